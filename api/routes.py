@@ -1,22 +1,56 @@
+import csv
+import io
 import json
 import logging
-from typing import List
+import os
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, List, Literal
 
-from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, ConfigDict
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy import func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
+import xlsxwriter
 
-from database.main import get_session
-from database.models import Poll, PollOption, Vote
+from database.main import async_session, get_session, get_pool_stats
+from database.stats import get_vote_histogram
+from database.models import BotUser, Poll, PollOption, Vote
+import poll_cache
+import poll_scheduler
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 templates = Jinja2Templates(directory="templates")
 
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Тот же Redis, что и у бота: через него API сбрасывает кэш результатов при изменении опроса
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+
+# Размер страницы списка участников в веб-отчете
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", 50))
+REPORT_MAX_PAGE_SIZE = 500
+
+# Максимальный размер страницы /api/polls
+POLLS_MAX_PAGE_SIZE = 200
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+async def get_redis() -> redis.Redis:
+    """
+    Зависимость для FastAPI для получения клиента Redis.
+    """
+    return redis_client
+
 
 class OptionOut(BaseModel):
     id: int
@@ -29,10 +63,18 @@ class PollOut(BaseModel):
     id: int
     title: str
     status: bool
+    opens_at: datetime | None = None
+    closes_at: datetime | None = None
     options: List[OptionOut]
     model_config = ConfigDict(from_attributes=True)
 
 
+class PollScheduleIn(BaseModel):
+    # Время без часового пояса - локальное время сервера; null - срок не задан
+    opens_at: datetime | None = None
+    closes_at: datetime | None = None
+
+
 @router.get("/", response_class=HTMLResponse, summary="Показать страницу со списком всех опросов")
 async def get_index_page(request: Request, session: AsyncSession = Depends(get_session)):
     result = await session.execute(select(Poll).order_by(Poll.id.desc()))
@@ -41,8 +83,12 @@ async def get_index_page(request: Request, session: AsyncSession = Depends(get_s
 
 
 @router.get("/report/{poll_id}/view", response_class=HTMLResponse, summary="Посмотреть веб-отчет по опросу")
-async def get_web_report(request: Request, poll_id: int, session: AsyncSession = Depends(get_session)):
-    logger.info(f"--- [ОТЧЕТ] Запрошен веб-отчет для опроса ID: {poll_id} ---")
+async def get_web_report(request: Request, poll_id: int,
+                         after: int | None = Query(None, description="ID последнего голоса предыдущей страницы"),
+                         option_id: int | None = Query(None, description="Показать только проголосовавших за вариант"),
+                         limit: int = Query(REPORT_PAGE_SIZE, ge=1, le=REPORT_MAX_PAGE_SIZE),
+                         session: AsyncSession = Depends(get_session)):
+    logger.info(f"--- [ОТЧЕТ] Запрошен веб-отчет для опроса ID: {poll_id} (after={after}, option={option_id}) ---")
 
     poll_result = await session.execute(select(Poll).filter(Poll.id == poll_id))
     poll = poll_result.scalar_one_or_none()
@@ -50,59 +96,318 @@ async def get_web_report(request: Request, poll_id: int, session: AsyncSession =
     if not poll:
         raise HTTPException(status_code=404, detail=f"Опрос с ID {poll_id} не найден.")
 
+    # Шапка и диаграмма строятся одним агрегирующим запросом, без загрузки самих голосов
+    options_query = (
+        select(PollOption.id, PollOption.option_text, func.count(Vote.id).label("votes"))
+        .outerjoin(Vote, Vote.option_id == PollOption.id)
+        .filter(PollOption.poll_id == poll_id)
+        .group_by(PollOption.id)
+        .order_by(PollOption.id)
+    )
+    options = (await session.execute(options_query)).all()
+    total_votes = sum(opt.votes for opt in options)
+    logger.info(f"[ОТЧЕТ] Найдено голосов в БД: {total_votes}")
+
+    if option_id is not None and option_id not in {opt.id for opt in options}:
+        raise HTTPException(status_code=404, detail=f"Вариант {option_id} не относится к опросу {poll_id}.")
+
+    # Таблица участников - одна страница, keyset-пагинация по ID голоса
     participants_query = (
-        select(Vote)
-        .options(
-            selectinload(Vote.user),
-            selectinload(Vote.option)
-        )
-        .filter(Vote.poll_id == poll_id)
+        select(Vote.id, BotUser, PollOption.option_text)
+        .outerjoin(BotUser, BotUser.user_tg_id == Vote.user_tg_id)
+        .outerjoin(PollOption, PollOption.id == Vote.option_id)
+        .order_by(Vote.id)
+        .limit(limit + 1)
     )
-    participants_result = await session.execute(participants_query)
-    participants = participants_result.scalars().all()
-    logger.info(f"[ОТЧЕТ] Найдено голосов в БД: {len(participants)}")
+    if option_id is not None:
+        participants_query = participants_query.filter(Vote.option_id == option_id)
+    else:
+        participants_query = participants_query.filter(Vote.poll_id == poll_id)
+    if after is not None:
+        participants_query = participants_query.filter(Vote.id > after)
 
-    options_query = select(PollOption).filter(PollOption.poll_id == poll_id).order_by(PollOption.id)
-    options_result = await session.execute(options_query)
-    options = options_result.scalars().all()
+    rows = (await session.execute(participants_query)).all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    participants = [{"user": user, "option_text": option_text} for _, user, option_text in rows]
+    next_after = rows[-1][0] if has_next else None
 
-    total_votes = len(participants)
-    chart_labels = json.dumps([opt.option_text for opt in options] if options else [])
-    chart_values = json.dumps([opt.votes_count for opt in options] if options else [])
+    chart_labels = json.dumps([opt.option_text for opt in options])
+    chart_values = json.dumps([opt.votes for opt in options])
+
+    # "Голоса во времени" - из минутных интервалов poll_vote_bucket, без обращения к таблице vote
+    unit, buckets, series = await get_vote_histogram(session, poll_id)
+    bucket_format = "%d.%m %H:%M" if unit == "minute" else "%d.%m %H:00"
+    timeline_labels = json.dumps([bucket.strftime(bucket_format) for bucket in buckets])
+    timeline_datasets = json.dumps([
+        {"label": opt.option_text, "data": series.get(opt.id, [0] * len(buckets))} for opt in options
+    ], ensure_ascii=False)
 
     context = {
         "request": request,
         "poll": poll,
         "total_votes": total_votes,
+        "options": options,
         "labels": chart_labels,
         "values": chart_values,
-        "participants": participants
+        "timeline_unit": unit,
+        "timeline_labels": timeline_labels,
+        "timeline_datasets": timeline_datasets,
+        "participants": participants,
+        "option_id": option_id,
+        "limit": limit,
+        "after": after,
+        "next_after": next_after,
     }
 
     return templates.TemplateResponse("report.html", context)
 
 
-@router.get("/polls", response_model=List[PollOut], summary="Получить все опросы в JSON")
-async def get_all_polls_json(session: AsyncSession = Depends(get_session)):
-    result = await session.execute(
-        select(Poll).options(selectinload(Poll.options)).order_by(Poll.id.desc())
-    )
-    return result.scalars().all()
+async def _get_etag(etag_func, *args) -> str | None:
+    """ETag из счетчиков версий в Redis; без Redis API продолжает работать, просто без условных запросов."""
+    try:
+        return await etag_func(*args)
+    except RedisError as e:
+        logger.warning(f"Не удалось получить версию опросов из Redis: {e}")
+        return None
+
+
+def _etag_matches(request: Request, etag: str | None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not etag or not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def _etag_headers(etag: str | None) -> dict:
+    # no-cache: клиент может хранить ответ, но обязан перепроверять его через If-None-Match
+    return {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+
+
+@router.get("/polls", response_model=List[PollOut], summary="Получить опросы в JSON")
+async def get_all_polls_json(request: Request, response: Response,
+                             cursor: int | None = Query(None, description="ID последнего опроса предыдущей страницы"),
+                             limit: int | None = Query(None, ge=1, le=POLLS_MAX_PAGE_SIZE,
+                                                       description="Размер страницы (без параметра - все опросы)"),
+                             status: bool | None = Query(None, description="true - активные, false - завершенные"),
+                             session: AsyncSession = Depends(get_session),
+                             redis_conn: redis.Redis = Depends(get_redis)):
+    # Версия читается до запроса в БД: если опрос изменится между ними, клиент просто получит данные повторно
+    etag = await _get_etag(poll_cache.polls_etag, redis_conn)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=_etag_headers(etag))
+
+    query = select(Poll).options(selectinload(Poll.options)).order_by(Poll.id.desc())
+    if status is not None:
+        query = query.filter(Poll.status.is_(status))
+    if cursor is not None:
+        query = query.filter(Poll.id < cursor)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    polls = (await session.execute(query)).scalars().all()
+
+    if limit is not None and len(polls) > limit:
+        polls = polls[:limit]
+        next_cursor = polls[-1].id
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    response.headers.update(_etag_headers(etag))
+    return polls
 
 
 @router.get("/polls/{poll_id}", response_model=PollOut, summary="Получить конкретный опрос в JSON")
-async def get_poll_by_id_json(poll_id: int, session: AsyncSession = Depends(get_session)):
+async def get_poll_by_id_json(poll_id: int, request: Request, response: Response,
+                              session: AsyncSession = Depends(get_session),
+                              redis_conn: redis.Redis = Depends(get_redis)):
+    etag = await _get_etag(poll_cache.poll_etag, redis_conn, poll_id)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=_etag_headers(etag))
+
     poll = await session.get(Poll, poll_id, options=[selectinload(Poll.options)])
     if not poll:
         raise HTTPException(status_code=404, detail="Опрос не найден.")
+    response.headers.update(_etag_headers(etag))
     return poll
 
 
+# --- ВЫГРУЗКА РЕЗУЛЬТАТОВ В CSV / XLSX ---
+
+# Доступные колонки выгрузки: имя параметра -> (заголовок, колонка запроса)
+EXPORT_COLUMNS = {
+    "poll_id": ("ID опроса", Poll.id),
+    "poll_title": ("Опрос", Poll.title),
+    "user_tg_id": ("Telegram ID", Vote.user_tg_id),
+    "username": ("Username", BotUser.username),
+    "first_name": ("Имя", BotUser.first_name),
+    "last_name": ("Фамилия", BotUser.last_name),
+    "option_id": ("ID варианта", PollOption.id),
+    "option": ("Выбранный вариант", PollOption.option_text),
+}
+DEFAULT_EXPORT_COLUMNS = ["poll_id", "poll_title", "user_tg_id", "username", "first_name", "last_name", "option"]
+# Сколько строк за раз читается из серверного курсора
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+
+def _parse_export_columns(columns: str | None) -> list[str]:
+    if not columns:
+        return DEFAULT_EXPORT_COLUMNS
+    names = [name.strip() for name in columns.split(",") if name.strip()]
+    unknown = [name for name in names if name not in EXPORT_COLUMNS]
+    if unknown or not names:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестные колонки: {', '.join(unknown)}. Доступны: {', '.join(EXPORT_COLUMNS)}."
+        )
+    return names
+
+
+def _export_query(columns: list[str], poll_id: int | None = None, scope: str = "all"):
+    query = (
+        select(*(EXPORT_COLUMNS[name][1] for name in columns))
+        .select_from(Vote)
+        .join(Poll, Poll.id == Vote.poll_id)
+        .join(PollOption, PollOption.id == Vote.option_id)
+        .outerjoin(BotUser, BotUser.user_tg_id == Vote.user_tg_id)
+        .order_by(Vote.poll_id, Vote.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if poll_id is not None:
+        query = query.filter(Vote.poll_id == poll_id)
+    elif scope == "active":
+        query = query.filter(Poll.status.is_(True))
+    return query
+
+
+async def _stream_rows(query) -> AsyncIterator[list]:
+    """
+    Читает строки выгрузки серверным курсором пачками по EXPORT_BATCH_SIZE.
+    Сессия открывается здесь, а не через Depends: зависимость закрывается до того, как начнется отдача ответа.
+    """
+    async with async_session() as session:
+        result = await session.stream(query)
+        async for partition in result.partitions():
+            yield partition
+
+
+async def _csv_chunks(query, columns: list[str]) -> AsyncIterator[bytes]:
+    # BOM нужен, чтобы Excel открыл файл в UTF-8 без мастера импорта
+    buffer = io.StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow([EXPORT_COLUMNS[name][0] for name in columns])
+    async for rows in _stream_rows(query):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+async def _xlsx_chunks(query, columns: list[str]) -> AsyncIterator[bytes]:
+    """
+    XLSX - это zip-архив, поэтому он собирается во временный файл (constant_memory сбрасывает
+    строки на диск по мере записи), а затем отдается кусками.
+    """
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        worksheet = workbook.add_worksheet("Голоса")
+        bold = workbook.add_format({"bold": True})
+        worksheet.write_row(0, 0, [EXPORT_COLUMNS[name][0] for name in columns], bold)
+        row_number = 1
+        async for rows in _stream_rows(query):
+            for row in rows:
+                worksheet.write_row(row_number, 0, row)
+                row_number += 1
+        await run_in_threadpool(workbook.close)
+
+        with open(path, "rb") as file:
+            while chunk := await run_in_threadpool(file.read, 64 * 1024):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def _export_response(chunks: AsyncIterator[bytes], filename: str, media_type: str) -> StreamingResponse:
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+async def _check_poll_exists(session: AsyncSession, poll_id: int):
+    if not await session.get(Poll, poll_id):
+        raise HTTPException(status_code=404, detail=f"Опрос с ID {poll_id} не найден.")
+
+
+@router.get("/report/{poll_id}/export.csv", summary="Выгрузить голоса опроса в CSV")
+async def export_poll_csv(poll_id: int, columns: str | None = Query(None, description="Колонки через запятую"),
+                          session: AsyncSession = Depends(get_session)):
+    names = _parse_export_columns(columns)
+    await _check_poll_exists(session, poll_id)
+    logger.info(f"[ВЫГРУЗКА] CSV по опросу ID: {poll_id}")
+    return _export_response(_csv_chunks(_export_query(names, poll_id), names),
+                            f"poll_{poll_id}.csv", "text/csv; charset=utf-8")
+
+
+@router.get("/report/{poll_id}/export.xlsx", summary="Выгрузить голоса опроса в Excel")
+async def export_poll_xlsx(poll_id: int, columns: str | None = Query(None, description="Колонки через запятую"),
+                           session: AsyncSession = Depends(get_session)):
+    names = _parse_export_columns(columns)
+    await _check_poll_exists(session, poll_id)
+    logger.info(f"[ВЫГРУЗКА] XLSX по опросу ID: {poll_id}")
+    return _export_response(_xlsx_chunks(_export_query(names, poll_id), names),
+                            f"poll_{poll_id}.xlsx", XLSX_MEDIA_TYPE)
+
+
+@router.get("/report/export.csv", summary="Выгрузить голоса всех или активных опросов в CSV")
+async def export_polls_csv(scope: Literal["all", "active"] = "all",
+                           columns: str | None = Query(None, description="Колонки через запятую")):
+    names = _parse_export_columns(columns)
+    logger.info(f"[ВЫГРУЗКА] CSV по опросам ({scope})")
+    return _export_response(_csv_chunks(_export_query(names, scope=scope), names),
+                            f"polls_{scope}.csv", "text/csv; charset=utf-8")
+
+
+@router.get("/report/export.xlsx", summary="Выгрузить голоса всех или активных опросов в Excel")
+async def export_polls_xlsx(scope: Literal["all", "active"] = "all",
+                            columns: str | None = Query(None, description="Колонки через запятую")):
+    names = _parse_export_columns(columns)
+    logger.info(f"[ВЫГРУЗКА] XLSX по опросам ({scope})")
+    return _export_response(_xlsx_chunks(_export_query(names, scope=scope), names),
+                            f"polls_{scope}.xlsx", XLSX_MEDIA_TYPE)
+
+
+@router.get("/health/db", summary="Состояние пула соединений с БД")
+async def get_db_pool_health():
+    return get_pool_stats()
+
+
 @router.put("/polls/{poll_id}/status", summary="Изменить статус опроса")
-async def update_poll_status(poll_id: int, status: bool, session: AsyncSession = Depends(get_session)):
+async def update_poll_status(poll_id: int, status: bool, session: AsyncSession = Depends(get_session),
+                             redis_conn: redis.Redis = Depends(get_redis)):
     poll = await session.get(Poll, poll_id)
     if not poll:
         raise HTTPException(status_code=404, detail="Опрос не найден.")
     poll.status = status
     await session.commit()
-    return {"message": f"Статус опроса {poll_id} изменен на {status}."}
\ No newline at end of file
+    await poll_cache.bump_version(redis_conn, poll_id)
+    return {"message": f"Статус опроса {poll_id} изменен на {status}."}
+
+
+@router.put("/polls/{poll_id}/schedule", summary="Задать время открытия и закрытия опроса")
+async def update_poll_schedule(poll_id: int, schedule: PollScheduleIn, session: AsyncSession = Depends(get_session),
+                               redis_conn: redis.Redis = Depends(get_redis)):
+    try:
+        poll = await poll_scheduler.set_schedule(session, redis_conn, poll_id, schedule.opens_at, schedule.closes_at)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not poll:
+        raise HTTPException(status_code=404, detail="Опрос не найден.")
+    return {"message": f"Расписание опроса {poll_id} обновлено.", "status": poll.status,
+            "opens_at": poll.opens_at, "closes_at": poll.closes_at}
\ No newline at end of file
@@ -1,11 +1,19 @@
 # KorpBot/app.py
 
 from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response
 from api.routes import router as poll_router
+from database.tracing import SQL_TRACE, fastapi_trace_middleware
+import metrics
 
 app = FastAPI(title="PollBot API")
 
+# Время ответа по маршрутам и число запросов в работе (см. metrics.py)
+app.middleware("http")(metrics.api_metrics_middleware)
+# Число и время SQL-запросов по каждому запросу (SQL_TRACE=1), итог - в заголовке Server-Timing
+if SQL_TRACE:
+    app.middleware("http")(fastapi_trace_middleware)
+
 # Добавляем наш роутер с эндпоинтами
 app.include_router(poll_router, prefix="/api")
 
@@ -13,4 +21,11 @@ app.include_router(poll_router, prefix="/api")
 @app.get("/")
 def read_root():
     """Редирект с главной страницы на список опросов."""
-    return RedirectResponse(url="/api/")
\ No newline at end of file
+    return RedirectResponse(url="/api/")
+
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """Метрики Prometheus: бота и воркера - на их собственных портах METRICS_PORT."""
+    content, content_type = metrics.render_latest()
+    return Response(content=content, media_type=content_type)
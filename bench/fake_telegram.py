@@ -0,0 +1,149 @@
+# KorpBot/bench/fake_telegram.py
+#
+# Локальная замена api.telegram.org для нагрузочных тестов: отвечает на методы Bot API правдоподобными
+# объектами, запоминает все вызовы и по настройке возвращает 429 (лимит скорости) и 403 (бот заблокирован).
+# Бот направляется на сервер через TelegramAPIServer:
+#   Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base(server.base_url)))
+
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_ID = 1_000_000
+BOT_USERNAME = "bench_bot"
+
+# Методы, которые отправляют сообщение в чат: к ним применяются 403 для заблокированных чатов
+_SEND_METHODS = {"sendmessage", "sendpoll", "sendphoto", "senddocument", "copymessage", "forwardmessage"}
+# Методы, которые могут получить 429
+_LIMITED_METHODS = _SEND_METHODS | {"editmessagetext", "editmessagereplymarkup"}
+
+
+class FakeTelegramServer:
+    """
+    aiohttp-сервер с подмножеством Bot API. Ошибки настраиваются на ходу (configure), поэтому один
+    сервер обслуживает все фазы теста: обработку апдейтов без ошибок и рассылку с 429/403.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, seed: int = 0):
+        self.host = host
+        self.port = port
+        self.calls: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.sent_to: Counter = Counter()
+        self.retry_after_rate = 0.0
+        self.retry_after = 1
+        self.blocked_share = 0.0
+        self.latency = 0.0
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def configure(self, retry_after_rate: float = 0.0, retry_after: int = 1,
+                  blocked_share: float = 0.0, latency: float = 0.0):
+        """
+        :param retry_after_rate: доля запросов отправки, на которые сервер отвечает 429.
+        :param retry_after: значение retry_after в ответе 429 (секунды).
+        :param blocked_share: доля чатов, заблокировавших бота (403); выбор детерминирован по chat_id.
+        :param latency: задержка каждого ответа, секунды (сеть до настоящего Telegram).
+        """
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked_share = blocked_share
+        self.latency = latency
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.statuses.clear()
+        self.sent_to.clear()
+
+    def is_blocked(self, chat_id: int) -> bool:
+        return self.blocked_share > 0 and (chat_id * 2654435761) % 10_000 < self.blocked_share * 10_000
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Порт 0 - свободный порт, выбранный системой
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            "unique_chats": len(self.sent_to),
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        name = method.lower()
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else None
+        if name in _LIMITED_METHODS and self.retry_after_rate and self._random.random() < self.retry_after_rate:
+            return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                               {"retry_after": self.retry_after})
+        if name in _SEND_METHODS and chat_id is not None and self.is_blocked(chat_id):
+            return self._error(403, "Forbidden: bot was blocked by the user")
+
+        if chat_id is not None and name in _SEND_METHODS:
+            self.sent_to[chat_id] += 1
+        return self._ok(self._result(name, params, chat_id))
+
+    def _result(self, name: str, params: dict, chat_id: int | None):
+        if name == "getme":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+        if name in _SEND_METHODS or name == "editmessagetext":
+            if name == "editmessagetext" and "inline_message_id" in params:
+                return True
+            return self._message(params, chat_id)
+        # answerCallbackQuery, deleteWebhook, setWebhook, deleteMessage и т.п.
+        return True
+
+    def _message(self, params: dict, chat_id: int | None) -> dict:
+        if "message_id" in params:
+            message_id = int(params["message_id"])
+        else:
+            self._message_id += 1
+            message_id = self._message_id
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id or 0, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME},
+            "text": params.get("text", ""),
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+            if "inline_keyboard" not in message["reply_markup"]:
+                # Обычная клавиатура в ответе Telegram не возвращается
+                del message["reply_markup"]
+        return message
+
+    def _ok(self, result) -> web.Response:
+        self.statuses[200] += 1
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, code: int, description: str, parameters: dict | None = None) -> web.Response:
+        self.statuses[code] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
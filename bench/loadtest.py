@@ -0,0 +1,444 @@
+# KorpBot/bench/loadtest.py
+#
+# Нагрузочный тест бота: N пользователей проходят сценарий /start -> poll_ -> vote_ -> results_ через настоящий
+# Dispatcher (те же роутеры, middleware, БД и Redis, что и в продакшене), а запросы к Bot API уходят на локальную
+# замену Telegram (bench/fake_telegram.py). Затем отдельно измеряется скорость рассылки с ответами 429/403.
+# Результаты сохраняются в JSON, чтобы сравнивать версии между собой.
+#
+#   python -m bench.loadtest run --users 500 --concurrency 50 --broadcast 2000
+#   python -m bench.loadtest compare bench/results/old.json bench/results/new.json
+#
+# Нужны PostgreSQL со схемой последней версии (python -m database.migrate) и Redis (или --fake-redis).
+# Тест создает свой опрос и пользователей с ID от BENCH_USER_BASE и удаляет их по окончании,
+# но запускать его лучше на отдельной базе: нагрузка на нее настоящая.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+from sqlalchemy import event as sa_event, text
+
+from bench.fake_telegram import FakeTelegramServer
+
+logger = logging.getLogger(__name__)
+
+# Пользователи теста: диапазон, в котором настоящих ID Telegram пока нет
+BENCH_USER_BASE = 9_000_000_000
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class UpdateTrace:
+    """Что произошло при обработке одного апдейта."""
+    handler: str = "unhandled"
+    queries: int = 0
+    api_calls: int = 0
+
+
+@dataclass
+class HandlerSamples:
+    latencies: list[float] = field(default_factory=list)
+    queries: int = 0
+    api_calls: int = 0
+    errors: int = 0
+
+
+# Трасса текущего апдейта. Запросы SQLAlchemy выполняются в greenlet внутри той же задачи,
+# поэтому обработчик событий движка видит это значение.
+_current_trace: ContextVar[UpdateTrace | None] = ContextVar("bench_update_trace", default=None)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.queries += 1
+
+
+async def _count_api_call(make_request, bot, method):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.api_calls += 1
+    return await make_request(bot, method)
+
+
+async def _remember_handler(handler, event, data):
+    trace = _current_trace.get()
+    if trace is not None:
+        callback = getattr(data.get("handler"), "callback", None)
+        trace.handler = getattr(callback, "__name__", "?")
+    return await handler(event, data)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Перцентиль по ближайшему рангу (values должен быть отсортирован)."""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, timeout=5).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+class LoadGenerator:
+    """Строит апдейты от имени пользователей теста и прогоняет их через Dispatcher с замерами."""
+
+    def __init__(self, bot: Bot, dp: Dispatcher, poll_id: int, option_ids: list[int], seed: int = 0):
+        self.bot = bot
+        self.dp = dp
+        self.poll_id = poll_id
+        self.option_ids = option_ids
+        self.samples: dict[str, HandlerSamples] = {}
+        self._random = random.Random(seed)
+        self._update_id = 0
+        self._message_id = 1_000_000
+
+    def _next_ids(self) -> tuple[int, int]:
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id - BENCH_USER_BASE}",
+                "username": f"bench_{user_id}", "language_code": "ru"}
+
+    def _message(self, user_id: int, text_: str, from_bot: bool = False, keyboard: list | None = None) -> dict:
+        _, message_id = self._next_ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bench"} if from_bot else self._user(user_id),
+            "text": text_,
+        }
+        if keyboard:
+            message["reply_markup"] = {"inline_keyboard": keyboard}
+        return message
+
+    def command(self, user_id: int, command: str) -> Update:
+        message = self._message(user_id, command)
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}]
+        return self._update({"message": message})
+
+    def callback(self, user_id: int, data: str, keyboard: list | None = None) -> Update:
+        message = self._message(user_id, "...", from_bot=True, keyboard=keyboard)
+        return self._update({"callback_query": {
+            "id": f"{user_id}-{self._update_id}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        }})
+
+    def _update(self, payload: dict) -> Update:
+        return Update.model_validate({"update_id": self._update_id, **payload}, context={"bot": self.bot})
+
+    async def feed(self, update: Update):
+        trace = UpdateTrace()
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        failed = False
+        try:
+            result = await self.dp.feed_update(self.bot, update)
+            if result is UNHANDLED:
+                trace.handler = "unhandled"
+        except Exception as e:
+            failed = True
+            logger.warning(f"Ошибка обработки апдейта {update.update_id} ({trace.handler}): {e}")
+        finally:
+            _current_trace.reset(token)
+        samples = self.samples.setdefault(trace.handler, HandlerSamples())
+        samples.latencies.append(time.perf_counter() - started)
+        samples.queries += trace.queries
+        samples.api_calls += trace.api_calls
+        samples.errors += failed
+
+    async def user_session(self, user_id: int, votes: int):
+        """Сценарий одного пользователя: /start, открыть опрос, проголосовать (votes раз), обновить результаты."""
+        vote_keyboard = [[{"text": str(option_id), "callback_data": f"vote_{option_id}"}] for option_id in self.option_ids]
+        results_keyboard = [[{"text": "🔄", "callback_data": f"results_{self.poll_id}"}]]
+
+        await self.feed(self.command(user_id, "/start"))
+        await self.feed(self.callback(user_id, f"poll_{self.poll_id}"))
+        for _ in range(votes):
+            option_id = self._random.choice(self.option_ids)
+            await self.feed(self.callback(user_id, f"vote_{option_id}", keyboard=vote_keyboard))
+        await self.feed(self.callback(user_id, f"results_{self.poll_id}", keyboard=results_keyboard))
+
+    def report(self) -> dict:
+        handlers = {}
+        for name, samples in sorted(self.samples.items()):
+            latencies = sorted(samples.latencies)
+            count = len(latencies)
+            handlers[name] = {
+                "count": count,
+                "errors": samples.errors,
+                **{f"p{pct}_ms": round(percentile(latencies, pct) * 1000, 2) for pct in PERCENTILES},
+                "max_ms": round(latencies[-1] * 1000, 2),
+                "mean_ms": round(sum(latencies) / count * 1000, 2),
+                "db_queries_per_update": round(samples.queries / count, 2),
+                "api_calls_per_update": round(samples.api_calls / count, 2),
+            }
+        return handlers
+
+
+async def _create_bench_poll(session_pool, options: int) -> tuple[int, list[int]]:
+    from poll_state import start_new_poll
+
+    async with session_pool() as session:
+        poll_id = await start_new_poll(session, f"Нагрузочный тест {datetime.now():%Y-%m-%d %H:%M:%S}",
+                                       [f"Вариант {i + 1}" for i in range(options)])
+        option_ids = (await session.execute(
+            text("SELECT id FROM poll_option WHERE poll_id = :poll_id ORDER BY id"), {"poll_id": poll_id}
+        )).scalars().all()
+    return poll_id, list(option_ids)
+
+
+async def _cleanup(session_pool, redis_client, poll_id: int, users: int):
+    import live_results
+    import poll_cache
+    import vote_buffer
+    from database.crud import KNOWN_USERS_KEY
+
+    if vote_buffer.WRITE_BEHIND:
+        await vote_buffer.flush(redis_client, session_pool)
+        await vote_buffer.forget_poll(redis_client, poll_id)
+    async with session_pool() as session:
+        await session.execute(text("DELETE FROM poll WHERE id = :poll_id"), {"poll_id": poll_id})
+        await session.execute(text("DELETE FROM bot_user WHERE user_tg_id BETWEEN :first AND :last"),
+                              {"first": BENCH_USER_BASE, "last": BENCH_USER_BASE + users})
+        await session.commit()
+    await redis_client.delete(live_results._messages_key(poll_id), live_results._hashes_key(poll_id))
+    await redis_client.srem(live_results.DIRTY_POLLS_KEY, poll_id)
+    await redis_client.hdel(KNOWN_USERS_KEY, *range(BENCH_USER_BASE, BENCH_USER_BASE + users + 1))
+    await poll_cache.bump_version(redis_client)
+
+
+async def _run_updates(generator: LoadGenerator, users: int, concurrency: int, votes: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_user(user_id: int):
+        async with semaphore:
+            await generator.user_session(user_id, votes)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(BENCH_USER_BASE + i + 1) for i in range(users)))
+    elapsed = time.perf_counter() - started
+
+    handlers = generator.report()
+    total = sum(stats["count"] for stats in handlers.values())
+    votes_handled = handlers.get("handle_vote", {}).get("count", 0)
+    return {
+        "handlers": handlers,
+        "updates": {
+            "total": total,
+            "elapsed": round(elapsed, 2),
+            "updates_per_sec": round(total / elapsed, 1) if elapsed else 0.0,
+            "votes_per_sec": round(votes_handled / elapsed, 1) if elapsed else 0.0,
+        },
+    }
+
+
+async def _run_broadcast(bot: Bot, server: FakeTelegramServer, poll_id: int, args) -> dict:
+    from broadcaster import BroadcastEngine
+    from tasks import _make_sender
+
+    server.reset_counters()
+    server.configure(retry_after_rate=args.retry_after_share, retry_after=args.retry_after,
+                     blocked_share=args.blocked_share, latency=args.latency)
+    engine = BroadcastEngine(rate=args.broadcast_rate, concurrency=args.broadcast_concurrency)
+    send = _make_sender(bot, "poll", {"poll_id": poll_id, "title": "Нагрузочный тест"})
+    chat_ids = range(BENCH_USER_BASE + 1, BENCH_USER_BASE + args.broadcast + 1)
+    stats = await engine.run(chat_ids, send)
+    return {
+        "target_rate": args.broadcast_rate,
+        "concurrency": args.broadcast_concurrency,
+        **stats.as_dict(),
+        "telegram": server.stats(),
+    }
+
+
+async def run(args) -> dict:
+    # Окружение бота должно быть готово до импорта main (он проверяет BOT_TOKEN при импорте)
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    from main import build_dispatcher, start_background_tasks
+    from commands import router as commands_router
+    from general import router as general_router
+    from database.main import async_session, engine
+    from database.migrate import check_schema_version
+    import live_results
+    import vote_buffer
+
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    if args.fake_redis:
+        from fakeredis import FakeAsyncRedis
+        redis_client = FakeAsyncRedis(decode_responses=True)
+    else:
+        import redis.asyncio as redis
+        redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", 6379)),
+                                   decode_responses=True)
+
+    await check_schema_version()
+    started_at = datetime.now().isoformat(timespec="seconds")
+
+    server = FakeTelegramServer(seed=args.seed)
+    await server.start()
+    server.configure(latency=args.latency)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(server.base_url))
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    bot.session.middleware(_count_api_call)
+
+    dp = build_dispatcher(redis_client)
+    commands_router.message.middleware(_remember_handler)
+    commands_router.callback_query.middleware(_remember_handler)
+    general_router.message.middleware(_remember_handler)
+    sa_event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+
+    poll_id, option_ids = await _create_bench_poll(async_session, args.options)
+    background_tasks = await start_background_tasks(bot, redis_client)
+    logger.info(f"Опрос теста: ID {poll_id}, вариантов {len(option_ids)}. "
+                f"Пользователей: {args.users}, одновременно: {args.concurrency}")
+    try:
+        updates = await _run_updates(LoadGenerator(bot, dp, poll_id, option_ids, args.seed),
+                                     args.users, args.concurrency, args.votes)
+        updates["telegram"] = server.stats()
+        broadcast = await _run_broadcast(bot, server, poll_id, args) if args.broadcast else None
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        sa_event.remove(engine.sync_engine, "before_cursor_execute", _count_query)
+        if not args.keep_data:
+            await _cleanup(async_session, redis_client, poll_id, max(args.users, args.broadcast))
+        await bot.session.close()
+        await server.stop()
+        await redis_client.aclose()
+        await engine.dispose()
+
+    return {
+        "meta": {
+            "revision": _git_revision(),
+            "started_at": started_at,
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "votes_per_user": args.votes,
+            "options": args.options,
+            "telegram_latency_ms": args.latency * 1000,
+            "fake_redis": args.fake_redis,
+            "write_behind": vote_buffer.WRITE_BEHIND,
+            "live_results": live_results.LIVE_RESULTS_ENABLED,
+            "db_pool_profile": os.getenv("DB_POOL_PROFILE", "bot"),
+        },
+        **updates,
+        "broadcast": broadcast,
+    }
+
+
+def print_report(result: dict):
+    print(f"Ревизия {result['meta']['revision']}, пользователей {result['meta']['users']}, "
+          f"одновременно {result['meta']['concurrency']}")
+    print(f"{'хэндлер':<22}{'кол-во':>8}{'ошибок':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'SQL/апд':>9}{'API/апд':>9}")
+    for name, stats in result["handlers"].items():
+        print(f"{name:<22}{stats['count']:>8}{stats['errors']:>8}{stats['p50_ms']:>9}{stats['p95_ms']:>9}"
+              f"{stats['p99_ms']:>9}{stats['db_queries_per_update']:>9}{stats['api_calls_per_update']:>9}")
+    updates = result["updates"]
+    print(f"Апдейтов: {updates['total']} за {updates['elapsed']} c - {updates['updates_per_sec']} апд./с, "
+          f"{updates['votes_per_sec']} голосов/с")
+    if result.get("broadcast"):
+        broadcast = result["broadcast"]
+        print(f"Рассылка: {broadcast['sent']} из {broadcast['total']} за {broadcast['elapsed']} c - "
+              f"{broadcast['rate']} сообщ./с (лимит {broadcast['target_rate']}), ошибок {broadcast['failed']}, "
+              f"пауз 429: {broadcast['retry_after_pauses']}")
+
+
+def compare(old: dict, new: dict):
+    """Печатает изменения p50/p95/p99 и пропускной способности между двумя прогонами."""
+    def delta(before: float, after: float) -> str:
+        if not before:
+            return f"{after}"
+        return f"{before} -> {after} ({(after - before) / before * 100:+.0f}%)"
+
+    print(f"Ревизии: {old['meta']['revision']} -> {new['meta']['revision']}")
+    for name in sorted(set(old["handlers"]) | set(new["handlers"])):
+        before, after = old["handlers"].get(name), new["handlers"].get(name)
+        if not before or not after:
+            print(f"{name}: есть только в {'новом' if after else 'старом'} прогоне")
+            continue
+        print(f"{name}: " + ", ".join(f"p{pct} {delta(before[f'p{pct}_ms'], after[f'p{pct}_ms'])} мс" for pct in PERCENTILES)
+              + f", SQL/апд {delta(before['db_queries_per_update'], after['db_queries_per_update'])}")
+    print(f"Апдейтов/с: {delta(old['updates']['updates_per_sec'], new['updates']['updates_per_sec'])}")
+    if old.get("broadcast") and new.get("broadcast"):
+        print(f"Рассылка, сообщ./с: {delta(old['broadcast']['rate'], new['broadcast']['rate'])}")
+
+
+def _main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальной замене Telegram")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Прогнать нагрузку и сохранить результаты")
+    run_parser.add_argument("--users", type=int, default=200, help="Пользователей в сценарии")
+    run_parser.add_argument("--concurrency", type=int, default=50, help="Пользователей одновременно")
+    run_parser.add_argument("--votes", type=int, default=2, help="Голосов на пользователя (повторные меняют выбор)")
+    run_parser.add_argument("--options", type=int, default=4, help="Вариантов в опросе теста")
+    run_parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответов Bot API, секунды")
+    run_parser.add_argument("--broadcast", type=int, default=500, help="Получателей рассылки (0 - без рассылки)")
+    run_parser.add_argument("--broadcast-rate", type=float, default=None, help="Лимит рассылки, сообщ./с")
+    run_parser.add_argument("--broadcast-concurrency", type=int, default=None)
+    run_parser.add_argument("--retry-after-share", type=float, default=0.005, help="Доля ответов 429 в рассылке")
+    run_parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, секунды")
+    run_parser.add_argument("--blocked-share", type=float, default=0.02, help="Доля получателей, заблокировавших бота")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--fake-redis", action="store_true", help="Redis в памяти процесса (fakeredis)")
+    run_parser.add_argument("--keep-data", action="store_true", help="Не удалять опрос и пользователей теста")
+    run_parser.add_argument("--out", help="Файл результатов (по умолчанию bench/results/<время>-<ревизия>.json)")
+
+    compare_parser = subparsers.add_parser("compare", help="Сравнить два файла результатов")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old, encoding="utf-8") as old, open(args.new, encoding="utf-8") as new:
+            compare(json.load(old), json.load(new))
+        return 0
+
+    from broadcaster import BROADCAST_CONCURRENCY, BROADCAST_RATE
+    args.broadcast_rate = args.broadcast_rate or BROADCAST_RATE
+    args.broadcast_concurrency = args.broadcast_concurrency or BROADCAST_CONCURRENCY
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    out = Path(args.out) if args.out else RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{result['meta']['revision']}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Результаты сохранены: {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,139 @@
+# KorpBot/bench/storage_bench.py
+#
+# Микробенчмарк файлового хранилища опросов (storage.py): журнал с пачечным fsync против прежней схемы,
+# которая на каждый save_poll / update_last_poll_votes перечитывает и целиком перезаписывает polls.json.
+# Оба варианта стартуют с одного и того же снимка из --polls опросов и выполняют --ops пар операций
+# (новый опрос + обновление его голосов), затем измеряется загрузка хранилища с нуля.
+# Прежняя схема на 10 тыс. опросов тратит на операцию сотни миллисекунд, поэтому --ops по умолчанию невелико;
+# чтобы в замер журнала попало сжатие в снимок, задайте --compact-every меньше 2 * --ops.
+#
+#   python -m bench.storage_bench --polls 10000 --ops 100
+#   python -m bench.storage_bench --polls 10000 --ops 100 --compact-every 50
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from storage import PollJournal
+
+
+def make_poll(number: int, options: int = 4) -> dict:
+    return {
+        "id": number,
+        "question": f"Вопрос номер {number}: как вы оцениваете работу столовой?",
+        "options": [f"Вариант {i + 1}" for i in range(options)],
+        "votes": {str(i): 0 for i in range(options)},
+    }
+
+
+class LegacyStore:
+    """Прежняя реализация storage.py: каждая запись перечитывает и перезаписывает весь файл."""
+
+    def __init__(self, data_file: str):
+        self.data_file = data_file
+
+    def load_polls(self):
+        if os.path.exists(self.data_file):
+            with open(self.data_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return []
+
+    def save_poll(self, poll):
+        polls = self.load_polls()
+        polls.append(poll)
+        with open(self.data_file, "w", encoding="utf-8") as f:
+            json.dump(polls, f, ensure_ascii=False, indent=4)
+
+    def update_last_poll_votes(self, votes):
+        polls = self.load_polls()
+        if polls:
+            polls[-1]["votes"] = votes
+            with open(self.data_file, "w", encoding="utf-8") as f:
+                json.dump(polls, f, ensure_ascii=False, indent=4)
+
+
+def _percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def _measure(save, update, polls: int, ops: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for number in range(polls, polls + ops):
+        poll = make_poll(number)
+        op_started = time.perf_counter()
+        save(poll)
+        latencies.append(time.perf_counter() - op_started)
+        op_started = time.perf_counter()
+        update({"0": number % 7, "1": 1, "2": 0, "3": 2})
+        latencies.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": len(latencies),
+        "elapsed": elapsed,
+        "ops_per_second": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+def _write_snapshot(path: str, polls: int):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([make_poll(number) for number in range(polls)], f, ensure_ascii=False, indent=4)
+
+
+def run(polls: int, ops: int, fsync_every: int, compact_every: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = os.path.join(directory, "legacy.json")
+        _write_snapshot(legacy_file, polls)
+        legacy = LegacyStore(legacy_file)
+        results["legacy"] = _measure(legacy.save_poll, legacy.update_last_poll_votes, polls, ops)
+        started = time.perf_counter()
+        loaded = len(legacy.load_polls())
+        results["legacy"]["load_ms"] = (time.perf_counter() - started) * 1000
+        results["legacy"]["size_kb"] = os.path.getsize(legacy_file) / 1024
+
+        data_file = os.path.join(directory, "polls.json")
+        journal_file = os.path.join(directory, "polls.journal.jsonl")
+        _write_snapshot(data_file, polls)
+        journal = PollJournal(data_file, journal_file, fsync_every=fsync_every, compact_every=compact_every)
+        results["journal"] = _measure(journal.add_poll, journal.update_last_votes, polls, ops)
+        journal.close()
+        started = time.perf_counter()
+        reloaded = PollJournal(data_file, journal_file)
+        results["journal"]["load_ms"] = (time.perf_counter() - started) * 1000
+        results["journal"]["size_kb"] = (os.path.getsize(data_file) + os.path.getsize(journal_file)) / 1024
+        reloaded.close()
+
+        if loaded != len(reloaded.polls) or legacy.load_polls()[-1] != reloaded.polls[-1]:
+            raise RuntimeError("Хранилища разошлись: журнал вернул не те данные, что прежняя реализация")
+    return results
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser(description="Сравнение журнала storage.py с перезаписью всего файла")
+    parser.add_argument("--polls", type=int, default=10_000, help="Опросов в хранилище перед замером")
+    parser.add_argument("--ops", type=int, default=100, help="Пар операций save_poll + update_last_poll_votes")
+    parser.add_argument("--fsync-every", type=int, default=64, help="fsync журнала раз в N записей")
+    parser.add_argument("--compact-every", type=int, default=1000, help="Сжатие журнала раз в N записей")
+    args = parser.parse_args()
+
+    results = run(args.polls, args.ops, args.fsync_every, args.compact_every)
+    print(f"Опросов: {args.polls}, операций: {args.ops * 2}")
+    print(f"{'':10} {'опер./с':>10} {'p50, мс':>10} {'p99, мс':>10} {'загрузка, мс':>14} {'на диске, КБ':>14}")
+    for name, result in results.items():
+        print(f"{name:10} {result['ops_per_second']:10.1f} {result['p50_ms']:10.3f} {result['p99_ms']:10.3f} "
+              f"{result['load_ms']:14.1f} {result['size_kb']:14.0f}")
+    speedup = results["journal"]["ops_per_second"] / results["legacy"]["ops_per_second"]
+    print(f"Журнал быстрее прежней схемы в {speedup:.0f} раз")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,196 @@
+# KorpBot/broadcast_state.py
+
+import json
+import time
+import uuid
+
+from redis.asyncio import Redis
+
+# Ключи Redis для состояния рассылок. Все ключи одной рассылки живут BROADCAST_TTL секунд.
+BROADCAST_TTL = 7 * 24 * 3600
+RECENT_BROADCASTS_KEY = "broadcasts:recent"
+
+
+def _meta_key(broadcast_id: int) -> str:
+    return f"broadcast:{broadcast_id}"
+
+
+def _checkpoints_key(broadcast_id: int) -> str:
+    return f"broadcast:{broadcast_id}:checkpoints"
+
+
+def _done_key(broadcast_id: int) -> str:
+    return f"broadcast:{broadcast_id}:done"
+
+
+def _lock_key(broadcast_id: int, shard: int) -> str:
+    return f"broadcast:{broadcast_id}:shard:{shard}:lock"
+
+
+# Блокировка шарда хранит токен задачи-владельца. Продлевает и снимает ее только владелец: задача, которая
+# зависла дольше срока блокировки, не должна продлить или снять блокировку задачи, перехватившей шард.
+
+# KEYS: lock, checkpoints, meta; ARGV: token, shard, last_user_id, sent, failed, lock_ttl, broadcast_ttl
+# Счетчики увеличиваются в любом случае - сообщения уже отправлены. Контрольная точка и срок блокировки
+# меняются, только если блокировка все еще наша. Возвращает 1 - блокировка наша, 0 - шард перехвачен.
+_SAVE_PROGRESS_SCRIPT = """
+redis.call('HINCRBY', KEYS[3], 'sent', ARGV[4])
+redis.call('HINCRBY', KEYS[3], 'failed', ARGV[5])
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return 1
+"""
+
+# KEYS: lock, done; ARGV: token, shard, broadcast_ttl
+# Возвращает число завершенных шардов или -1, если блокировка уже не наша (шард не отмечается).
+_FINISH_SHARD_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return -1
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('DEL', KEYS[1])
+return redis.call('SCARD', KEYS[2])
+"""
+
+# KEYS: lock; ARGV: token
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ShardLocked(Exception):
+    """Шард захвачен другой задачей: живой или воркером, который упал, не успев снять блокировку."""
+
+    def __init__(self, broadcast_id: int, shard: int, retry_in: int):
+        super().__init__(f"Шард {shard} рассылки ID {broadcast_id} заблокирован еще {retry_in} с")
+        self.retry_in = retry_in
+
+
+async def create_broadcast(redis: Redis, kind: str, payload: dict, shards: int, total_users: int,
+                           audience: dict | None = None) -> int:
+    """
+    Регистрирует новую рассылку и возвращает ее ID.
+    :param kind: тип рассылки ("message", "poll" или "reminder").
+    :param payload: данные, необходимые шардам для отправки (текст, ID опроса и т.п.).
+    :param audience: аудитория рассылки (database.audience.Audience.to_dict()), по умолчанию - все.
+    """
+    broadcast_id = await redis.incr("broadcast:seq")
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_meta_key(broadcast_id), mapping={
+            "kind": kind,
+            "payload": json.dumps(payload, ensure_ascii=False),
+            "audience": json.dumps(audience or {}),
+            "shards": shards,
+            "total_users": total_users,
+            "sent": 0,
+            "failed": 0,
+            "status": "running",
+            "created_at": time.time(),
+        })
+        pipe.expire(_meta_key(broadcast_id), BROADCAST_TTL)
+        pipe.lpush(RECENT_BROADCASTS_KEY, broadcast_id)
+        pipe.ltrim(RECENT_BROADCASTS_KEY, 0, 19)
+        await pipe.execute()
+    return broadcast_id
+
+
+async def get_broadcast(redis: Redis, broadcast_id: int) -> dict | None:
+    """Возвращает описание рассылки (kind, payload, счетчики) или None, если она не найдена."""
+    meta = await redis.hgetall(_meta_key(broadcast_id))
+    if not meta:
+        return None
+    meta["payload"] = json.loads(meta["payload"])
+    # У рассылок, созданных до появления аудиторий, поля нет - это рассылка всем
+    meta["audience"] = json.loads(meta.get("audience") or "{}")
+    return meta
+
+
+async def get_latest_broadcast_id(redis: Redis) -> int | None:
+    latest = await redis.lindex(RECENT_BROADCASTS_KEY, 0)
+    return int(latest) if latest is not None else None
+
+
+async def acquire_shard(redis: Redis, broadcast_id: int, shard: int, ttl: int = 900) -> str | None:
+    """
+    Захватывает шард, чтобы повторно доставленная задача не выполнялась параллельно с живой.
+    Блокировку нужно продлевать вызовом save_progress.
+    :return: токен владельца блокировки или None, если шард уже завершен.
+    :raises ShardLocked: шард заблокирован; задачу нужно повторить, когда блокировка истечет.
+    """
+    if await redis.sismember(_done_key(broadcast_id), shard):
+        return None
+    token = uuid.uuid4().hex
+    if await redis.set(_lock_key(broadcast_id, shard), token, nx=True, ex=ttl):
+        return token
+    # Блокировка могла истечь между SET и TTL (-2) - тогда повторяем почти сразу
+    raise ShardLocked(broadcast_id, shard, max(await redis.ttl(_lock_key(broadcast_id, shard)), 1))
+
+
+async def release_shard(redis: Redis, broadcast_id: int, shard: int, token: str):
+    await redis.eval(_RELEASE_LOCK_SCRIPT, 1, _lock_key(broadcast_id, shard), token)
+
+
+async def get_checkpoint(redis: Redis, broadcast_id: int, shard: int) -> int | None:
+    """Возвращает последний обработанный user_tg_id шарда или None, если шард еще не начинался."""
+    checkpoint = await redis.hget(_checkpoints_key(broadcast_id), shard)
+    return int(checkpoint) if checkpoint is not None else None
+
+
+async def save_progress(redis: Redis, broadcast_id: int, shard: int, token: str, last_user_id: int,
+                        sent: int, failed: int, lock_ttl: int = 900) -> bool:
+    """
+    Атомарно увеличивает счетчики рассылки, сохраняет контрольную точку шарда и продлевает его блокировку.
+    :return: False - блокировка уже не наша (шард перехватила другая задача), шард нужно остановить.
+    """
+    keys = [_lock_key(broadcast_id, shard), _checkpoints_key(broadcast_id), _meta_key(broadcast_id)]
+    args = [token, shard, last_user_id, sent, failed, lock_ttl, BROADCAST_TTL]
+    return bool(await redis.eval(_SAVE_PROGRESS_SCRIPT, len(keys), *keys, *args))
+
+
+async def finish_shard(redis: Redis, broadcast_id: int, shard: int, token: str) -> bool:
+    """
+    Отмечает шард завершенным; когда завершены все шарды, рассылка получает статус done.
+    :return: False - блокировка уже не наша, шард не отмечен (его завершит задача-владелец).
+    """
+    keys = [_lock_key(broadcast_id, shard), _done_key(broadcast_id)]
+    done = await redis.eval(_FINISH_SHARD_SCRIPT, len(keys), *keys, token, shard, BROADCAST_TTL)
+    if done < 0:
+        return False
+    shards = await redis.hget(_meta_key(broadcast_id), "shards")
+    if shards is not None and done >= int(shards):
+        await redis.hset(_meta_key(broadcast_id), mapping={"status": "done", "finished_at": time.time()})
+    return True
+
+
+async def get_progress(redis: Redis, broadcast_id: int) -> dict | None:
+    """Возвращает текущий прогресс рассылки для отображения администратору."""
+    meta = await get_broadcast(redis, broadcast_id)
+    if not meta:
+        return None
+    sent, failed = int(meta["sent"]), int(meta["failed"])
+    total_users = int(meta["total_users"])
+    created_at = float(meta["created_at"])
+    finished_at = float(meta["finished_at"]) if "finished_at" in meta else time.time()
+    elapsed = max(finished_at - created_at, 0.001)
+    return {
+        "id": broadcast_id,
+        "kind": meta["kind"],
+        "audience": meta["audience"],
+        "status": meta["status"],
+        "shards": int(meta["shards"]),
+        "shards_done": await redis.scard(_done_key(broadcast_id)),
+        "total_users": total_users,
+        "sent": sent,
+        "failed": failed,
+        "percent": (sent + failed) / total_users * 100 if total_users else 100.0,
+        "elapsed": elapsed,
+        "rate": sent / elapsed,
+    }
@@ -0,0 +1,327 @@
+# KorpBot/broadcaster.py
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable, Iterable, NamedTuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+# Лимиты рассылки. Telegram допускает ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", 1.0))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+
+SendFunc = Callable[[int], Awaitable]
+
+# Ответы 403, после которых писать пользователю бессмысленно, пока он сам не вернется в бота
+_UNREACHABLE_MARKERS = {
+    "bot was blocked by the user": "blocked",
+    "user is deactivated": "deactivated",
+}
+
+
+def unreachable_reason(error: Exception) -> str | None:
+    """Причина, по которой пользователь недоступен для рассылок ("blocked", "deactivated"), или None."""
+    if isinstance(error, TelegramForbiddenError):
+        message = error.message.lower()
+        for marker, reason in _UNREACHABLE_MARKERS.items():
+            if marker in message:
+                return reason
+    return None
+
+
+class Delivery(NamedTuple):
+    """Результат отправки одному получателю (для журнала доставки)."""
+    chat_id: int
+    status: str  # sent, failed или unreachable
+    error: str | None = None
+    reason: str | None = None
+
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости: в среднем не более rate операций в секунду,
+    с небольшим запасом (burst) на случай простоя.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate / 5)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def pause(self, seconds: float):
+        """
+        Приостанавливает выдачу на seconds секунд и обнуляет накопленный запас (используется после
+        TelegramRetryAfter): после паузы отправка возобновляется с номинальной скоростью, без всплеска.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + max(seconds, 0))
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# GCRA: KEYS[1] - теоретическое время следующей отправки, KEYS[2] - пауза до (мс), ARGV[1] - интервал, ARGV[2] - burst.
+# Возвращает 0, если отправлять можно, иначе - сколько миллисекунд подождать.
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local paused_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if paused_until > now then
+    return paused_until - now
+end
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then
+    tat = now
+end
+if tat - now > burst then
+    return tat - now - burst
+end
+redis.call('SET', KEYS[1], tat + interval, 'PX', 60000)
+return 0
+"""
+
+# KEYS[1] - пауза до (мс), ARGV[1] - длительность паузы (мс). retry_after=0 дает 0 мс, а SET ... PX 0
+# Redis отвергает, поэтому срок ключа не меньше 1 мс.
+_PAUSE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local ttl = math.max(1, tonumber(ARGV[1]))
+local until_ms = now + ttl
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if until_ms > current then
+    redis.call('SET', KEYS[1], until_ms, 'PX', ttl)
+end
+return 0
+"""
+
+
+class RedisRateLimiter:
+    """
+    Общий для всех воркеров ограничитель скорости (GCRA в Redis).
+    Нужен, когда рассылка разбита на шарды, выполняемые в разных процессах:
+    лимит Telegram действует на бота целиком, а не на отдельный процесс.
+    """
+
+    def __init__(self, redis: Redis, rate: float = BROADCAST_RATE, key: str = "broadcast:rate"):
+        self.redis = redis
+        self.interval_ms = max(1, int(1000 / rate))
+        self.burst_ms = self.interval_ms * max(1, int(rate / 5))
+        self.key = key
+        self.pause_key = f"{key}:paused_until"
+        self._acquire_script = redis.register_script(_ACQUIRE_SCRIPT)
+        self._pause_script = redis.register_script(_PAUSE_SCRIPT)
+
+    async def pause(self, seconds: float):
+        await self._pause_script(keys=[self.pause_key], args=[int(seconds * 1000)])
+
+    async def acquire(self):
+        while True:
+            wait_ms = int(await self._acquire_script(keys=[self.key, self.pause_key], args=[self.interval_ms, self.burst_ms]))
+            if wait_ms <= 0:
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+
+@dataclass
+class BroadcastStats:
+    """Итоги одного прогона рассылки."""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retry_after_pauses: int = 0
+    unreachable: int = 0
+    errors: dict[str, int] = field(default_factory=dict)
+    # Результат по каждому получателю; заполняется, только если движок создан с record_deliveries=True
+    deliveries: list[Delivery] = field(default_factory=list)
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def merge(self, other: "BroadcastStats"):
+        """Добавляет счетчики другого прогона (например, очередной пачки шарда). deliveries не переносятся."""
+        self.total += other.total
+        self.sent += other.sent
+        self.failed += other.failed
+        self.retry_after_pauses += other.retry_after_pauses
+        self.unreachable += other.unreachable
+        for error_name, count in other.errors.items():
+            self.errors[error_name] = self.errors.get(error_name, 0) + count
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after_pauses": self.retry_after_pauses,
+            "unreachable": self.unreachable,
+            "errors": dict(self.errors),
+            "elapsed": round(self.elapsed, 2),
+            "rate": round(self.rate, 2),
+        }
+
+    def summary(self) -> str:
+        return (f"Всего: {self.total}, Успешно: {self.sent}, Ошибок: {self.failed} "
+                f"(из них недоступны: {self.unreachable}), "
+                f"Пауз из-за лимитов: {self.retry_after_pauses}, "
+                f"Время: {self.elapsed:.1f} c, Скорость: {self.rate:.1f} сообщ./с")
+
+
+class BroadcastEngine:
+    """
+    Движок доставки сообщений с учетом ограничений Telegram:
+    - общий token bucket на скорость отправки;
+    - ограниченное число одновременных запросов;
+    - минимальный интервал между сообщениями в один чат;
+    - TelegramRetryAfter приостанавливает весь движок, а не считается ошибкой пользователя.
+
+    Один экземпляр можно переиспользовать для нескольких прогонов: лимиты общие.
+    Вместо локального TokenBucket можно передать RedisRateLimiter, чтобы лимит был общим для всех процессов.
+    С record_deliveries=True результат по каждому получателю попадает в stats.deliveries (журнал доставки).
+    """
+
+    def __init__(self,
+                 rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY,
+                 per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL,
+                 max_retries: int = BROADCAST_MAX_RETRIES,
+                 bucket: TokenBucket | RedisRateLimiter | None = None,
+                 record_deliveries: bool = False):
+        self.bucket = bucket or TokenBucket(rate)
+        self.record_deliveries = record_deliveries
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._paused_until = 0.0
+        self._chat_next_send: dict[int, float] = {}
+
+    async def _wait_global_pause(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _wait_chat_slot(self, chat_id: int):
+        now = time.monotonic()
+        next_send = self._chat_next_send.get(chat_id, 0.0)
+        self._chat_next_send[chat_id] = max(now, next_send) + self.per_chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        if len(self._chat_next_send) > 10000:
+            # Чистим устаревшие записи, чтобы словарь не рос бесконечно
+            self._chat_next_send = {cid: t for cid, t in self._chat_next_send.items() if t > now}
+
+    async def _pause(self, retry_after: float, stats: BroadcastStats):
+        resume_at = time.monotonic() + retry_after
+        if resume_at > self._paused_until:
+            self._paused_until = resume_at
+            stats.retry_after_pauses += 1
+            logger.warning(f"Telegram ограничил скорость отправки. Пауза всей рассылки на {retry_after} c.")
+        await self.bucket.pause(retry_after)
+
+    async def deliver(self, chat_id: int, send: SendFunc, stats: BroadcastStats) -> bool:
+        """
+        Отправляет одно сообщение с соблюдением всех лимитов.
+        :return: True, если сообщение доставлено.
+        """
+        await self._wait_chat_slot(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await self._wait_global_pause()
+            await self.bucket.acquire()
+            await self._wait_global_pause()
+            try:
+                await send(chat_id)
+                stats.sent += 1
+                if self.record_deliveries:
+                    stats.deliveries.append(Delivery(chat_id, "sent"))
+                return True
+            except TelegramRetryAfter as e:
+                await self._pause(e.retry_after, stats)
+                error = e
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                logger.warning(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                error = e
+                break
+            except Exception as e:
+                logger.error(f"Непредвиденная ошибка при отправке пользователю {chat_id}: {e}")
+                error = e
+                break
+
+        stats.failed += 1
+        error_name = type(error).__name__
+        stats.errors[error_name] = stats.errors.get(error_name, 0) + 1
+        reason = unreachable_reason(error)
+        if reason:
+            stats.unreachable += 1
+        if self.record_deliveries:
+            stats.deliveries.append(Delivery(chat_id, "unreachable" if reason else "failed", error_name, reason))
+        return False
+
+    async def run(self, chat_ids: Iterable[int] | AsyncIterable[int], send: SendFunc) -> BroadcastStats:
+        """
+        Рассылает сообщение по всем chat_ids. send(chat_id) выполняет сам запрос к Telegram.
+        chat_ids может быть как обычным, так и асинхронным итератором.
+        """
+        stats = BroadcastStats()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    if chat_id is None:
+                        return
+                    await self.deliver(chat_id, send, stats)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if isinstance(chat_ids, AsyncIterable):
+                async for chat_id in chat_ids:
+                    stats.total += 1
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    stats.total += 1
+                    await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            stats.finished_at = time.monotonic()
+        return stats
@@ -1,14 +1,25 @@
 import logging
+import time
+from datetime import datetime
 from aiogram import types, Router, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from sqlalchemy import event as sa_event
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
-
+from sqlalchemy.orm import joinedload, selectinload
+from redis.asyncio import Redis
+
+import broadcast_state
+from database.main import get_pool_stats
+import live_results
+import poll_cache
+import poll_scheduler
+import vote_buffer
 from database import crud
-from database.models import Poll, PollOption, Vote
+from database.audience import Audience
+from database.models import Poll, PollOption
 from poll_state import start_new_poll, record_vote
 from keyboards import (
     get_main_menu,
@@ -20,10 +31,56 @@ from keyboards import (
 )
 from config import is_admin
 # ИМПОРТИРУЕМ ОБЕ НАШИ ЗАДАЧИ
-from tasks import notify_users_about_new_poll, broadcast_message_task
+from tasks import notify_users_about_new_poll, broadcast_message_task, remind_non_voters_task
 
 logger = logging.getLogger(__name__)
-router = Router()
+router = Router(name="commands")
+
+
+# Счетчики по всем апдейтам: сколько из них реально обращались к БД и сколько держали соединение
+session_stats = {"updates": 0, "sessions_used": 0, "connection_held_total": 0.0, "connection_held_max": 0.0}
+
+
+class LazySession:
+    """
+    Ленивая замена AsyncSession для хэндлеров: сама сессия создается при первом обращении к ней,
+    поэтому апдейты, которым БД не нужна, не создают сессию и не занимают соединение из пула.
+    Заодно замеряет, сколько времени соединение было взято из пула.
+    """
+
+    def __init__(self, session_pool):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+        self._begun_at: float | None = None
+        self.connection_held = 0.0
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+            sa_event.listen(self._session.sync_session, "after_begin", self._on_begin)
+            sa_event.listen(self._session.sync_session, "after_transaction_end", self._on_transaction_end)
+        return self._session
+
+    def _on_begin(self, session, transaction, connection):
+        if self._begun_at is None:
+            self._begun_at = time.monotonic()
+
+    def _on_transaction_end(self, session, transaction):
+        # Соединение возвращается в пул по завершении корневой транзакции (commit/rollback/close)
+        if transaction.parent is None and self._begun_at is not None:
+            self.connection_held += time.monotonic() - self._begun_at
+            self._begun_at = None
+
+    @property
+    def used(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name):
+        return getattr(self._get_session(), name)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
 
 
 class DbSessionMiddleware:
@@ -31,21 +88,62 @@ class DbSessionMiddleware:
         self.session_pool = session_pool
 
     async def __call__(self, handler, event, data):
-        async with self.session_pool() as session:
-            data["session"] = session
+        session = LazySession(self.session_pool)
+        data["session"] = session
+        try:
             return await handler(event, data)
-
-
-async def get_poll_text_and_options(poll_id: int, session: AsyncSession) -> tuple[str, list[PollOption] | None]:
-    query = select(Poll).options(selectinload(Poll.options)).filter(Poll.id == poll_id)
+        finally:
+            await session.close()
+            session_stats["updates"] += 1
+            if session.used:
+                session_stats["sessions_used"] += 1
+                session_stats["connection_held_total"] += session.connection_held
+                session_stats["connection_held_max"] = max(session_stats["connection_held_max"],
+                                                           session.connection_held)
+            handler_name = getattr(data.get("handler"), "callback", None)
+            logger.debug(f"Апдейт {getattr(handler_name, '__name__', '?')}: сессия БД "
+                         f"{'использована' if session.used else 'не понадобилась'}, "
+                         f"соединение удерживалось {session.connection_held * 1000:.1f} мс")
+
+
+async def get_poll_text_and_options(poll_id: int, session: AsyncSession,
+                                    redis: Redis | None = None) -> tuple[str, list[PollOption] | None]:
+    """
+    Возвращает текст результатов и варианты опроса. При наличии redis результат берется из кэша
+    по (poll_id, версия опроса), и повторные запросы не обращаются к БД.
+    """
+    if redis is None:
+        return await _render_poll_text(poll_id, session, redis)
+
+    version, cached = await poll_cache.lookup(redis, poll_id)
+    if cached is not None:
+        return cached
+    poll_text, options = await _render_poll_text(poll_id, session, redis)
+    if options:
+        await poll_cache.store(redis, poll_id, version, poll_text, options)
+    return poll_text, options
+
+
+async def _render_poll_text(poll_id: int, session: AsyncSession,
+                            redis: Redis | None = None) -> tuple[str, list[PollOption] | None]:
+    query = select(Poll).options(selectinload(Poll.options), joinedload(Poll.stats)).filter(Poll.id == poll_id)
     poll = (await session.execute(query)).scalar_one_or_none()
     if not poll: return "Опрос не найден.", None
-    total_votes = sum(opt.votes_count for opt in poll.options)
+    counts = {opt.id: opt.votes_count for opt in poll.options}
+    # Итог берется из агрегата poll_stats, а не суммируется по вариантам
+    total_votes = poll.stats.total_votes if poll.stats else sum(counts.values())
+    if redis is not None and vote_buffer.WRITE_BEHIND:
+        # В режиме write-behind актуальные счетчики живут в Redis, а БД догоняет их с задержкой
+        tally = await vote_buffer.get_tally(redis, poll_id)
+        if tally is not None:
+            counts = {option_id: tally.get(option_id, 0) for option_id in counts}
+            total_votes = sum(counts.values())
     text_lines = [f"<b>{poll.title}</b>\n", f"👥 Всего проголосовало: {total_votes}\n"]
     sorted_options = sorted(poll.options, key=lambda o: o.id)
     for option in sorted_options:
-        percentage = (option.votes_count / total_votes * 100) if total_votes > 0 else 0
-        text_lines.append(f"▫️ {option.option_text}: {option.votes_count} ({percentage:.1f}%)")
+        votes_count = counts[option.id]
+        percentage = (votes_count / total_votes * 100) if total_votes > 0 else 0
+        text_lines.append(f"▫️ {option.option_text}: {votes_count} ({percentage:.1f}%)")
     return "\n".join(text_lines), sorted_options
 
 
@@ -60,8 +158,9 @@ class Broadcast(StatesGroup):
 
 
 @router.message(Command("start"))
-async def start(message: types.Message, session: AsyncSession):
-    await crud.get_or_create_user(session, message.from_user)
+async def start(message: types.Message, session: AsyncSession, redis: Redis):
+    # Если пользователь блокировал бота, upsert в ensure_user вернет его в рассылки
+    await crud.ensure_user(session, message.from_user, redis)
     await message.answer(
         f"Здравствуйте, {message.from_user.first_name}! 👋\n\n"
         "Я корпоративный бот для проведения голосований.",
@@ -70,8 +169,8 @@ async def start(message: types.Message, session: AsyncSession):
 
 
 @router.message(Command("profile"))
-async def show_profile(message: types.Message, session: AsyncSession):
-    user = await crud.get_or_create_user(session, message.from_user)
+async def show_profile(message: types.Message, session: AsyncSession, redis: Redis):
+    user = await crud.get_or_create_user(session, message.from_user, redis)
     completed_polls = await crud.get_user_completed_polls(session, user.user_tg_id)
 
     profile_text = (
@@ -110,6 +209,12 @@ async def help_command(message: types.Message):
         "/webreports - Открыть все опросы.\n"
         "/newpoll - Создать новый опрос.\n"
         "/broadcast - Сделать рассылку всем пользователям.\n"  # <-- НОВЫЙ ПУНКТ
+        "/broadcast not_voted:ID voted:ID after:ДД.ММ.ГГГГ - Рассылка части пользователей.\n"
+        "/remind ID - Напомнить об опросе тем, кто не голосовал.\n"
+        "/schedule ID open|close ДД.ММ.ГГГГ ЧЧ:ММ - Открыть или закрыть опрос по расписанию.\n"
+        "/broadcast_status - Прогресс рассылки.\n"
+        "/cache_stats - Статистика кэша результатов.\n"
+        "/db_stats - Состояние пула соединений с БД.\n"
         "/list_polls - Управление опросами.",
         parse_mode="HTML"
     )
@@ -146,7 +251,7 @@ async def newpoll_get_question(message: types.Message, state: FSMContext):
 
 
 @router.message(StateFilter(PollCreation.waiting_for_options))
-async def newpoll_get_options(message: types.Message, state: FSMContext, session: AsyncSession):
+async def newpoll_get_options(message: types.Message, state: FSMContext, session: AsyncSession, redis: Redis):
     options = [opt.strip() for opt in message.text.split(",") if opt.strip()]
     if len(options) < 2:
         await message.answer("Нужно как минимум 2 варианта. Попробуйте еще раз.")
@@ -154,12 +259,13 @@ async def newpoll_get_options(message: types.Message, state: FSMContext, session
     data = await state.get_data()
     question = data.get("question")
     poll_id = await start_new_poll(session, question, options)
+    await poll_cache.bump_version(redis)
 
     await message.answer(f"✅ Опрос \"{question}\" успешно создан с ID {poll_id}.")
     await state.clear()
 
     notify_users_about_new_poll.delay(poll_id)
-    await message.answer("Запущена рассылка уведомлений о новом опросе...")
+    await message.answer("Запущена рассылка уведомлений о новом опросе... Прогресс: /broadcast_status")
 
 
 # НОВЫЕ ОБРАБОТЧИКИ ДЛЯ РАССЫЛКИ
@@ -167,42 +273,116 @@ async def newpoll_get_options(message: types.Message, state: FSMContext, session
 async def broadcast_start(message: types.Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         return await message.answer("⛔️ Эта команда доступна только администратору.")
-    await message.answer("Введите текст сообщения, которое вы хотите отправить всем пользователям:")
+
+    # /broadcast [not_voted:ID] [voted_in:ID] [voted:ID] [after:ДД.ММ.ГГГГ] - без условий рассылка всем
+    try:
+        audience = Audience.parse(message.text.split()[1:])
+    except ValueError as e:
+        return await message.answer(f"{e}\nУсловия: not_voted:ID опроса, voted_in:ID опроса, voted:ID варианта, "
+                                    f"after:ДД.ММ.ГГГГ")
+    await state.update_data(audience=audience.to_dict())
+    await message.answer(f"Получатели: {audience.describe()}.\n"
+                         "Введите текст сообщения, которое вы хотите отправить:")
     await state.set_state(Broadcast.waiting_for_message)
 
 
 @router.message(StateFilter(Broadcast.waiting_for_message))
 async def broadcast_get_message(message: types.Message, state: FSMContext):
     # Запускаем фоновую задачу для рассылки сообщения
-    # Передаем текст сообщения как аргумент
-    broadcast_message_task.delay(message.text)
-    await message.answer("✅ Рассылка запущена! Пользователи получат ваше сообщение в фоновом режиме.")
+    # Передаем текст сообщения и аудиторию как аргументы
+    data = await state.get_data()
+    broadcast_message_task.delay(message.text, data.get("audience"))
+    await message.answer("✅ Рассылка запущена! Пользователи получат ваше сообщение в фоновом режиме.\n"
+                         "Прогресс: /broadcast_status")
     await state.clear()
 
 
+@router.message(Command("remind"))
+async def remind_non_voters(message: types.Message, session: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔️ Эта команда доступна только администратору.")
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return await message.answer("Укажите ID опроса: /remind ID (список опросов: /list_polls)")
+    poll_id = int(parts[1])
+    poll = await session.get(Poll, poll_id)
+    if not poll or not poll.status:
+        return await message.answer("Опрос не найден или уже завершен.")
+
+    # Точное число получателей посчитает задача; здесь - чтобы не запускать пустую рассылку
+    audience = Audience(not_voted_poll_id=poll_id)
+    recipients = await crud.count_users(session, reachable_only=True, audience=audience)
+    if not recipients:
+        return await message.answer("Все пользователи уже проголосовали в этом опросе. 🎉")
+
+    remind_non_voters_task.delay(poll_id)
+    await message.answer(f"⏰ Напоминание об опросе \"{poll.title}\" отправится {recipients} пользователям, "
+                         f"которые еще не голосовали.\nПрогресс: /broadcast_status")
+
+
+@router.message(Command("broadcast_status"))
+async def broadcast_status(message: types.Message, redis: Redis):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔️ Эта команда доступна только администратору.")
+
+    # /broadcast_status [ID] - без ID показываем последнюю рассылку
+    parts = message.text.split()
+    broadcast_id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() \
+        else await broadcast_state.get_latest_broadcast_id(redis)
+    progress = await broadcast_state.get_progress(redis, broadcast_id) if broadcast_id else None
+    if not progress:
+        return await message.answer("Рассылка не найдена.")
+
+    status_text = "✅ Завершена" if progress["status"] == "done" else "⏳ Выполняется"
+    await message.answer(
+        f"📬 <b>Рассылка ID {progress['id']}</b> ({progress['kind']})\n"
+        f"Получатели: {Audience.from_dict(progress['audience']).describe()}\n"
+        f"<i>Статус: {status_text}</i>\n\n"
+        f"Обработано: {progress['sent'] + progress['failed']} из {progress['total_users']} ({progress['percent']:.1f}%)\n"
+        f"Успешно: {progress['sent']}, Ошибок: {progress['failed']}\n"
+        f"Шардов завершено: {progress['shards_done']} из {progress['shards']}\n"
+        f"Скорость: {progress['rate']:.1f} сообщ./с",
+        parse_mode="HTML"
+    )
+
+
 @router.callback_query(F.data.startswith("poll_"))
-async def send_custom_poll(callback: types.CallbackQuery, session: AsyncSession):
+async def send_custom_poll(callback: types.CallbackQuery, session: AsyncSession, redis: Redis):
     poll_id = int(callback.data.split("_")[1])
-    poll_text, options = await get_poll_text_and_options(poll_id, session)
+    poll_text, options = await get_poll_text_and_options(poll_id, session, redis)
     if not options:
         await callback.answer(poll_text, show_alert=True)
         return
-    await callback.message.answer(text=poll_text, reply_markup=create_voting_keyboard(options), parse_mode="HTML")
+    sent = await callback.message.answer(text=poll_text, reply_markup=create_voting_keyboard(options),
+                                         parse_mode="HTML")
+    if live_results.LIVE_RESULTS_ENABLED:
+        await live_results.track_message(redis, poll_id, sent.chat.id, sent.message_id, "vote", poll_text)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("vote_"))
-async def handle_vote(callback: types.CallbackQuery, session: AsyncSession):
+async def handle_vote(callback: types.CallbackQuery, session: AsyncSession, redis: Redis):
     option_id = int(callback.data.split("_")[1])
     option = await session.get(PollOption, option_id)
     if not option:
         await callback.answer("Этот вариант ответа больше не существует.", show_alert=True)
         return
 
-    await crud.get_or_create_user(session, callback.from_user)
-    await record_vote(session, option.poll_id, option_id, callback.from_user)
-
-    new_text, _ = await get_poll_text_and_options(option.poll_id, session)
+    await crud.ensure_user(session, callback.from_user, redis)
+    if vote_buffer.WRITE_BEHIND:
+        changed = await vote_buffer.record_vote(redis, session, option.poll_id, option_id, callback.from_user.id)
+    else:
+        changed = (await record_vote(session, option.poll_id, option_id, callback.from_user)).changed
+    if changed:
+        await poll_cache.bump_version(redis, option.poll_id)
+        if live_results.LIVE_RESULTS_ENABLED:
+            await live_results.mark_dirty(redis, option.poll_id)
+
+    new_text, _ = await get_poll_text_and_options(option.poll_id, session, redis)
+    if live_results.LIVE_RESULTS_ENABLED:
+        await live_results.track_message(redis, option.poll_id, callback.message.chat.id,
+                                         callback.message.message_id, "results", new_text)
     try:
         await callback.message.edit_text(text=new_text, reply_markup=create_results_keyboard(option.poll_id),
                                          parse_mode="HTML")
@@ -213,19 +393,28 @@ async def handle_vote(callback: types.CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("results_"))
-async def refresh_results(callback: types.CallbackQuery, session: AsyncSession):
+async def refresh_results(callback: types.CallbackQuery, session: AsyncSession, redis: Redis):
     poll_id = int(callback.data.split("_")[1])
-    new_text, options = await get_poll_text_and_options(poll_id, session)
+    new_text, options = await get_poll_text_and_options(poll_id, session, redis)
     if not options:
         await callback.answer("Опрос не найден.", show_alert=True)
         return
 
     try:
-        user_vote_check = await session.execute(
-            select(Vote).filter_by(poll_id=poll_id, user_tg_id=callback.from_user.id))
-        voted = user_vote_check.scalar_one_or_none() is not None
+        user_vote = await vote_buffer.get_user_vote(redis, poll_id, callback.from_user.id) \
+            if vote_buffer.WRITE_BEHIND else False
+        if user_vote is False:
+            # Не обращаемся к БД: если в сообщении уже нет кнопок голосования, пользователь проголосовал
+            markup = callback.message.reply_markup
+            voted = not (markup and any(button.callback_data and button.callback_data.startswith("vote_")
+                                        for row in markup.inline_keyboard for button in row))
+        else:
+            voted = user_vote is not None
 
         keyboard = create_results_keyboard(poll_id) if voted else create_voting_keyboard(options)
+        if live_results.LIVE_RESULTS_ENABLED:
+            await live_results.track_message(redis, poll_id, callback.message.chat.id, callback.message.message_id,
+                                             "results" if voted else "vote", new_text)
         await callback.message.edit_text(text=new_text, reply_markup=keyboard, parse_mode="HTML")
         await callback.answer("Результаты обновлены.")
     except Exception as e:
@@ -233,6 +422,104 @@ async def refresh_results(callback: types.CallbackQuery, session: AsyncSession):
         await callback.answer("Результаты уже актуальны.")
 
 
+@router.message(Command("cache_stats"))
+async def cache_stats(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔️ Эта команда доступна только администратору.")
+
+    cache = poll_cache.get_stats()
+    await message.answer(
+        f"🗂 <b>Кэш результатов опросов</b>\n\n"
+        f"Попаданий в памяти: {cache['local_hits']}\n"
+        f"Попаданий в Redis: {cache['redis_hits']}\n"
+        f"Промахов: {cache['misses']}\n"
+        f"Hit rate: {cache['hit_rate'] * 100:.1f}%\n"
+        f"Записей в памяти: {cache['local_size']}",
+        parse_mode="HTML"
+    )
+
+
+@router.message(Command("db_stats"))
+async def db_stats(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔️ Эта команда доступна только администратору.")
+
+    pool = get_pool_stats()
+    updates = session_stats["updates"]
+    used = session_stats["sessions_used"]
+    avg_held = session_stats["connection_held_total"] / used * 1000 if used else 0.0
+    await message.answer(
+        f"🗄 <b>Соединения с БД</b> (профиль {pool['profile']})\n\n"
+        f"Пул: {pool['pool_size']} + overflow {pool['max_overflow']}\n"
+        f"Занято: {pool.get('checked_out', 0)}, свободно: {pool.get('checked_in', 0)}, "
+        f"overflow сейчас: {pool.get('overflow', 0)}\n"
+        f"Выдач: {pool.get('checkouts', 0)}, таймаутов: {pool.get('timeouts', 0)}\n"
+        f"Ожидание выдачи: среднее {pool.get('wait_avg_ms', 0)} мс, макс. {pool.get('wait_max_ms', 0)} мс\n\n"
+        f"Апдейтов: {updates}, из них с обращением к БД: {used}\n"
+        f"Соединение удерживалось: среднее {avg_held:.1f} мс, "
+        f"макс. {session_stats['connection_held_max'] * 1000:.1f} мс",
+        parse_mode="HTML"
+    )
+
+
+SCHEDULE_FORMAT = "%d.%m.%Y %H:%M"
+
+
+def _schedule_text(poll: Poll) -> str:
+    lines = []
+    if poll.opens_at:
+        lines.append(f"⏰ Откроется: {poll.opens_at:{SCHEDULE_FORMAT}}")
+    if poll.closes_at:
+        lines.append(f"⏰ Закроется: {poll.closes_at:{SCHEDULE_FORMAT}}")
+    return "\n".join(lines)
+
+
+def _admin_poll_text(poll: Poll) -> str:
+    status_emoji = "🟢 Активен" if poll.status else "🔴 Завершен"
+    poll_text = f"<b>ID: {poll.id}</b> - {poll.title}\n<i>Статус: {status_emoji}</i>"
+    schedule = _schedule_text(poll)
+    return f"{poll_text}\n{schedule}" if schedule else poll_text
+
+
+@router.message(Command("schedule"))
+async def schedule_poll(message: types.Message, session: AsyncSession, redis: Redis):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔️ Эта команда доступна только администратору.")
+
+    usage = ("Использование:\n"
+             "/schedule ID open ДД.ММ.ГГГГ ЧЧ:ММ - открыть опрос в заданное время\n"
+             "/schedule ID close ДД.ММ.ГГГГ ЧЧ:ММ - закрыть опрос в заданное время\n"
+             "/schedule ID off - отменить расписание")
+    parts = message.text.split()
+    if len(parts) < 3 or not parts[1].isdigit() or parts[2] not in ("open", "close", "off"):
+        return await message.answer(usage)
+    poll = await session.get(Poll, int(parts[1]))
+    if not poll:
+        return await message.answer("Опрос не найден.")
+
+    opens_at, closes_at = poll.opens_at, poll.closes_at
+    if parts[2] == "off":
+        opens_at = closes_at = None
+    else:
+        try:
+            moment = datetime.strptime(" ".join(parts[3:5]), SCHEDULE_FORMAT)
+        except ValueError:
+            return await message.answer(usage)
+        if parts[2] == "open":
+            opens_at = moment
+        else:
+            closes_at = moment
+
+    try:
+        poll = await poll_scheduler.set_schedule(session, redis, poll.id, opens_at, closes_at)
+    except ValueError as e:
+        return await message.answer(str(e))
+    poll_text = _admin_poll_text(poll)
+    if not poll.opens_at and not poll.closes_at:
+        poll_text += "\nРасписание не задано."
+    await message.answer(poll_text, parse_mode="HTML")
+
+
 @router.message(Command("list_polls"))
 async def list_all_polls_admin(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id):
@@ -247,13 +534,11 @@ async def list_all_polls_admin(message: types.Message, session: AsyncSession):
 
     await message.answer("<b>Список всех опросов для управления:</b>", parse_mode="HTML")
     for poll in all_polls:
-        status_emoji = "🟢 Активен" if poll.status else "🔴 Завершен"
-        poll_text = f"<b>ID: {poll.id}</b> - {poll.title}\n<i>Статус: {status_emoji}</i>"
-        await message.answer(poll_text, reply_markup=create_admin_poll_keyboard(poll), parse_mode="HTML")
+        await message.answer(_admin_poll_text(poll), reply_markup=create_admin_poll_keyboard(poll), parse_mode="HTML")
 
 
 @router.callback_query(F.data.startswith("admin_poll_"))
-async def manage_poll_status(callback: types.CallbackQuery, session: AsyncSession):
+async def manage_poll_status(callback: types.CallbackQuery, session: AsyncSession, redis: Redis):
     if not is_admin(callback.from_user.id):
         return await callback.answer("Доступ запрещен.", show_alert=True)
 
@@ -267,11 +552,10 @@ async def manage_poll_status(callback: types.CallbackQuery, session: AsyncSessio
 
     poll_to_update.status = (action == "activate")
     await session.commit()
+    await poll_cache.bump_version(redis, poll_id)
     await callback.answer(f"Опрос {'активирован' if poll_to_update.status else 'завершен'}.")
 
-    status_emoji = "🟢 Активен" if poll_to_update.status else "🔴 Завершен"
-    poll_text = f"<b>ID: {poll_to_update.id}</b> - {poll_to_update.title}\n<i>Статус: {status_emoji}</i>"
-    await callback.message.edit_text(poll_text, reply_markup=create_admin_poll_keyboard(poll_to_update),
+    await callback.message.edit_text(_admin_poll_text(poll_to_update), reply_markup=create_admin_poll_keyboard(poll_to_update),
                                      parse_mode="HTML")
 
 
@@ -302,7 +586,7 @@ async def ask_delete_poll(callback: types.CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("admin_delete_confirm_"))
-async def confirm_delete_poll(callback: types.CallbackQuery, session: AsyncSession):
+async def confirm_delete_poll(callback: types.CallbackQuery, session: AsyncSession, redis: Redis):
     if not is_admin(callback.from_user.id):
         return await callback.answer("Доступ запрещен.", show_alert=True)
 
@@ -311,6 +595,9 @@ async def confirm_delete_poll(callback: types.CallbackQuery, session: AsyncSessi
     if poll_to_delete:
         await session.delete(poll_to_delete)
         await session.commit()
+        await poll_cache.bump_version(redis, poll_id)
+        if vote_buffer.WRITE_BEHIND:
+            await vote_buffer.forget_poll(redis, poll_id)
         await callback.message.edit_text(f"✅ Опрос ID {poll_id} был успешно удален.")
     else:
         await callback.message.edit_text(f"⚠️ Опрос ID {poll_id} уже был удален ранее.")
@@ -329,8 +616,6 @@ async def cancel_delete_poll(callback: types.CallbackQuery, session: AsyncSessio
         await callback.message.edit_text("Опрос был удален.")
         return
 
-    status_emoji = "🟢 Активен" if poll.status else "🔴 Завершен"
-    poll_text = f"<b>ID: {poll.id}</b> - {poll.title}\n<i>Статус: {status_emoji}</i>"
-    await callback.message.edit_text(poll_text, reply_markup=create_admin_poll_keyboard(poll),
+    await callback.message.edit_text(_admin_poll_text(poll), reply_markup=create_admin_poll_keyboard(poll),
                                      parse_mode="HTML")
     await callback.answer("Удаление отменено.")
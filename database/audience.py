@@ -0,0 +1,100 @@
+# KorpBot/database/audience.py
+#
+# Аудитории рассылок: кому из пользователей отправлять сообщение.
+# Аудитория - набор условий на bot_user, которые добавляются в те же запросы keyset-пагинации,
+# что и у обычной рассылки (crud.iter_user_id_batches). Условия по голосам - это полусоединение
+# и антисоединение с vote (EXISTS / NOT EXISTS), поэтому каждая пачка получателей по-прежнему
+# читается одним запросом, без выгрузки списков ID в приложение.
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+from sqlalchemy import exists
+
+from .models import BotUser, Vote
+
+
+@dataclass(frozen=True)
+class Audience:
+    """
+    Условия выборки получателей; заданные условия объединяются через И, без условий - все пользователи.
+    Хранится в описании рассылки в Redis (to_dict / from_dict), поэтому шарды читают ее оттуда.
+    """
+    # Не голосовали в опросе (напоминание)
+    not_voted_poll_id: int | None = None
+    # Голосовали в опросе (итоги завершенного опроса)
+    voted_poll_id: int | None = None
+    # Голосовали за вариант
+    voted_option_id: int | None = None
+    # Зарегистрировались в боте позже этой даты
+    registered_after: datetime | None = None
+
+    @property
+    def is_everyone(self) -> bool:
+        return all(value is None for value in asdict(self).values())
+
+    def conditions(self) -> list:
+        """Условия WHERE для запроса к bot_user."""
+        conditions = []
+        if self.not_voted_poll_id is not None:
+            # NOT EXISTS - антисоединение, ищется по уникальному индексу (poll_id, user_tg_id)
+            conditions.append(~exists().where(Vote.poll_id == self.not_voted_poll_id,
+                                              Vote.user_tg_id == BotUser.user_tg_id))
+        if self.voted_poll_id is not None:
+            conditions.append(exists().where(Vote.poll_id == self.voted_poll_id,
+                                             Vote.user_tg_id == BotUser.user_tg_id))
+        if self.voted_option_id is not None:
+            conditions.append(exists().where(Vote.option_id == self.voted_option_id,
+                                             Vote.user_tg_id == BotUser.user_tg_id))
+        if self.registered_after is not None:
+            conditions.append(BotUser.registration_date > self.registered_after)
+        return conditions
+
+    def describe(self) -> str:
+        if self.is_everyone:
+            return "все пользователи"
+        parts = []
+        if self.not_voted_poll_id is not None:
+            parts.append(f"не голосовали в опросе ID {self.not_voted_poll_id}")
+        if self.voted_poll_id is not None:
+            parts.append(f"голосовали в опросе ID {self.voted_poll_id}")
+        if self.voted_option_id is not None:
+            parts.append(f"голосовали за вариант ID {self.voted_option_id}")
+        if self.registered_after is not None:
+            parts.append(f"зарегистрировались после {self.registered_after:%d.%m.%Y}")
+        return ", ".join(parts)
+
+    def to_dict(self) -> dict:
+        data = {key: value for key, value in asdict(self).items() if value is not None}
+        if self.registered_after is not None:
+            data["registered_after"] = self.registered_after.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> "Audience":
+        data = dict(data or {})
+        if data.get("registered_after"):
+            data["registered_after"] = datetime.fromisoformat(data["registered_after"])
+        return cls(**data)
+
+    @classmethod
+    def parse(cls, args: list[str]) -> "Audience":
+        """
+        Разбирает аргументы команды: not_voted:<ID опроса>, voted_in:<ID опроса>, voted:<ID варианта>,
+        after:<ДД.ММ.ГГГГ>.
+        :raises ValueError: неизвестный или некорректный аргумент.
+        """
+        values = {}
+        for arg in args:
+            key, _, value = arg.partition(":")
+            if key == "not_voted" and value.isdigit():
+                values["not_voted_poll_id"] = int(value)
+            elif key == "voted_in" and value.isdigit():
+                values["voted_poll_id"] = int(value)
+            elif key == "voted" and value.isdigit():
+                values["voted_option_id"] = int(value)
+            elif key == "after" and value:
+                values["registered_after"] = datetime.strptime(value, "%d.%m.%Y")
+            else:
+                raise ValueError(f"Неизвестное условие аудитории: {arg}")
+        return cls(**values)
@@ -1,24 +1,102 @@
+import hashlib
+import os
+import time
+from typing import AsyncIterator
+
 from aiogram import types
-from sqlalchemy.ext.asyncio import AsyncSession
+from redis.asyncio import Redis
+from sqlalchemy import func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.future import select
 
-from .models import BotUser, Vote, Poll
+from .audience import Audience
+from .models import BotUser, BroadcastDelivery, Vote, Poll
 
-async def get_or_create_user(session: AsyncSession, user_data: types.User) -> BotUser:
-    result = await session.execute(select(BotUser).filter(BotUser.user_tg_id == user_data.id))
-    db_user = result.scalar_one_or_none()
+# Кэш уже зарегистрированных пользователей: user_tg_id -> (отпечаток профиля, время последнего обновления).
+# Общий для всех процессов слой - хэш в Redis с теми же отпечатками.
+PROFILE_REFRESH_INTERVAL = int(os.getenv("PROFILE_REFRESH_INTERVAL", 3600))
+KNOWN_USERS_KEY = "bot:known_users"
+_known_users: dict[int, tuple[str, float]] = {}
+
+
+def _profile_fingerprint(user_data: types.User) -> str:
+    profile = f"{user_data.username}|{user_data.first_name}|{user_data.last_name}"
+    return hashlib.sha1(profile.encode("utf-8")).hexdigest()[:12]
 
-    if not db_user:
-        db_user = BotUser(
-            user_tg_id=user_data.id,
-            username=user_data.username,
-            first_name=user_data.first_name,
-            last_name=user_data.last_name,
-        )
-        session.add(db_user)
-        await session.commit()
-        await session.refresh(db_user)
 
+def _upsert_user_stmt(user_data: types.User, only_if_changed: bool = False):
+    """
+    INSERT ... ON CONFLICT DO UPDATE для пользователя: идемпотентно и без гонок при двух быстрых кликах.
+    Пользователь пишет боту, значит он снова доступен для рассылок - флаг недоступности сбрасывается здесь же.
+    При only_if_changed строка перезаписывается, только если имя или username изменились
+    или пользователь был помечен недоступным.
+    """
+    stmt = insert(BotUser).values(
+        user_tg_id=user_data.id,
+        username=user_data.username,
+        first_name=user_data.first_name,
+        last_name=user_data.last_name,
+    )
+    changed = or_(
+        BotUser.username.is_distinct_from(stmt.excluded.username),
+        BotUser.first_name.is_distinct_from(stmt.excluded.first_name),
+        BotUser.last_name.is_distinct_from(stmt.excluded.last_name),
+        BotUser.is_reachable.is_(False),
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[BotUser.user_tg_id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "is_reachable": True,
+            "unreachable_reason": None,
+            "unreachable_since": None,
+        },
+        where=changed if only_if_changed else None,
+    )
+
+
+async def _remember_user(user_data: types.User, fingerprint: str, redis: Redis | None):
+    _known_users[user_data.id] = (fingerprint, time.monotonic())
+    if redis is not None:
+        await redis.hset(KNOWN_USERS_KEY, user_data.id, fingerprint)
+
+
+async def ensure_user(session: AsyncSession, user_data: types.User, redis: Redis | None = None):
+    """
+    Гарантирует, что пользователь есть в bot_user, а его имя актуально.
+    Для уже известного пользователя с неизменным профилем не делает запросов к БД;
+    профиль обновляется не чаще раза в PROFILE_REFRESH_INTERVAL секунд или при его изменении.
+    """
+    fingerprint = _profile_fingerprint(user_data)
+    known = _known_users.get(user_data.id)
+    if known and known[0] == fingerprint and time.monotonic() - known[1] < PROFILE_REFRESH_INTERVAL:
+        return
+    if known is None and redis is not None and await redis.hget(KNOWN_USERS_KEY, user_data.id) == fingerprint:
+        _known_users[user_data.id] = (fingerprint, time.monotonic())
+        return
+
+    await session.execute(_upsert_user_stmt(user_data, only_if_changed=True))
+    await session.commit()
+    await _remember_user(user_data, fingerprint, redis)
+
+
+async def get_or_create_user(session: AsyncSession, user_data: types.User, redis: Redis | None = None) -> BotUser:
+    """
+    Возвращает пользователя из БД, создавая или обновляя его одним запросом (upsert ... RETURNING).
+    Строка перезаписывается, только если профиль изменился; иначе RETURNING пуст и пользователь читается по ключу.
+    """
+    stmt = _upsert_user_stmt(user_data, only_if_changed=True).returning(BotUser)
+    result = await session.execute(select(BotUser).from_statement(stmt).execution_options(populate_existing=True))
+    db_user = result.scalar_one_or_none()
+    if db_user is None:
+        db_user = (await session.execute(
+            select(BotUser).filter(BotUser.user_tg_id == user_data.id).execution_options(populate_existing=True)
+        )).scalar_one()
+    await session.commit()
+    await _remember_user(user_data, _profile_fingerprint(user_data), redis)
     return db_user
 
 
@@ -33,11 +111,111 @@ async def get_user_completed_polls(session: AsyncSession, user_tg_id: int) -> li
     result = await session.execute(query)
     return result.scalars().all()
 
-# НОВАЯ ФУНКЦИЯ ДЛЯ РАССЫЛКИ
-async def get_all_users(session: AsyncSession) -> list[BotUser]:
+async def count_users(session: AsyncSession, reachable_only: bool = False, audience: Audience | None = None) -> int:
     """
-    Возвращает список всех зарегистрированных пользователей.
+    Возвращает количество зарегистрированных пользователей.
+    :param reachable_only: только доступные для рассылок (не заблокировавшие бота).
+    :param audience: только пользователи, входящие в аудиторию рассылки.
     """
-    query = select(BotUser)
+    query = select(func.count()).select_from(BotUser)
+    if reachable_only:
+        query = query.filter(BotUser.is_reachable)
+    if audience is not None:
+        query = query.filter(*audience.conditions())
     result = await session.execute(query)
-    return result.scalars().all()
\ No newline at end of file
+    return result.scalar_one()
+
+
+async def get_user_id_shard_bounds(session: AsyncSession, shard_size: int,
+                                   audience: Audience | None = None) -> list[int]:
+    """
+    Возвращает границы шардов по user_tg_id: каждый shard_size-й ID в порядке возрастания.
+    Шард i охватывает ID в полуинтервале (bounds[i-1], bounds[i]], последний шард не ограничен сверху.
+    Учитываются только доступные для рассылок пользователи (и только из аудитории, если она задана).
+    """
+    numbered = select(
+        BotUser.user_tg_id,
+        func.row_number().over(order_by=BotUser.user_tg_id).label("rn"),
+    ).filter(BotUser.is_reachable, *(audience.conditions() if audience else ())).subquery()
+    query = select(numbered.c.user_tg_id).filter(numbered.c.rn % shard_size == 0).order_by(numbered.c.user_tg_id)
+    result = await session.execute(query)
+    return list(result.scalars().all())
+
+
+async def iter_user_id_batches(session_pool: async_sessionmaker, batch_size: int = 1000,
+                               after_id: int | None = None, until_id: int | None = None,
+                               audience: Audience | None = None) -> AsyncIterator[list[int]]:
+    """
+    Выдает ID пользователей пачками по batch_size, упорядоченно по user_tg_id (keyset-пагинация).
+    Читается только колонка user_tg_id, а каждая пачка запрашивается в отдельной короткой сессии,
+    поэтому соединение с БД не удерживается на время рассылки и память не растет с числом пользователей.
+    Пользователи, недоступные для рассылок (is_reachable = false), пропускаются.
+    :param after_id: начать со следующего после этого ID (не включительно).
+    :param until_id: закончить на этом ID (включительно).
+    :param audience: условия аудитории; попадают в тот же запрос пачки (EXISTS / NOT EXISTS по vote).
+    """
+    conditions = audience.conditions() if audience else []
+    last_id = after_id
+    while True:
+        query = (
+            select(BotUser.user_tg_id)
+            .filter(BotUser.is_reachable, *conditions)
+            .order_by(BotUser.user_tg_id)
+            .limit(batch_size)
+        )
+        if last_id is not None:
+            query = query.filter(BotUser.user_tg_id > last_id)
+        if until_id is not None:
+            query = query.filter(BotUser.user_tg_id <= until_id)
+
+        async with session_pool() as session:
+            batch = list((await session.execute(query)).scalars().all())
+
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1]
+
+
+async def record_deliveries(session_pool: async_sessionmaker, broadcast_id: int, deliveries: list,
+                            redis: Redis | None = None) -> int:
+    """
+    Записывает результаты отправки пачки рассылки в журнал доставки (один пакетный INSERT)
+    и исключает из рассылок пользователей, которые заблокировали бота или удалили аккаунт.
+    Повторная отправка того же шарда после сбоя перезаписывает строки журнала.
+    :param deliveries: список broadcaster.Delivery.
+    :param redis: если передан, недоступные пользователи удаляются из общего кэша известных пользователей:
+                  их сообщение боту пройдет через upsert и вернет их в рассылки (не позже чем через
+                  PROFILE_REFRESH_INTERVAL - столько живет локальный кэш процесса бота).
+    :return: сколько пользователей помечено недоступными.
+    """
+    if not deliveries:
+        return 0
+    stmt = insert(BroadcastDelivery)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[BroadcastDelivery.broadcast_id, BroadcastDelivery.user_tg_id],
+        set_={"status": stmt.excluded.status, "error": stmt.excluded.error, "attempted_at": func.now()},
+    )
+    rows = [{"broadcast_id": broadcast_id, "user_tg_id": d.chat_id, "status": d.status, "error": d.error}
+            for d in deliveries]
+    unreachable: dict[str, list[int]] = {}
+    for delivery in deliveries:
+        if delivery.reason:
+            unreachable.setdefault(delivery.reason, []).append(delivery.chat_id)
+
+    marked = 0
+    async with session_pool() as session:
+        await session.execute(stmt, rows)
+        for reason, user_ids in unreachable.items():
+            result = await session.execute(
+                update(BotUser)
+                .where(BotUser.user_tg_id.in_(user_ids), BotUser.is_reachable)
+                .values(is_reachable=False, unreachable_reason=reason, unreachable_since=func.now())
+            )
+            marked += result.rowcount
+        await session.commit()
+    if redis is not None and unreachable:
+        await redis.hdel(KNOWN_USERS_KEY, *[user_id for user_ids in unreachable.values() for user_id in user_ids])
+    return marked
@@ -3,7 +3,8 @@
 import os
 import sys
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from .models import Base
+from .pool import get_pool_settings, engine_kwargs, pool_stats
+from .tracing import install as install_tracing
 from dotenv import load_dotenv
 load_dotenv()
 # 1. ПОЛУЧАЕМ URL ИЗ ПЕРЕМЕННОЙ ОКРУЖЕНИЯ, КОТОРУЮ ПЕРЕДАЕТ DOCKER COMPOSE
@@ -15,7 +16,11 @@ if not DATABASE_URL:
     sys.exit("Критическая ошибка: Переменная окружения DATABASE_URL не установлена!")
 
 # 3. СОЗДАЕМ "ДВИЖОК" С ИСПОЛЬЗОВАНИЕМ ПОЛУЧЕННОЙ ПЕРЕМЕННОЙ
-engine = create_async_engine(DATABASE_URL)
+# Параметры пула зависят от сервиса (DB_POOL_PROFILE=bot|api|worker), см. database/pool.py
+pool_settings = get_pool_settings()
+engine = create_async_engine(DATABASE_URL, **engine_kwargs(DATABASE_URL, pool_settings))
+# Трассировка SQL и лог медленных запросов (SQL_TRACE, SQL_SLOW_QUERY_MS), см. database/tracing.py
+install_tracing(engine.sync_engine)
 
 # --- Остальной код остается без изменений ---
 
@@ -26,12 +31,13 @@ async_session = async_sessionmaker(
     class_=AsyncSession
 )
 
-async def init_models():
+
+def get_pool_stats() -> dict:
     """
-    Создает все таблицы в базе данных на основе моделей SQLAlchemy.
+    Состояние пула соединений этого процесса.
     """
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    return pool_stats(engine, pool_settings)
+
 
 async def get_session() -> AsyncSession:
     """
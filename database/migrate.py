@@ -0,0 +1,348 @@
+# KorpBot/database/migrate.py
+#
+# Версионные миграции схемы БД.
+#   python -m database.migrate           - применить недостающие миграции
+#   python -m database.migrate status    - показать текущую и последнюю версии схемы
+#   python -m database.migrate explain   - проверить через EXPLAIN, что горячие запросы используют индексы
+#
+# Все миграции идемпотентны (IF NOT EXISTS), поэтому их можно применять и к новой, и к старой базе,
+# созданной когда-то через create_all.
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from typing import Awaitable, Callable, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .main import engine
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock: две одновременно запущенные миграции не будут мешать друг другу
+MIGRATION_LOCK_KEY = 7_310_001
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def _execute_all(conn: AsyncConnection, statements: list[str]):
+    for statement in statements:
+        await conn.execute(text(statement))
+
+
+async def _initial_schema(conn: AsyncConnection):
+    # Схема, с которой бот жил до появления миграций (тогда ее создавал create_all), зафиксирована как есть.
+    # Модели с тех пор менялись, а все новое - колонки, индексы, таблицы - добавляют следующие миграции
+    await _execute_all(conn, [
+        "CREATE TABLE IF NOT EXISTS bot_user ("
+        "user_tg_id bigserial NOT NULL PRIMARY KEY, "
+        "username varchar, "
+        "first_name varchar, "
+        "last_name varchar, "
+        "registration_date timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_bot_user_user_tg_id ON bot_user (user_tg_id)",
+        "CREATE TABLE IF NOT EXISTS poll ("
+        "id serial NOT NULL PRIMARY KEY, "
+        "title varchar(255) NOT NULL, "
+        "created_at timestamp, "
+        "status boolean)",
+        "CREATE INDEX IF NOT EXISTS ix_poll_id ON poll (id)",
+        "CREATE TABLE IF NOT EXISTS poll_option ("
+        "id serial NOT NULL PRIMARY KEY, "
+        "poll_id integer NOT NULL REFERENCES poll (id) ON DELETE CASCADE, "
+        "option_text text NOT NULL, "
+        "votes_count integer)",
+        "CREATE INDEX IF NOT EXISTS ix_poll_option_id ON poll_option (id)",
+        "CREATE TABLE IF NOT EXISTS vote ("
+        "id serial NOT NULL PRIMARY KEY, "
+        "poll_id integer NOT NULL REFERENCES poll (id) ON DELETE CASCADE, "
+        "user_tg_id bigint NOT NULL REFERENCES bot_user (user_tg_id) ON DELETE CASCADE, "
+        "option_id integer NOT NULL REFERENCES poll_option (id) ON DELETE CASCADE)",
+        "CREATE INDEX IF NOT EXISTS ix_vote_id ON vote (id)",
+        "CREATE INDEX IF NOT EXISTS ix_vote_user_tg_id ON vote (user_tg_id)",
+        "CREATE TABLE IF NOT EXISTS telegram_poll ("
+        "telegram_poll_id varchar NOT NULL PRIMARY KEY, "
+        "poll_id integer NOT NULL REFERENCES poll (id) ON DELETE CASCADE)",
+    ])
+
+
+async def _vote_unique(conn: AsyncConnection):
+    # Старые базы могли накопить дубли голосов: оставляем последний голос и пересчитываем счетчики
+    duplicates = await conn.execute(text(
+        "DELETE FROM vote a USING vote b "
+        "WHERE a.poll_id = b.poll_id AND a.user_tg_id = b.user_tg_id AND a.id < b.id"
+    ))
+    if duplicates.rowcount:
+        logger.info(f"Удалено дублирующихся голосов: {duplicates.rowcount}")
+        await conn.execute(text(
+            "UPDATE poll_option po SET votes_count = (SELECT count(*) FROM vote v WHERE v.option_id = po.id)"
+        ))
+    await conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_vote_poll_user ON vote (poll_id, user_tg_id)"))
+
+
+async def _performance_indexes(conn: AsyncConnection):
+    await _execute_all(conn, [
+        # Отчеты: постраничный список участников и GROUP BY по вариантам внутри опроса
+        "CREATE INDEX IF NOT EXISTS ix_vote_poll_id_id ON vote (poll_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_vote_option_id_id ON vote (option_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_vote_poll_id_option_id ON vote (poll_id, option_id)",
+        # Внешние ключи без индексов: выборка вариантов опроса и каскадное удаление
+        "CREATE INDEX IF NOT EXISTS ix_poll_option_poll_id ON poll_option (poll_id)",
+        "CREATE INDEX IF NOT EXISTS ix_telegram_poll_poll_id ON telegram_poll (poll_id)",
+        # /poll показывает активные опросы от новых к старым, /list_polls - все опросы
+        "CREATE INDEX IF NOT EXISTS ix_poll_created_at ON poll (created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_poll_active_created_at ON poll (created_at) WHERE status",
+    ])
+
+
+async def _poll_stats(conn: AsyncConnection):
+    await _execute_all(conn, [
+        "ALTER TABLE vote ADD COLUMN IF NOT EXISTS voted_at timestamp NOT NULL DEFAULT now()",
+        "CREATE TABLE IF NOT EXISTS poll_stats ("
+        "poll_id integer NOT NULL PRIMARY KEY REFERENCES poll (id) ON DELETE CASCADE, "
+        "total_votes integer NOT NULL, "
+        "updated_at timestamp)",
+        "CREATE TABLE IF NOT EXISTS poll_vote_bucket ("
+        "poll_id integer NOT NULL REFERENCES poll (id) ON DELETE CASCADE, "
+        "option_id integer NOT NULL REFERENCES poll_option (id) ON DELETE CASCADE, "
+        "bucket_start timestamp NOT NULL, "
+        "votes integer NOT NULL, "
+        "PRIMARY KEY (poll_id, option_id, bucket_start))",
+        # Начальное заполнение из vote. Время старых голосов неизвестно: в гистограмме они попадут
+        # в минуту применения миграции. Дальше агрегаты поддерживаются при каждом голосе
+        "INSERT INTO poll_stats (poll_id, total_votes, updated_at) "
+        "SELECT p.id, count(v.id), now() FROM poll p LEFT JOIN vote v ON v.poll_id = p.id GROUP BY p.id "
+        "ON CONFLICT (poll_id) DO UPDATE SET total_votes = EXCLUDED.total_votes, updated_at = EXCLUDED.updated_at",
+        "DELETE FROM poll_vote_bucket",
+        "INSERT INTO poll_vote_bucket (poll_id, option_id, bucket_start, votes) "
+        "SELECT poll_id, option_id, date_trunc('minute', voted_at), count(*) FROM vote GROUP BY 1, 2, 3",
+    ])
+
+
+async def _delivery_ledger(conn: AsyncConnection):
+    await _execute_all(conn, [
+        "ALTER TABLE bot_user ADD COLUMN IF NOT EXISTS is_reachable boolean NOT NULL DEFAULT true",
+        "ALTER TABLE bot_user ADD COLUMN IF NOT EXISTS unreachable_reason varchar",
+        "ALTER TABLE bot_user ADD COLUMN IF NOT EXISTS unreachable_since timestamp",
+        "CREATE INDEX IF NOT EXISTS ix_bot_user_reachable ON bot_user (user_tg_id) WHERE is_reachable",
+        # Без внешнего ключа на bot_user: журнал пишется пачками
+        "CREATE TABLE IF NOT EXISTS broadcast_delivery ("
+        "broadcast_id bigint NOT NULL, "
+        "user_tg_id bigint NOT NULL, "
+        "status varchar(16) NOT NULL, "
+        "error varchar, "
+        "attempted_at timestamp NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (broadcast_id, user_tg_id))",
+    ])
+
+
+async def _poll_schedule(conn: AsyncConnection):
+    await _execute_all(conn, [
+        "ALTER TABLE poll ADD COLUMN IF NOT EXISTS opens_at timestamp",
+        "ALTER TABLE poll ADD COLUMN IF NOT EXISTS closes_at timestamp",
+        # Частичные индексы: в них только опросы с ожидающим сроком, поэтому поиск ближайшего
+        # срока и сработавших опросов не зависит от общего числа опросов
+        "CREATE INDEX IF NOT EXISTS ix_poll_opens_at ON poll (opens_at) WHERE opens_at IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_poll_closes_at ON poll (closes_at) WHERE closes_at IS NOT NULL",
+    ])
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "initial schema", _initial_schema),
+    Migration(2, "unique vote per user and poll", _vote_unique),
+    Migration(3, "performance indexes", _performance_indexes),
+    Migration(4, "poll stats and vote histogram", _poll_stats),
+    Migration(5, "broadcast delivery ledger and user reachability", _delivery_ledger),
+    Migration(6, "scheduled poll open and close", _poll_schedule),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def _ensure_version_table(conn: AsyncConnection):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version integer PRIMARY KEY, "
+        "name text NOT NULL, "
+        "applied_at timestamp NOT NULL DEFAULT now())"
+    ))
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    """Текущая версия схемы; 0 - миграции еще не применялись."""
+    exists = await conn.scalar(text("SELECT to_regclass('schema_version') IS NOT NULL"))
+    if not exists:
+        return 0
+    return await conn.scalar(text("SELECT coalesce(max(version), 0) FROM schema_version"))
+
+
+async def migrate() -> list[int]:
+    """
+    Применяет недостающие миграции, каждую в своей транзакции.
+    :return: список примененных версий.
+    """
+    applied = []
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        await conn.commit()
+        try:
+            async with conn.begin():
+                await _ensure_version_table(conn)
+            current = await get_schema_version(conn)
+            await conn.commit()
+            for migration in MIGRATIONS:
+                if migration.version <= current:
+                    continue
+                logger.info(f"Применение миграции {migration.version}: {migration.name}...")
+                async with conn.begin():
+                    await migration.apply(conn)
+                    await conn.execute(
+                        text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                        {"version": migration.version, "name": migration.name}
+                    )
+                applied.append(migration.version)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            await conn.commit()
+    return applied
+
+
+async def check_schema_version():
+    """
+    Проверка при старте сервиса: схема БД должна быть не старше кода.
+    Сами миграции выполняет отдельная команда python -m database.migrate.
+    """
+    async with engine.connect() as conn:
+        current = await get_schema_version(conn)
+    if current < LATEST_VERSION:
+        raise RuntimeError(
+            f"Схема БД устарела (версия {current}, требуется {LATEST_VERSION}). "
+            f"Выполните: python -m database.migrate"
+        )
+    if current > LATEST_VERSION:
+        logger.warning(f"Версия схемы БД ({current}) новее, чем известна коду ({LATEST_VERSION}).")
+    return current
+
+
+# --- ПРОВЕРКА ИНДЕКСОВ ЧЕРЕЗ EXPLAIN ---
+
+class ExplainCheck(NamedTuple):
+    name: str
+    sql: str
+    # Подходит любой из перечисленных индексов
+    expected_indexes: tuple[str, ...]
+
+
+# Горячие запросы бота и API и индексы, которые они должны использовать.
+# Значения параметров не важны: проверяется, что план вообще может опереться на индекс.
+EXPLAIN_CHECKS: list[ExplainCheck] = [
+    ExplainCheck("голос пользователя в опросе (record_vote)",
+                 "SELECT option_id FROM vote WHERE poll_id = 1 AND user_tg_id = 1",
+                 # Оба индекса начинаются с poll_id; на маленьком опросе планировщику все равно, какой взять
+                 ("uq_vote_poll_user", "ix_vote_poll_id_option_id")),
+    ExplainCheck("голоса по вариантам опроса (отчет)",
+                 "SELECT option_id, count(*) FROM vote WHERE poll_id = 1 GROUP BY option_id",
+                 ("ix_vote_poll_id_option_id",)),
+    ExplainCheck("страница участников опроса",
+                 "SELECT id FROM vote WHERE poll_id = 1 AND id > 0 ORDER BY id LIMIT 51",
+                 ("ix_vote_poll_id_id",)),
+    ExplainCheck("страница участников варианта",
+                 "SELECT id FROM vote WHERE option_id = 1 AND id > 0 ORDER BY id LIMIT 51",
+                 ("ix_vote_option_id_id",)),
+    ExplainCheck("варианты опроса",
+                 "SELECT * FROM poll_option WHERE poll_id = 1",
+                 ("ix_poll_option_poll_id",)),
+    ExplainCheck("активные опросы (/poll)",
+                 "SELECT * FROM poll WHERE status ORDER BY created_at DESC",
+                 ("ix_poll_active_created_at",)),
+    ExplainCheck("все опросы (/list_polls)",
+                 "SELECT * FROM poll ORDER BY created_at DESC",
+                 ("ix_poll_created_at",)),
+    ExplainCheck("гистограмма голосов опроса (отчет)",
+                 "SELECT bucket_start, option_id, votes FROM poll_vote_bucket WHERE poll_id = 1",
+                 ("poll_vote_bucket_pkey",)),
+    ExplainCheck("получатели рассылки (пачка после контрольной точки)",
+                 "SELECT user_tg_id FROM bot_user WHERE is_reachable AND user_tg_id > 1 ORDER BY user_tg_id LIMIT 500",
+                 ("ix_bot_user_reachable",)),
+    ExplainCheck("не голосовавшие в опросе (напоминание, антисоединение)",
+                 "SELECT user_tg_id FROM bot_user WHERE is_reachable AND user_tg_id > 1 AND NOT EXISTS "
+                 "(SELECT 1 FROM vote WHERE vote.poll_id = 1 AND vote.user_tg_id = bot_user.user_tg_id) "
+                 "ORDER BY user_tg_id LIMIT 500",
+                 ("uq_vote_poll_user", "ix_vote_poll_id_option_id")),
+    ExplainCheck("ближайший срок закрытия опроса (планировщик)",
+                 "SELECT min(closes_at) FROM poll WHERE closes_at IS NOT NULL",
+                 ("ix_poll_closes_at",)),
+    ExplainCheck("опросы с наступившим сроком закрытия (планировщик)",
+                 "SELECT id FROM poll WHERE closes_at <= now()::timestamp ORDER BY closes_at LIMIT 100",
+                 ("ix_poll_closes_at",)),
+    ExplainCheck("пройденные опросы пользователя (/profile)",
+                 "SELECT DISTINCT poll_id FROM vote WHERE user_tg_id = 1",
+                 ("ix_vote_user_tg_id",)),
+]
+
+
+def _plan_indexes(plan: dict) -> set[str]:
+    indexes = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        indexes |= _plan_indexes(child)
+    return indexes
+
+
+async def explain_checks() -> list[tuple[ExplainCheck, set[str], bool]]:
+    """
+    Выполняет EXPLAIN для горячих запросов и проверяет, что в плане есть ожидаемый индекс.
+    На маленькой базе планировщик честно выбирает Seq Scan, поэтому последовательное
+    сканирование на время проверки запрещается: так видно, что индекс пригоден для запроса.
+    """
+    results = []
+    async with engine.connect() as conn:
+        async with conn.begin() as transaction:
+            await conn.execute(text("SET LOCAL enable_seqscan = off"))
+            for check in EXPLAIN_CHECKS:
+                raw = await conn.scalar(text(f"EXPLAIN (FORMAT JSON) {check.sql}"))
+                plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+                indexes = _plan_indexes(plan)
+                results.append((check, indexes, bool(indexes & set(check.expected_indexes))))
+            await transaction.rollback()
+    return results
+
+
+async def _main(command: str) -> int:
+    try:
+        if command == "status":
+            async with engine.connect() as conn:
+                current = await get_schema_version(conn)
+            print(f"Версия схемы: {current}, последняя миграция: {LATEST_VERSION}")
+            return 0 if current >= LATEST_VERSION else 1
+
+        if command == "explain":
+            failed = 0
+            for check, indexes, ok in await explain_checks():
+                mark = "OK  " if ok else "FAIL"
+                print(f"[{mark}] {check.name}: ожидается {' или '.join(check.expected_indexes)}, "
+                      f"в плане: {', '.join(sorted(indexes)) or 'нет индексов'}")
+                failed += not ok
+            return 1 if failed else 0
+
+        applied = await migrate()
+        if applied:
+            logger.info(f"Применены миграции: {', '.join(map(str, applied))}. Версия схемы: {applied[-1]}")
+        else:
+            logger.info(f"Схема БД актуальна (версия {LATEST_VERSION}).")
+        return 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument("command", nargs="?", default="migrate", choices=["migrate", "status", "explain"])
+    sys.exit(asyncio.run(_main(parser.parse_args().command)))
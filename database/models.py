@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, ForeignKey, TIMESTAMP, Boolean, BigInteger, Text
+from sqlalchemy import Column, String, Integer, ForeignKey, TIMESTAMP, Boolean, BigInteger, Text, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -7,12 +7,20 @@ Base = declarative_base()
 # НОВАЯ МОДЕЛЬ ДЛЯ ЗАРЕГИСТРИРОВАННЫХ ПОЛЬЗОВАТЕЛЕЙ
 class BotUser(Base):
     __tablename__ = 'bot_user'
+    __table_args__ = (
+        # Получатели рассылок: keyset-пагинация только по доступным пользователям
+        Index("ix_bot_user_reachable", "user_tg_id", postgresql_where=text("is_reachable")),
+    )
 
     user_tg_id = Column(BigInteger, primary_key=True, index=True)
     username = Column(String, nullable=True)
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
     registration_date = Column(TIMESTAMP, default=datetime.now)
+    # Пользователь заблокировал бота или удалил аккаунт: рассылки его пропускают, пока он снова не напишет /start
+    is_reachable = Column(Boolean, nullable=False, default=True, server_default=text("true"))
+    unreachable_reason = Column(String, nullable=True)
+    unreachable_since = Column(TIMESTAMP, nullable=True)
 
     # Связь с голосами пользователя
     votes = relationship("Vote", back_populates="user", cascade="all, delete-orphan")
@@ -26,23 +34,35 @@ class BotUser(Base):
 
 class Poll(Base):
     __tablename__ = 'poll'
+    # Индексы создаются миграциями (database/migrate.py); здесь они описаны для новых баз и документации
+    __table_args__ = (
+        # Активные опросы от новых к старым (/poll)
+        Index('ix_poll_active_created_at', 'created_at', postgresql_where=text('status')),
+        # Ближайший срок открытия/закрытия для планировщика (poll_scheduler.py): в индексах только ожидающие сроки
+        Index('ix_poll_opens_at', 'opens_at', postgresql_where=text('opens_at IS NOT NULL')),
+        Index('ix_poll_closes_at', 'closes_at', postgresql_where=text('closes_at IS NOT NULL')),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), nullable=False)
-    created_at = Column(TIMESTAMP, default=datetime.now)
+    created_at = Column(TIMESTAMP, default=datetime.now, index=True)
     status = Column(Boolean, default=True)
+    # Запланированные открытие и закрытие; планировщик меняет статус и обнуляет сработавший срок
+    opens_at = Column(TIMESTAMP, nullable=True)
+    closes_at = Column(TIMESTAMP, nullable=True)
 
     options = relationship("PollOption", back_populates="poll", cascade="all, delete-orphan")
     # Теперь participants - это голоса, а не пользователи
     participants = relationship("Vote", back_populates="poll", cascade="all, delete-orphan")
     telegram_map = relationship("TelegramPoll", back_populates="poll", cascade="all, delete-orphan")
+    stats = relationship("PollStats", back_populates="poll", uselist=False, cascade="all, delete-orphan")
 
 
 class PollOption(Base):
     __tablename__ = 'poll_option'
 
     id = Column(Integer, primary_key=True, index=True)
-    poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), nullable=False)
+    poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), nullable=False, index=True)
     option_text = Column(Text, nullable=False)
     votes_count = Column(Integer, default=0)
 
@@ -54,12 +74,23 @@ class PollOption(Base):
 # МОДЕЛЬ User ПЕРЕИМЕНОВАНА В Vote И ПЕРЕРАБОТАНА
 class Vote(Base):
     __tablename__ = 'vote'
+    # Один голос пользователя на опрос; на этом ограничении построен INSERT ... ON CONFLICT в record_vote
+    __table_args__ = (
+        UniqueConstraint('poll_id', 'user_tg_id', name='uq_vote_poll_user'),
+        # Постраничный вывод участников в веб-отчете (keyset по id внутри опроса / варианта)
+        Index('ix_vote_poll_id_id', 'poll_id', 'id'),
+        Index('ix_vote_option_id_id', 'option_id', 'id'),
+        # Подсчет голосов по вариантам внутри опроса
+        Index('ix_vote_poll_id_option_id', 'poll_id', 'option_id'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), nullable=False)
     # Внешний ключ к ID пользователя из Telegram
     user_tg_id = Column(BigInteger, ForeignKey('bot_user.user_tg_id', ondelete="CASCADE"), nullable=False, index=True)
     option_id = Column(Integer, ForeignKey('poll_option.id', ondelete="CASCADE"), nullable=False)
+    # Время последнего голоса (при смене варианта обновляется); по нему строится гистограмма голосов
+    voted_at = Column(TIMESTAMP, nullable=False, server_default=text('now()'))
 
     # Связи для удобного доступа к данным
     poll = relationship("Poll", back_populates="participants")
@@ -71,6 +102,43 @@ class TelegramPoll(Base):
     __tablename__ = 'telegram_poll'
 
     telegram_poll_id = Column(String, primary_key=True)
-    poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), nullable=False)
+    poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), nullable=False, index=True)
+
+    poll = relationship("Poll", back_populates="telegram_map")
+
+
+# АГРЕГАТЫ ПО ОПРОСУ: поддерживаются при каждом голосе (poll_state.RECORD_VOTE_SQL)
+# и пересчитываются из таблицы vote командой python -m database.stats rebuild
+class PollStats(Base):
+    __tablename__ = 'poll_stats'
+
+    poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), primary_key=True)
+    total_votes = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, default=datetime.now)
+
+    poll = relationship("Poll", back_populates="stats")
+
+
+class PollVoteBucket(Base):
+    """Количество текущих голосов за вариант, поданных в течение одной минуты."""
+    __tablename__ = 'poll_vote_bucket'
+
+    poll_id = Column(Integer, ForeignKey('poll.id', ondelete="CASCADE"), primary_key=True)
+    option_id = Column(Integer, ForeignKey('poll_option.id', ondelete="CASCADE"), primary_key=True)
+    bucket_start = Column(TIMESTAMP, primary_key=True)
+    votes = Column(Integer, nullable=False, default=0)
+
+
+# ЖУРНАЛ ДОСТАВКИ РАССЫЛОК: результат отправки каждому пользователю (пишется пачками, см. crud.record_deliveries)
+class BroadcastDelivery(Base):
+    __tablename__ = 'broadcast_delivery'
 
-    poll = relationship("Poll", back_populates="telegram_map")
\ No newline at end of file
+    # ID рассылки из broadcast_state (Redis)
+    broadcast_id = Column(BigInteger, primary_key=True)
+    # Без внешнего ключа: журнал пишется пачками, и проверка ссылок на каждую строку ему не нужна
+    user_tg_id = Column(BigInteger, primary_key=True)
+    # sent, failed или unreachable (заблокировал бота / аккаунт удален)
+    status = Column(String(16), nullable=False)
+    # Класс ошибки отправки, например TelegramForbiddenError
+    error = Column(String, nullable=True)
+    attempted_at = Column(TIMESTAMP, nullable=False, server_default=text("now()"))
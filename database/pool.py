@@ -0,0 +1,150 @@
+# KorpBot/database/pool.py
+
+import logging
+import os
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+
+logger = logging.getLogger(__name__)
+
+# Профили пула соединений для каждого сервиса. У бота много коротких запросов от хэндлеров,
+# у API - немного параллельных запросов отчетов, у процесса Celery-воркера задачи выполняются
+# по одной в общем event loop (worker_runtime.py), поэтому ему хватает пары соединений, которые
+# переживают задачи. Между задачами соединение может долго простаивать - проверяем его перед выдачей.
+# Профиль выбирается переменной DB_POOL_PROFILE, отдельные параметры переопределяются через DB_POOL_*.
+POOL_PROFILES = {
+    "bot": {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": False,
+        "statement_cache_size": 500,
+    },
+    "api": {
+        "pool_size": 5,
+        "max_overflow": 5,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_cache_size": 200,
+    },
+    "worker": {
+        "pool_size": 2,
+        "max_overflow": 3,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_cache_size": 100,
+    },
+}
+
+DB_POOL_PROFILE = os.getenv("DB_POOL_PROFILE", "bot")
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return value.lower() in ("1", "true", "yes") if value not in (None, "") else default
+
+
+def get_pool_settings(profile: str = DB_POOL_PROFILE) -> dict:
+    """Возвращает параметры пула для профиля с учетом переопределений из окружения."""
+    if profile not in POOL_PROFILES:
+        logger.warning(f"Неизвестный профиль пула '{profile}', используется 'bot'.")
+        profile = "bot"
+    settings = dict(POOL_PROFILES[profile])
+    settings["pool_size"] = _env_int("DB_POOL_SIZE", settings["pool_size"])
+    settings["max_overflow"] = _env_int("DB_POOL_MAX_OVERFLOW", settings["max_overflow"])
+    settings["pool_timeout"] = _env_int("DB_POOL_TIMEOUT", settings["pool_timeout"])
+    settings["pool_recycle"] = _env_int("DB_POOL_RECYCLE", settings["pool_recycle"])
+    settings["pool_pre_ping"] = _env_bool("DB_POOL_PRE_PING", settings["pool_pre_ping"])
+    settings["statement_cache_size"] = _env_int("DB_STATEMENT_CACHE_SIZE", settings["statement_cache_size"])
+    settings["profile"] = profile
+    return settings
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Пул, который замеряет время ожидания свободного соединения и считает выдачи и таймауты.
+    Выдачей считается только успешная; ошибка открытия соединения (БД недоступна, неверный пароль)
+    не попадает ни в таймауты, ни в статистику ожидания.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        waited = time.perf_counter() - started
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return connection
+
+
+# SQLAlchemy пишет служебные сообщения пула в логгер "<модуль>.<класс>". Для стандартных пулов это
+# sqlalchemy.pool.*, который по умолчанию молчит, а для нашего класса - database.pool.InstrumentedPool,
+# и при уровне INFO в логи попадали сообщения о каждом dispose/recreate.
+logging.getLogger(f"{__name__}.{InstrumentedPool.__name__}").setLevel(logging.WARNING)
+
+
+def engine_kwargs(database_url: str, settings: dict) -> dict:
+    """Аргументы create_async_engine для выбранного профиля."""
+    kwargs = {"pool_pre_ping": settings["pool_pre_ping"]}
+    if settings["pool_size"] <= 0:
+        kwargs["poolclass"] = NullPool
+    else:
+        kwargs.update(
+            poolclass=InstrumentedPool,
+            pool_size=settings["pool_size"],
+            max_overflow=settings["max_overflow"],
+            pool_timeout=settings["pool_timeout"],
+            pool_recycle=settings["pool_recycle"],
+        )
+    if "asyncpg" in database_url:
+        connect_args = {"prepared_statement_cache_size": settings["statement_cache_size"]}
+        if settings["statement_cache_size"] == 0:
+            # Полностью отключаем кэш и на уровне asyncpg (нужно, например, за pgbouncer)
+            connect_args["statement_cache_size"] = 0
+        kwargs["connect_args"] = connect_args
+    return kwargs
+
+
+def pool_stats(engine, settings: dict) -> dict:
+    """
+    Текущее состояние пула: занятые и свободные соединения, overflow и время ожидания выдачи.
+    Помогает подобрать max_connections в PostgreSQL под все сервисы.
+    """
+    pool = engine.pool
+    stats = {
+        "profile": settings["profile"],
+        "pool_size": settings["pool_size"],
+        "max_overflow": settings["max_overflow"],
+    }
+    if isinstance(pool, InstrumentedPool):
+        stats.update(
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            checkouts=pool.checkouts,
+            timeouts=pool.timeouts,
+            wait_avg_ms=round(pool.wait_total / pool.checkouts * 1000, 3) if pool.checkouts else 0.0,
+            wait_max_ms=round(pool.wait_max * 1000, 3),
+        )
+    return stats
@@ -0,0 +1,112 @@
+# KorpBot/database/stats.py
+#
+# Агрегаты опросов (poll_stats, poll_vote_bucket): пересчет из таблицы vote и гистограмма голосов.
+#   python -m database.stats rebuild              - пересчитать все опросы
+#   python -m database.stats rebuild 12 15        - пересчитать только указанные опросы
+
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from .main import async_session, engine
+
+logger = logging.getLogger(__name__)
+
+# Минутные интервалы гистограммы; для длинных опросов отчет укрупняет их до часов
+BUCKET_UNIT = "minute"
+# Если голоса идут дольше этого срока, гистограмма в отчете строится по часам
+HOURLY_HISTOGRAM_AFTER = timedelta(hours=6)
+
+# Пустой массив (NULL) означает "все опросы"
+REBUILD_TOTALS_SQL = text("""
+INSERT INTO poll_stats (poll_id, total_votes, updated_at)
+SELECT p.id, count(v.id), now()
+FROM poll p
+LEFT JOIN vote v ON v.poll_id = p.id
+WHERE CAST(:poll_ids AS integer[]) IS NULL OR p.id = ANY(CAST(:poll_ids AS integer[]))
+GROUP BY p.id
+ON CONFLICT (poll_id) DO UPDATE
+    SET total_votes = EXCLUDED.total_votes, updated_at = EXCLUDED.updated_at
+""")
+
+DELETE_BUCKETS_SQL = text("""
+DELETE FROM poll_vote_bucket
+WHERE CAST(:poll_ids AS integer[]) IS NULL OR poll_id = ANY(CAST(:poll_ids AS integer[]))
+""")
+
+REBUILD_BUCKETS_SQL = text(f"""
+INSERT INTO poll_vote_bucket (poll_id, option_id, bucket_start, votes)
+SELECT poll_id, option_id, date_trunc('{BUCKET_UNIT}', voted_at), count(*)
+FROM vote
+WHERE CAST(:poll_ids AS integer[]) IS NULL OR poll_id = ANY(CAST(:poll_ids AS integer[]))
+GROUP BY 1, 2, 3
+""")
+
+
+async def rebuild_poll_stats(session: AsyncSession | AsyncConnection, poll_ids: list[int] | None = None, lock: bool = True):
+    """
+    Пересчитывает агрегаты опросов из таблицы vote (без commit - его делает вызывающий код).
+    :param poll_ids: опросы для пересчета; None - все опросы.
+    :param lock: заблокировать запись в vote до конца транзакции. Без блокировки голос, поданный
+                 во время пересчета, может быть потерян в агрегатах.
+    """
+    if lock:
+        await session.execute(text("LOCK TABLE vote IN SHARE MODE"))
+    params = {"poll_ids": poll_ids}
+    await session.execute(REBUILD_TOTALS_SQL, params)
+    await session.execute(DELETE_BUCKETS_SQL, params)
+    await session.execute(REBUILD_BUCKETS_SQL, params)
+
+
+async def get_vote_histogram(session: AsyncSession, poll_id: int) -> tuple[str, list, dict[int, list[int]]]:
+    """
+    Гистограмма голосов опроса для графика "голоса во времени".
+    :return: (единица интервала, начала интервалов, {option_id: [голосов в каждом интервале]}).
+    """
+    span = (await session.execute(
+        text("SELECT min(bucket_start), max(bucket_start) FROM poll_vote_bucket WHERE poll_id = :poll_id"),
+        {"poll_id": poll_id}
+    )).one()
+    if span[0] is None:
+        return BUCKET_UNIT, [], {}
+    unit = "hour" if span[1] - span[0] > HOURLY_HISTOGRAM_AFTER else BUCKET_UNIT
+
+    rows = (await session.execute(text("""
+        SELECT date_trunc(:unit, bucket_start) AS bucket, option_id, sum(votes) AS votes
+        FROM poll_vote_bucket
+        WHERE poll_id = :poll_id AND votes > 0
+        GROUP BY 1, 2
+        ORDER BY 1
+    """), {"poll_id": poll_id, "unit": unit})).all()
+
+    buckets = sorted({row.bucket for row in rows})
+    index = {bucket: i for i, bucket in enumerate(buckets)}
+    series: dict[int, list[int]] = {}
+    for row in rows:
+        series.setdefault(row.option_id, [0] * len(buckets))[index[row.bucket]] = int(row.votes)
+    return unit, buckets, series
+
+
+async def _main(poll_ids: list[int]) -> int:
+    try:
+        async with async_session() as session:
+            await rebuild_poll_stats(session, poll_ids or None)
+            await session.commit()
+        logger.info(f"Агрегаты пересчитаны: {'опросы ' + ', '.join(map(str, poll_ids)) if poll_ids else 'все опросы'}")
+        return 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Агрегаты опросов")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("poll_ids", nargs="*", type=int, help="ID опросов (по умолчанию все)")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.poll_ids)))
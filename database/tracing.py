@@ -0,0 +1,168 @@
+# KorpBot/database/tracing.py
+#
+# Трассировка SQL по единицам работы (апдейт бота, запрос к API) на событиях движка SQLAlchemy.
+# Включается переменными окружения, без них обработчики событий не подключаются вовсе:
+#   SQL_TRACE=1                     - считать запросы и время БД по каждому апдейту/запросу,
+#                                     предупреждать о повторяющихся запросах (похоже на N+1)
+#   SQL_TRACE_REPEAT_THRESHOLD=5    - сколько одинаковых по форме запросов в одной единице работы допустимо
+#   SQL_SLOW_QUERY_MS=200           - писать в лог запросы дольше порога (0 - не писать)
+#   SQL_SLOW_QUERY_LOG=/path/slow.log - дополнительно писать медленные запросы в файл
+
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(f"{__name__}.slow")
+
+SQL_TRACE = os.getenv("SQL_TRACE", "").lower() in ("1", "true", "yes")
+SQL_TRACE_REPEAT_THRESHOLD = int(os.getenv("SQL_TRACE_REPEAT_THRESHOLD", 5))
+SQL_TRACE_TOP = int(os.getenv("SQL_TRACE_TOP", 3))
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", 0))
+SQL_SLOW_QUERY_LOG = os.getenv("SQL_SLOW_QUERY_LOG", "")
+
+_CAST_RE = re.compile(r"::\w+(?:\[\])?")
+_PLACEHOLDER_RE = re.compile(r"\$\d+|%\(\w+\)s|:\w+|\?")
+_NUMBER_RE = re.compile(r"\b\d+\b")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_LIST_RE = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Форма запроса без значений: параметры, числа и строки заменяются на ?, списки IN - на (...).
+    Одинаковая форма у запросов, которые различаются только значениями, - так выглядит N+1.
+    """
+    shape = _STRING_RE.sub("?", statement)
+    shape = _CAST_RE.sub("", shape)
+    shape = _PLACEHOLDER_RE.sub("?", shape)
+    shape = _NUMBER_RE.sub("?", shape)
+    shape = _LIST_RE.sub("(...)", shape)
+    return _SPACES_RE.sub(" ", shape).strip()
+
+
+@dataclass
+class QueryTrace:
+    """Запросы одной единицы работы."""
+    name: str
+    statements: int = 0
+    db_time: float = 0.0
+    shapes: dict[str, int] = field(default_factory=dict)
+    # Самые долгие запросы: (секунды, форма запроса), по убыванию
+    slowest: list[tuple[float, str]] = field(default_factory=list)
+
+    def record(self, shape: str, duration: float):
+        self.statements += 1
+        self.db_time += duration
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if len(self.slowest) < SQL_TRACE_TOP or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, shape))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SQL_TRACE_TOP:]
+
+    def repeated(self, threshold: int = SQL_TRACE_REPEAT_THRESHOLD) -> list[tuple[str, int]]:
+        """Формы запросов, выполненные больше threshold раз."""
+        return [(shape, count) for shape, count in self.shapes.items() if count > threshold]
+
+    def report(self):
+        if not self.statements:
+            return
+        logger.info(f"SQL [{self.name}]: запросов {self.statements}, время БД {self.db_time * 1000:.1f} мс")
+        for duration, shape in self.slowest:
+            logger.debug(f"SQL [{self.name}]: {duration * 1000:.1f} мс - {shape[:300]}")
+        for shape, count in self.repeated():
+            logger.warning(f"SQL [{self.name}]: запрос выполнен {count} раз (возможен N+1): {shape[:300]}")
+
+
+_current_trace: ContextVar[QueryTrace | None] = ContextVar("sql_trace", default=None)
+
+
+@contextmanager
+def trace_unit(name: str) -> Iterator[QueryTrace | None]:
+    """
+    Единица работы для трассировки: все запросы внутри блока (в том числе из дочерних задач,
+    созданных внутри него) попадают в один QueryTrace. Без SQL_TRACE возвращает None.
+    """
+    if not SQL_TRACE:
+        yield None
+        return
+    trace = QueryTrace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.report()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._trace_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_trace_started", None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    trace = _current_trace.get()
+    if trace is None and duration * 1000 < SQL_SLOW_QUERY_MS:
+        return
+    shape = statement_shape(statement)
+    if trace is not None:
+        trace.record(shape, duration)
+    if SQL_SLOW_QUERY_MS and duration * 1000 >= SQL_SLOW_QUERY_MS:
+        slow_query_logger.warning(f"Медленный запрос {duration * 1000:.1f} мс "
+                                  f"[{trace.name if trace else '-'}]: {shape[:1000]}")
+
+
+def install(engine: Engine):
+    """Подключает обработчики событий к движку, если трассировка или лог медленных запросов включены."""
+    if not SQL_TRACE and not SQL_SLOW_QUERY_MS:
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    if SQL_SLOW_QUERY_LOG and not slow_query_logger.handlers:
+        handler = logging.FileHandler(SQL_SLOW_QUERY_LOG, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+        slow_query_logger.addHandler(handler)
+    logger.info(f"Трассировка SQL: {'включена' if SQL_TRACE else 'выключена'}, "
+                f"порог медленных запросов: {SQL_SLOW_QUERY_MS or '-'} мс")
+
+
+async def aiogram_trace_middleware(handler, event, data):
+    """Inner middleware диспетчера: единица работы - апдейт, подписанная именем хэндлера."""
+    callback = getattr(data.get("handler"), "callback", None)
+    with trace_unit(f"bot:{getattr(callback, '__name__', '?')}"):
+        return await handler(event, data)
+
+
+def setup_dispatcher_tracing(dp):
+    """Подключает трассировку ко всем хэндлерам диспетчера (при SQL_TRACE)."""
+    if not SQL_TRACE:
+        return
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(aiogram_trace_middleware)
+
+
+async def fastapi_trace_middleware(request, call_next):
+    """
+    HTTP-middleware FastAPI: единица работы - запрос. Итог добавляется в заголовок Server-Timing,
+    его видно в инструментах разработчика браузера. Запросы, которые потоковый ответ (экспорт)
+    выполняет уже после отправки заголовков, в итог не попадают.
+    """
+    with trace_unit(f"api:{request.method} {request.url.path}") as trace:
+        response = await call_next(request)
+        if trace is not None:
+            response.headers["Server-Timing"] = (f'db;dur={trace.db_time * 1000:.1f};'
+                                                 f'desc="{trace.statements} queries"')
+        return response
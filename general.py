@@ -2,7 +2,7 @@
 
 from aiogram import types, Router, F
 
-router = Router()
+router = Router(name="general")
 
 @router.message(F.text.lower() == 'привет')
 async def greet_user(message: types.Message):
@@ -0,0 +1,143 @@
+# KorpBot/live_results.py
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from broadcaster import BroadcastEngine, BroadcastStats
+from keyboards import create_voting_keyboard, create_results_keyboard
+
+logger = logging.getLogger(__name__)
+
+# Живое обновление сообщений с результатами: бот запоминает отправленные сообщения опроса
+# и периодически перерисовывает их, если счетчики изменились.
+LIVE_RESULTS_ENABLED = os.getenv("LIVE_RESULTS", "1").lower() in ("1", "true", "yes")
+LIVE_RESULTS_INTERVAL = float(os.getenv("LIVE_RESULTS_INTERVAL", 5.0))
+# Обновляются только сообщения, с которыми работали за последние LIVE_RESULTS_WINDOW секунд
+LIVE_RESULTS_WINDOW = int(os.getenv("LIVE_RESULTS_WINDOW", 3600))
+# Скорость правок ниже общего лимита бота, чтобы оставить запас для ответов пользователям
+LIVE_RESULTS_RATE = float(os.getenv("LIVE_RESULTS_RATE", 10))
+
+DIRTY_POLLS_KEY = "polls:live_dirty"
+
+RenderFunc = Callable[..., Awaitable[tuple[str, list | None]]]
+
+
+def _messages_key(poll_id: int) -> str:
+    return f"poll:{poll_id}:live"
+
+
+def _hashes_key(poll_id: int) -> str:
+    return f"poll:{poll_id}:live_text"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+async def track_message(redis: Redis, poll_id: int, chat_id: int, message_id: int, kind: str, text: str):
+    """
+    Запоминает сообщение опроса для живого обновления.
+    :param kind: "vote" - сообщение с кнопками голосования, "results" - только с кнопкой обновления.
+    """
+    member = f"{chat_id}:{message_id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zadd(_messages_key(poll_id), {member: time.time()})
+        pipe.hset(_hashes_key(poll_id), member, f"{kind}:{text_hash(text)}")
+        pipe.expire(_messages_key(poll_id), LIVE_RESULTS_WINDOW * 2)
+        pipe.expire(_hashes_key(poll_id), LIVE_RESULTS_WINDOW * 2)
+        await pipe.execute()
+
+
+async def mark_dirty(redis: Redis, poll_id: int):
+    """Отмечает, что результаты опроса изменились и открытые сообщения нужно перерисовать."""
+    await redis.sadd(DIRTY_POLLS_KEY, poll_id)
+
+
+async def _push_poll(bot: Bot, redis: Redis, engine: BroadcastEngine, stats: BroadcastStats,
+                     poll_id: int, poll_text: str, options: list) -> int:
+    """Перерисовывает все активные сообщения опроса, текст которых отличается от нового."""
+    cutoff = time.time() - LIVE_RESULTS_WINDOW
+    await redis.zremrangebyscore(_messages_key(poll_id), "-inf", cutoff)
+    members = await redis.zrange(_messages_key(poll_id), 0, -1)
+    if not members:
+        return 0
+
+    new_hash = text_hash(poll_text)
+    known = await redis.hmget(_hashes_key(poll_id), members)
+    stale = []
+    for member, value in zip(members, known):
+        kind, _, old_hash = (value or "vote:").partition(":")
+        if old_hash != new_hash:
+            stale.append((member, kind))
+
+    gone = []
+
+    async def edit(member: str, kind: str):
+        chat_id, message_id = map(int, member.split(":"))
+        markup = create_voting_keyboard(options) if kind == "vote" else create_results_keyboard(poll_id)
+
+        async def send(_chat_id: int):
+            try:
+                await bot.edit_message_text(text=poll_text, chat_id=chat_id, message_id=message_id,
+                                            reply_markup=markup, parse_mode="HTML")
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    return
+                if "message to edit not found" in str(e) or "message can't be edited" in str(e):
+                    gone.append(member)
+                    return
+                raise
+
+        if await engine.deliver(chat_id, send, stats):
+            await redis.hset(_hashes_key(poll_id), member, f"{kind}:{new_hash}")
+
+    semaphore = asyncio.Semaphore(engine.concurrency)
+
+    async def limited(member: str, kind: str):
+        async with semaphore:
+            await edit(member, kind)
+
+    await asyncio.gather(*(limited(member, kind) for member, kind in stale))
+    if gone:
+        await redis.zrem(_messages_key(poll_id), *gone)
+        await redis.hdel(_hashes_key(poll_id), *gone)
+    return len(stale)
+
+
+async def run_updater(bot: Bot, redis: Redis, session_pool: async_sessionmaker, render: RenderFunc,
+                      interval: float = LIVE_RESULTS_INTERVAL):
+    """
+    Фоновая задача: раз в interval секунд забирает опросы с изменившимися результатами
+    и правит их открытые сообщения. Каждое сообщение правится не чаще раза за интервал.
+    :param render: функция (poll_id, session, redis) -> (текст, варианты), обычно get_poll_text_and_options.
+    """
+    engine = BroadcastEngine(rate=LIVE_RESULTS_RATE)
+    logger.info(f"Запущено живое обновление результатов (интервал {interval} c).")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # SPOP забирает опросы атомарно: при нескольких репликах каждый опрос обновит одна из них
+            poll_ids = await redis.spop(DIRTY_POLLS_KEY, 1000)
+            if not poll_ids:
+                continue
+            stats = BroadcastStats()
+            edited = 0
+            for poll_id in map(int, poll_ids):
+                async with session_pool() as session:
+                    poll_text, options = await render(poll_id, session, redis)
+                if not options:
+                    continue
+                edited += await _push_poll(bot, redis, engine, stats, poll_id, poll_text, options)
+            if edited:
+                logger.info(f"Живое обновление: опросов {len(poll_ids)}, правок {stats.sent}, ошибок {stats.failed}")
+        except Exception as e:
+            logger.error(f"Ошибка живого обновления результатов: {e}")
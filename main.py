@@ -10,9 +10,17 @@ from aiogram.fsm.storage.redis import RedisStorage
 import redis.asyncio as redis
 
 # Импортируем роутеры и middleware
-from commands import router as commands_router, DbSessionMiddleware
+from commands import router as commands_router, DbSessionMiddleware, get_poll_text_and_options
 from general import router as general_router
-from database.main import init_models, async_session
+from database.main import async_session
+from database.migrate import check_schema_version
+from database.tracing import setup_dispatcher_tracing
+import vote_buffer
+import live_results
+import poll_scheduler
+import metrics
+from webhook import run_webhook, UPDATES_MAX_IN_FLIGHT
+from update_stream import run_ingester
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
@@ -22,11 +30,50 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# polling - один процесс забирает апдейты сам; webhook - апдейты присылает Telegram (см. webhook.py);
+# ingest - апдейты только складываются в Redis Streams, а обрабатывают их процессы update_stream.py
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
 
 if not BOT_TOKEN:
     logger.critical("Ошибка: Необходимо установить переменную окружения BOT_TOKEN")
     sys.exit("Ошибка: BOT_TOKEN не найден")
 
+def build_dispatcher(redis_client: redis.Redis) -> Dispatcher:
+    """Диспетчер с роутерами и middleware; одинаков для polling и webhook."""
+    storage = RedisStorage(redis=redis_client)
+    # redis_client доступен в хэндлерах как аргумент redis
+    dp = Dispatcher(storage=storage, redis=redis_client)
+    # Время обработки, ошибки и апдейты в работе по каждому хэндлеру (см. metrics.py)
+    metrics.setup_bot_metrics(dp)
+    # Число и время SQL-запросов по каждому апдейту (только при SQL_TRACE=1)
+    setup_dispatcher_tracing(dp)
+
+    # Этот middleware будет создавать сессию БД для каждого запроса в commands_router
+    commands_router.message.middleware(DbSessionMiddleware(session_pool=async_session))
+    commands_router.callback_query.middleware(DbSessionMiddleware(session_pool=async_session))
+
+    logger.info("Регистрация роутеров...")
+    dp.include_router(commands_router)
+    dp.include_router(general_router)
+    logger.info("Роутеры зарегистрированы.")
+    return dp
+
+
+async def start_background_tasks(bot: Bot, redis_client: redis.Redis) -> list[asyncio.Task]:
+    background_tasks = []
+    if vote_buffer.WRITE_BEHIND:
+        logger.info("Включен режим write-behind для голосов. Сверка счетчиков с БД...")
+        await vote_buffer.reconcile(redis_client, async_session)
+        background_tasks.append(asyncio.create_task(vote_buffer.run_flusher(redis_client, async_session)))
+    if live_results.LIVE_RESULTS_ENABLED:
+        background_tasks.append(asyncio.create_task(
+            live_results.run_updater(bot, redis_client, async_session, get_poll_text_and_options)
+        ))
+    if poll_scheduler.POLL_SCHEDULER_ENABLED:
+        background_tasks.append(asyncio.create_task(poll_scheduler.run_scheduler(redis_client, async_session)))
+    return background_tasks
+
+
 async def main():
     logger.info(f"Подключение к Redis: {REDIS_HOST}:{REDIS_PORT}")
     try:
@@ -38,29 +85,32 @@ async def main():
         sys.exit("Ошибка подключения к Redis")
 
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    storage = RedisStorage(redis=redis_client)
-    dp = Dispatcher(storage=storage)
+    dp = build_dispatcher(redis_client)
 
-    # Этот middleware будет создавать сессию БД для каждого запроса в commands_router
-    commands_router.message.middleware(DbSessionMiddleware(session_pool=async_session))
-    commands_router.callback_query.middleware(DbSessionMiddleware(session_pool=async_session))
-
-    logger.info("Регистрация роутеров...")
-    dp.include_router(commands_router)
-    dp.include_router(general_router)
-    logger.info("Роутеры зарегистрированы.")
-
-    logger.info("Инициализация базы данных...")
-    await init_models()
-    logger.info("БД инициализирована.")
+    logger.info("Проверка версии схемы БД...")
+    schema_version = await check_schema_version()
+    logger.info(f"Схема БД актуальна (версия {schema_version}).")
 
     me = await bot.get_me()
     logger.info(f"Бот запущен! ID: {me.id}, Имя: @{me.username}")
 
-    await bot.delete_webhook(drop_pending_updates=True)
-
-    logger.info("Запуск получения обновлений...")
-    await dp.start_polling(bot)
+    metrics.start_metrics_server()
+    background_tasks = await start_background_tasks(bot, redis_client)
+    try:
+        if BOT_MODE == "webhook":
+            logger.info("Запуск в режиме webhook...")
+            await run_webhook(bot, dp)
+        elif BOT_MODE == "ingest":
+            logger.info("Запуск в режиме ингестера (обработка - в процессах update_stream.py)...")
+            await run_ingester(bot, redis_client, dp)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("Запуск получения обновлений...")
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATES_MAX_IN_FLIGHT)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,206 @@
+# KorpBot/metrics.py
+#
+# Метрики Prometheus для бота, API и воркера Celery.
+# API отдает их на /metrics, бот и воркер - на отдельном порту METRICS_PORT (0 - не запускать).
+#
+# Если метрики пишут несколько процессов (prefork-воркер Celery, uvicorn --workers), задайте
+# PROMETHEUS_MULTIPROC_DIR: каждый процесс пишет свои значения в файлы этого каталога, а процесс,
+# отдающий /metrics, собирает их вместе.
+
+import glob
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import Update
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    # Файлы метрик без меток создаются сразу при импорте
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# Хэндлеры и запросы API: от единиц миллисекунд до секунд
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Задачи Celery: шард рассылки может идти десятки минут
+TASK_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+BOT_HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта ботом",
+    ["event_type", "router", "handler"], buckets=LATENCY_BUCKETS,
+)
+BOT_HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Необработанные исключения в хэндлерах бота",
+    ["event_type", "router", "handler", "error"],
+)
+BOT_UPDATES_IN_FLIGHT = Gauge(
+    "bot_updates_in_flight", "Апдейты, которые обрабатываются прямо сейчас", multiprocess_mode="livesum",
+)
+
+API_REQUEST_DURATION = Histogram(
+    "api_request_duration_seconds", "Время ответа API (до отправки заголовков)",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+API_REQUESTS_IN_FLIGHT = Gauge(
+    "api_requests_in_flight", "Запросы к API, которые обрабатываются прямо сейчас", multiprocess_mode="livesum",
+)
+
+CELERY_TASK_DURATION = Histogram(
+    "celery_task_duration_seconds", "Время выполнения задач Celery",
+    ["task", "state"], buckets=TASK_BUCKETS,
+)
+CELERY_TASK_FAILURES = Counter(
+    "celery_task_failures_total", "Задачи Celery, завершившиеся исключением",
+    ["task", "error"],
+)
+
+# По рассылкам - только по типу: каждая рассылка с меткой broadcast_id навсегда добавляла бы новые ряды.
+# Цифры отдельной рассылки хранятся в broadcast_state и видны в /broadcast_status
+BROADCAST_MESSAGES = Counter(
+    "broadcast_messages_total", "Сообщения рассылок по результату отправки",
+    ["kind", "result"],
+)
+BROADCAST_RETRY_AFTER_PAUSES = Counter(
+    "broadcast_retry_after_pauses_total", "Паузы рассылок из-за ответа 429 от Telegram",
+    ["kind"],
+)
+
+# Ключ в data апдейта, через который внутренний middleware сообщает внешнему, какой хэндлер сработал
+_LABEL_KEY = "metrics_handler_label"
+
+
+class _HandlerLabel:
+    __slots__ = ("router", "handler")
+
+    def __init__(self):
+        self.router = ""
+        self.handler = "unhandled"
+
+
+class BotMetricsMiddleware(BaseMiddleware):
+    """
+    Outer middleware апдейтов: время обработки, ошибки и число апдейтов в работе.
+    Хэндлер становится известен только после фильтров, поэтому его имя и роутер
+    подставляет внутренний middleware (_label_handler) - см. setup_bot_metrics.
+    """
+
+    async def __call__(self, handler, event: Update, data: dict):
+        label = _HandlerLabel()
+        data[_LABEL_KEY] = label
+        event_type = event.event_type
+        BOT_UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            BOT_HANDLER_ERRORS.labels(event_type, label.router, label.handler, type(e).__name__).inc()
+            raise
+        finally:
+            BOT_UPDATES_IN_FLIGHT.dec()
+            BOT_HANDLER_DURATION.labels(event_type, label.router, label.handler).observe(time.perf_counter() - started)
+
+
+async def _label_handler(handler, event, data: dict):
+    label = data.get(_LABEL_KEY)
+    if label is not None:
+        label.router = data["event_router"].name
+        label.handler = getattr(data["handler"].callback, "__name__", "?")
+    return await handler(event, data)
+
+
+def setup_bot_metrics(dp: Dispatcher):
+    """Подключает метрики к диспетчеру. Внутренние middleware диспетчера действуют и во вложенных роутерах."""
+    dp.update.outer_middleware(BotMetricsMiddleware())
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(_label_handler)
+
+
+def _route_template(scope: dict) -> str:
+    """
+    Шаблон сработавшего маршрута с префиксом роутера: /api/polls/{poll_id}.
+    Маршрут из include_router может хранить путь без префикса, поэтому префикс
+    восстанавливается по той части реального пути, которую маршрут не покрывает.
+    """
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    path = scope.get("path", "")
+    for position, char in enumerate(path):
+        if char == "/" and route.path_regex.match(path[position:]):
+            return path[:position] + template
+    return template
+
+
+async def api_metrics_middleware(request, call_next):
+    """
+    HTTP-middleware FastAPI. Маршрут берется шаблоном (/api/polls/{poll_id}), а не реальным путем,
+    чтобы число рядов метрики не росло с каждым ID; для потоковых ответов (экспорт) время
+    измеряется до начала передачи.
+    """
+    API_REQUESTS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        API_REQUESTS_IN_FLIGHT.dec()
+        API_REQUEST_DURATION.labels(request.method, _route_template(request.scope), str(status)).observe(
+            time.perf_counter() - started
+        )
+
+
+def get_registry() -> CollectorRegistry:
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_latest() -> tuple[bytes, str]:
+    """Текст метрик в формате Prometheus и его Content-Type."""
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+def reset_multiprocess_dir():
+    """
+    Удаляет файлы метрик прошлого запуска (вызывается до запуска дочерних процессов),
+    иначе счетчики давно завершенных процессов продолжат попадать в сумму.
+    """
+    if not MULTIPROC_DIR:
+        return
+    own_suffix = f"_{os.getpid()}.db"
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.db")):
+        if not path.endswith(own_suffix):
+            os.remove(path)
+
+
+def mark_process_dead(pid: int):
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Запускает HTTP-сервер метрик в отдельном потоке; при port=0 ничего не делает."""
+    if not port:
+        return
+    start_http_server(port, registry=get_registry())
+    logger.info(f"Метрики Prometheus доступны на порту {port} (/metrics)")
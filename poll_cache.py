@@ -0,0 +1,154 @@
+# KorpBot/poll_cache.py
+
+import json
+import os
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from redis.asyncio import Redis
+
+# Кэш текста результатов опроса. Ключ - (poll_id, версия опроса): версия увеличивается при каждом
+# голосе и изменении опроса, поэтому устаревшие записи никогда не читаются и не требуют удаления.
+POLL_CACHE_SIZE = int(os.getenv("POLL_CACHE_SIZE", 256))
+POLL_CACHE_TTL = int(os.getenv("POLL_CACHE_TTL", 3600))
+
+# Общая версия списка опросов: меняется вместе с версией любого опроса, а также при создании и удалении
+POLLS_VERSION_KEY = "polls:version"
+# Случайная метка "поколения" счетчиков версий: если Redis очищен и версии начались заново с нуля,
+# метка тоже меняется, и старые ETag клиентов не совпадут с новыми
+EPOCH_KEY = "polls:epoch"
+
+
+def _version_key(poll_id: int) -> str:
+    return f"poll:{poll_id}:version"
+
+
+def _text_key(poll_id: int, version: int) -> str:
+    return f"poll:{poll_id}:text:{version}"
+
+
+@dataclass(frozen=True)
+class CachedOption:
+    """Легкая замена PollOption для клавиатур: те же поля, но без привязки к сессии БД."""
+    id: int
+    poll_id: int
+    option_text: str
+    votes_count: int
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_local = LRUCache(POLL_CACHE_SIZE)
+stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+
+def get_stats() -> dict:
+    """Счетчики попаданий в кэш (для проверки hit rate)."""
+    total = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+    hits = stats["local_hits"] + stats["redis_hits"]
+    return {**stats, "local_size": len(_local), "hit_rate": hits / total if total else 0.0}
+
+
+async def get_version(redis: Redis, poll_id: int) -> int:
+    version = await redis.get(_version_key(poll_id))
+    return int(version) if version is not None else 0
+
+
+async def get_polls_version(redis: Redis) -> int:
+    version = await redis.get(POLLS_VERSION_KEY)
+    return int(version) if version is not None else 0
+
+
+async def bump_version(redis: Redis, poll_id: int | None = None):
+    """
+    Увеличивает версию опроса (голос, смена статуса, удаление) и общую версию списка опросов.
+    Без poll_id меняется только версия списка (например, при создании опроса).
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        if poll_id is not None:
+            pipe.incr(_version_key(poll_id))
+        pipe.incr(POLLS_VERSION_KEY)
+        await pipe.execute()
+
+
+async def bump_versions(redis: Redis, poll_ids):
+    """Увеличивает версии нескольких опросов сразу (например, после сброса пачки голосов в БД)."""
+    async with redis.pipeline(transaction=True) as pipe:
+        for poll_id in poll_ids:
+            pipe.incr(_version_key(poll_id))
+        pipe.incr(POLLS_VERSION_KEY)
+        await pipe.execute()
+
+
+async def get_epoch(redis: Redis) -> str:
+    epoch = await redis.get(EPOCH_KEY)
+    if epoch is None:
+        await redis.set(EPOCH_KEY, uuid.uuid4().hex[:8], nx=True)
+        epoch = await redis.get(EPOCH_KEY)
+    return epoch
+
+
+async def poll_etag(redis: Redis, poll_id: int) -> str:
+    """ETag данных одного опроса: меняется вместе с версией опроса."""
+    epoch = await get_epoch(redis)
+    return f'"poll-{poll_id}-{epoch}-{await get_version(redis, poll_id)}"'
+
+
+async def polls_etag(redis: Redis) -> str:
+    """ETag списка опросов: меняется при любом изменении любого опроса."""
+    epoch = await get_epoch(redis)
+    return f'"polls-{epoch}-{await get_polls_version(redis)}"'
+
+
+async def lookup(redis: Redis, poll_id: int) -> tuple[int, tuple[str, list[CachedOption]] | None]:
+    """
+    Ищет текст результатов для текущей версии опроса: сначала в памяти процесса, затем в Redis.
+    :return: (версия, (текст, варианты) или None при промахе). Версию нужно передать в store.
+    """
+    version = await get_version(redis, poll_id)
+    cached = _local.get((poll_id, version))
+    if cached is not None:
+        stats["local_hits"] += 1
+        return version, cached
+
+    raw = await redis.get(_text_key(poll_id, version))
+    if raw is not None:
+        data = json.loads(raw)
+        cached = (data["text"], [CachedOption(*option) for option in data["options"]])
+        _local.put((poll_id, version), cached)
+        stats["redis_hits"] += 1
+        return version, cached
+
+    stats["misses"] += 1
+    return version, None
+
+
+async def store(redis: Redis, poll_id: int, version: int, text: str, options: list):
+    """Сохраняет отрендеренный текст для версии, полученной в lookup до рендеринга."""
+    cached_options = [CachedOption(opt.id, opt.poll_id, opt.option_text, opt.votes_count) for opt in options]
+    _local.put((poll_id, version), (text, cached_options))
+    payload = json.dumps({
+        "text": text,
+        "options": [[opt.id, opt.poll_id, opt.option_text, opt.votes_count] for opt in cached_options],
+    }, ensure_ascii=False)
+    await redis.set(_text_key(poll_id, version), payload, ex=POLL_CACHE_TTL)
@@ -0,0 +1,162 @@
+# KorpBot/poll_scheduler.py
+#
+# Открытие и закрытие опросов по расписанию (poll.opens_at / poll.closes_at).
+# Планировщик не опрашивает таблицу по таймеру: он спрашивает у БД ближайший срок (минимум по частичным
+# индексам ix_poll_opens_at / ix_poll_closes_at) и спит до него. Новое расписание будит его через Redis
+# (schedule_changed), поэтому срок, назначенный раньше текущего, тоже не пропускается.
+# На каждом шаге выполняются два UPDATE по индексу, не больше POLL_SCHEDULER_BATCH опросов каждый,
+# и один запрос ближайшего срока - стоимость шага не зависит от числа запланированных опросов.
+# Несколько реплик бота могут работать одновременно: сработавшие опросы берутся с SKIP LOCKED.
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from redis.asyncio import Redis
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import poll_cache
+from database.models import Poll
+
+logger = logging.getLogger(__name__)
+
+POLL_SCHEDULER_ENABLED = os.getenv("POLL_SCHEDULER", "1").lower() in ("1", "true", "yes")
+# Разослать участникам итоги опроса, закрытого по расписанию
+POLL_CLOSE_NOTIFY = os.getenv("POLL_CLOSE_NOTIFY", "0").lower() in ("1", "true", "yes")
+# Сколько опросов открывать/закрывать за шаг; остальные сработавшие обработаются сразу следующим шагом
+POLL_SCHEDULER_BATCH = int(os.getenv("POLL_SCHEDULER_BATCH", 100))
+# Самый долгий сон без пробуждений: страховка на случай потерянного сигнала schedule_changed
+POLL_SCHEDULER_MAX_SLEEP = float(os.getenv("POLL_SCHEDULER_MAX_SLEEP", 300))
+POLL_SCHEDULER_ERROR_RETRY = 5.0
+
+WAKE_KEY = "polls:schedule:wake"
+
+# Открытие: статус true, срок обнуляется (сработавший срок больше не попадает в индекс)
+OPEN_DUE_SQL = text("""
+WITH due AS (
+    SELECT id FROM poll
+    WHERE opens_at <= :now
+    ORDER BY opens_at
+    LIMIT :batch
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE poll SET status = true, opens_at = NULL
+FROM due
+WHERE poll.id = due.id
+RETURNING poll.id
+""")
+
+# Закрытие; was_open - статус до закрытия: итоги рассылаются, только если опрос действительно был открыт
+CLOSE_DUE_SQL = text("""
+WITH due AS (
+    SELECT id, status FROM poll
+    WHERE closes_at <= :now
+    ORDER BY closes_at
+    LIMIT :batch
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE poll SET status = false, closes_at = NULL
+FROM due
+WHERE poll.id = due.id
+RETURNING poll.id, coalesce(due.status, false) AS was_open
+""")
+
+NEXT_DEADLINE_SQL = text("""
+SELECT LEAST(
+    (SELECT min(opens_at) FROM poll WHERE opens_at IS NOT NULL),
+    (SELECT min(closes_at) FROM poll WHERE closes_at IS NOT NULL)
+)
+""")
+
+
+def _to_local(moment: datetime | None) -> datetime | None:
+    # В БД время хранится без часового пояса, в локальном времени сервера (как created_at)
+    if moment is not None and moment.tzinfo is not None:
+        return moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+async def schedule_changed(redis: Redis):
+    """Будит планировщик (в любом процессе), чтобы он пересчитал ближайший срок."""
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(WAKE_KEY, 1)
+        pipe.ltrim(WAKE_KEY, -1, -1)
+        pipe.expire(WAKE_KEY, 3600)
+        await pipe.execute()
+
+
+async def set_schedule(session: AsyncSession, redis: Redis, poll_id: int,
+                       opens_at: datetime | None, closes_at: datetime | None) -> Poll | None:
+    """
+    Задает расписание опроса (None - срок не задан). Опрос с будущим сроком открытия закрывается до этого срока.
+    :return: опрос или None, если он не найден.
+    :raises ValueError: время закрытия не позже времени открытия.
+    """
+    opens_at, closes_at = _to_local(opens_at), _to_local(closes_at)
+    if opens_at is not None and closes_at is not None and closes_at <= opens_at:
+        raise ValueError("Время закрытия должно быть позже времени открытия.")
+    poll = await session.get(Poll, poll_id)
+    if not poll:
+        return None
+    poll.opens_at, poll.closes_at = opens_at, closes_at
+    if opens_at is not None and opens_at > datetime.now():
+        poll.status = False
+    await session.commit()
+    await poll_cache.bump_version(redis, poll_id)
+    await schedule_changed(redis)
+    return poll
+
+
+async def tick(redis: Redis, session_pool: async_sessionmaker,
+               notify_closed: bool = POLL_CLOSE_NOTIFY) -> tuple[int, datetime | None]:
+    """
+    Один шаг: открывает и закрывает опросы с наступившим сроком.
+    :return: число измененных опросов и ближайший оставшийся срок (None - расписаний нет).
+    """
+    now = datetime.now()
+    async with session_pool() as session:
+        opened = list((await session.execute(OPEN_DUE_SQL, {"now": now, "batch": POLL_SCHEDULER_BATCH})).scalars())
+        closed = (await session.execute(CLOSE_DUE_SQL, {"now": now, "batch": POLL_SCHEDULER_BATCH})).all()
+        await session.commit()
+        deadline = await session.scalar(NEXT_DEADLINE_SQL)
+
+    changed = opened + [poll_id for poll_id, _ in closed]
+    if changed:
+        await poll_cache.bump_versions(redis, set(changed))
+        logger.info(f"По расписанию открыто опросов: {len(opened)}, закрыто: {len(closed)}")
+    if notify_closed and closed:
+        # Модуль задач подключает Celery - импортируем его, только когда он нужен (API его не использует)
+        from tasks import notify_poll_results
+        for poll_id, was_open in closed:
+            if was_open:
+                notify_poll_results.delay(poll_id)
+    return len(changed), deadline
+
+
+async def _sleep(redis: Redis, timeout: float):
+    """Спит timeout секунд или до сигнала schedule_changed."""
+    # timeout=0 у BLPOP - ждать бесконечно, поэтому совсем короткий сон округляется вверх
+    if await redis.blpop([WAKE_KEY], timeout=max(timeout, 0.01)):
+        # Несколько изменений подряд - один пересчет
+        await redis.delete(WAKE_KEY)
+
+
+async def run_scheduler(redis: Redis, session_pool: async_sessionmaker, notify_closed: bool = POLL_CLOSE_NOTIFY):
+    """Фоновая задача: открывает и закрывает опросы по расписанию, просыпаясь к ближайшему сроку."""
+    logger.info(f"Запущен планировщик опросов (итоги при закрытии: {'да' if notify_closed else 'нет'}).")
+    while True:
+        try:
+            changed, deadline = await tick(redis, session_pool, notify_closed)
+            timeout = POLL_SCHEDULER_MAX_SLEEP
+            if deadline is not None:
+                timeout = min(max((deadline - datetime.now()).total_seconds(), 0.0), POLL_SCHEDULER_MAX_SLEEP)
+            if timeout == 0 and not changed:
+                # Срок наступил, но опросы сейчас обрабатывает другая реплика - не крутимся вхолостую
+                timeout = 1.0
+            if timeout > 0:
+                await _sleep(redis, timeout)
+        except Exception as e:
+            logger.error(f"Ошибка планировщика опросов: {e}")
+            await asyncio.sleep(POLL_SCHEDULER_ERROR_RETRY)
@@ -1,7 +1,107 @@
+from typing import NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
 from aiogram import types
-from database.models import PollOption, Vote, Poll
+from database.models import PollOption, Poll
+
+# Голос одним запросом: upsert строки vote и атомарная корректировка счетчиков в той же транзакции.
+# prev - голос пользователя на момент начала запроса. DO UPDATE срабатывает, только если
+# заблокированная строка все еще совпадает с prev: если ее успели изменить параллельно,
+# upsert ничего не вернет и запрос будет повторен уже с актуальными данными.
+# Там же обновляются агрегаты опроса: poll_stats (новый голос) и минутные интервалы poll_vote_bucket
+# (голос переносится из интервала прежнего варианта в текущую минуту нового).
+#
+# Порядок выполнения CTE в PostgreSQL не определен, а голоса одного опроса делят "горячие" строки.
+# Чтобы параллельные голоса не блокировали друг друга крест-накрест, строки блокируются всегда в одном
+# порядке: счетчики вариантов по id, затем интервалы по (option_id, bucket_start), затем poll_stats.
+# Каждый шаг начинается с барьера (SELECT count(*) FROM <предыдущий шаг>) >= 0: условие всегда истинно,
+# но вычисляется до первой строки шага и дочитывает предыдущий шаг целиком. Внутри шага порядок задает
+# ORDER BY ... FOR UPDATE. Взаимная блокировка остается возможной только при одновременной вставке
+# новых строк интервалов - на этот случай остается повтор по 40P01.
+RECORD_VOTE_SQL = text("""
+WITH prev AS (
+    SELECT option_id, voted_at FROM vote
+    WHERE poll_id = :poll_id AND user_tg_id = :user_tg_id
+),
+upsert AS (
+    INSERT INTO vote (poll_id, user_tg_id, option_id, voted_at)
+    VALUES (:poll_id, :user_tg_id, :option_id, now())
+    ON CONFLICT (poll_id, user_tg_id) DO UPDATE
+        SET option_id = EXCLUDED.option_id, voted_at = EXCLUDED.voted_at
+        WHERE vote.option_id = (SELECT option_id FROM prev)
+          AND vote.voted_at = (SELECT voted_at FROM prev)
+          AND vote.option_id <> EXCLUDED.option_id
+    RETURNING (xmax = 0) AS inserted
+),
+option_locks AS (
+    SELECT id FROM poll_option
+    WHERE EXISTS (SELECT 1 FROM upsert)
+      AND (id = :option_id
+           OR (id = (SELECT option_id FROM prev) AND EXISTS (SELECT 1 FROM upsert WHERE NOT inserted)))
+    ORDER BY id
+    FOR UPDATE
+),
+counters AS (
+    -- Обновляются только строки, уже заблокированные в option_locks
+    UPDATE poll_option
+    SET votes_count = CASE WHEN id = :option_id THEN votes_count + 1 ELSE GREATEST(votes_count - 1, 0) END
+    WHERE id IN (SELECT id FROM option_locks)
+    RETURNING id
+),
+bucket_locks AS (
+    SELECT option_id FROM poll_vote_bucket
+    WHERE (SELECT count(*) FROM counters) >= 0
+      AND poll_id = :poll_id
+      AND EXISTS (SELECT 1 FROM upsert)
+      AND ((option_id = :option_id AND bucket_start = date_trunc('minute', now()))
+           OR (option_id = (SELECT option_id FROM prev)
+               AND bucket_start = date_trunc('minute', (SELECT voted_at FROM prev))
+               AND EXISTS (SELECT 1 FROM upsert WHERE NOT inserted)))
+    ORDER BY option_id, bucket_start
+    FOR UPDATE
+),
+bucket_in AS (
+    INSERT INTO poll_vote_bucket (poll_id, option_id, bucket_start, votes)
+    SELECT :poll_id, :option_id, date_trunc('minute', now()), 1 FROM upsert
+    WHERE (SELECT count(*) FROM bucket_locks) >= 0
+    ON CONFLICT (poll_id, option_id, bucket_start) DO UPDATE
+        SET votes = poll_vote_bucket.votes + 1
+    RETURNING option_id
+),
+bucket_out AS (
+    UPDATE poll_vote_bucket
+    SET votes = GREATEST(votes - 1, 0)
+    WHERE (SELECT count(*) FROM bucket_locks) >= 0
+      AND poll_id = :poll_id
+      AND option_id = (SELECT option_id FROM prev)
+      AND bucket_start = date_trunc('minute', (SELECT voted_at FROM prev))
+      AND EXISTS (SELECT 1 FROM upsert WHERE NOT inserted)
+    RETURNING option_id
+),
+stats AS (
+    INSERT INTO poll_stats (poll_id, total_votes, updated_at)
+    SELECT :poll_id, 1, now() FROM upsert
+    WHERE inserted AND (SELECT count(*) FROM bucket_in) + (SELECT count(*) FROM bucket_out) >= 0
+    ON CONFLICT (poll_id) DO UPDATE
+        SET total_votes = poll_stats.total_votes + 1, updated_at = EXCLUDED.updated_at
+    RETURNING poll_id
+)
+SELECT
+    (SELECT option_id FROM prev) AS previous_option_id,
+    EXISTS (SELECT 1 FROM upsert) AS changed
+""")
+
+# Коды PostgreSQL, при которых запрос голоса безопасно повторить: deadlock и serialization failure
+_RETRYABLE_SQLSTATES = {"40P01", "40001"}
+RECORD_VOTE_ATTEMPTS = 5
+
+
+class VoteResult(NamedTuple):
+    changed: bool
+    previous_option_id: int | None
+
 
 async def start_new_poll(session: AsyncSession, question: str, options: list) -> int:
     """
@@ -25,48 +125,29 @@ async def start_new_poll(session: AsyncSession, question: str, options: list) ->
         raise
 
 
-async def record_vote(session: AsyncSession, poll_id: int, option_id: int, user: types.User):
+async def record_vote(session: AsyncSession, poll_id: int, option_id: int, user: types.User) -> VoteResult:
     """
     Сохраняет голос пользователя. Если пользователь уже голосовал - обновляет его голос.
+    Выполняется одним запросом (см. RECORD_VOTE_SQL) и корректен при одновременных голосах.
+    :return: VoteResult - изменился ли голос и какой вариант был выбран раньше.
     """
-    try:
-        # Ищем существующий голос пользователя в этом опросе
-        existing_vote_result = await session.execute(
-            select(Vote).filter_by(poll_id=poll_id, user_tg_id=user.id)
-        )
-        user_vote = existing_vote_result.scalars().first()
-
-        if user_vote:
-            # Если пользователь меняет свой выбор
-            if user_vote.option_id != option_id:
-                # Уменьшаем счетчик старого варианта
-                old_option = await session.get(PollOption, user_vote.option_id)
-                if old_option and old_option.votes_count > 0:
-                    old_option.votes_count -= 1
+    params = {"poll_id": poll_id, "user_tg_id": user.id, "option_id": option_id}
+    for attempt in range(1, RECORD_VOTE_ATTEMPTS + 1):
+        try:
+            row = (await session.execute(RECORD_VOTE_SQL, params)).one()
+            await session.commit()
+        except DBAPIError as e:
+            await session.rollback()
+            if getattr(e.orig, "sqlstate", None) in _RETRYABLE_SQLSTATES and attempt < RECORD_VOTE_ATTEMPTS:
+                continue
+            print(f"Ошибка при сохранении голоса: {e}")
+            raise
+        except Exception as e:
+            await session.rollback()
+            print(f"Ошибка при сохранении голоса: {e}")
+            raise
 
-                # Увеличиваем счетчик нового варианта
-                new_option = await session.get(PollOption, option_id)
-                if new_option:
-                    new_option.votes_count += 1
-
-                # Обновляем ID варианта в голосе
-                user_vote.option_id = option_id
-        else:
-            # Пользователь голосует впервые в этом опросе
-            new_vote = Vote(
-                poll_id=poll_id,
-                user_tg_id=user.id, # Используем ID из объекта User
-                option_id=option_id,
-            )
-            session.add(new_vote)
-
-            # Увеличиваем счетчик голосов для выбранного варианта
-            option = await session.get(PollOption, option_id)
-            if option:
-                option.votes_count += 1
-
-        await session.commit()
-    except Exception as e:
-        await session.rollback()
-        print(f"Ошибка при сохранении голоса: {e}")
-        raise
+        if row.changed or row.previous_option_id == option_id:
+            return VoteResult(row.changed, row.previous_option_id)
+        # Голос пользователя изменили параллельно между снимком и блокировкой строки - повторяем
+    raise RuntimeError(f"Не удалось сохранить голос пользователя {user.id} в опросе {poll_id}")
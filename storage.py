@@ -1,28 +1,182 @@
+# KorpBot/storage.py
+#
+# Файловое хранилище опросов - запасной вариант для офлайн-режима и разработки (без PostgreSQL).
+# Данные лежат в двух файлах:
+#   polls.json           - снимок: список опросов в прежнем формате, поэтому старый файл читается как есть
+#   polls.journal.jsonl  - журнал изменений после снимка: по JSON-записи на строку, файл только дописывается
+# Запись стоит O(1) вместо перезаписи всего файла. При загрузке снимок и журнал воспроизводятся в память,
+# а когда в журнале набирается STORAGE_COMPACT_EVERY записей, состояние сжимается в новый снимок.
+#
+# Каждая запись сразу передается ОС (flush), поэтому падение процесса данных не теряет. fsync делается пачками:
+# раз в STORAGE_FSYNC_EVERY записей или если с прошлого fsync прошло STORAGE_FSYNC_INTERVAL секунд - при сбое
+# питания могут пропасть только последние записи. Хранилище рассчитано на один процесс-писатель.
+
+import atexit
+import copy
 import json
+import logging
 import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 DATA_FILE = "polls.json"
+JOURNAL_FILE = "polls.journal.jsonl"
+
+STORAGE_FSYNC_EVERY = int(os.getenv("STORAGE_FSYNC_EVERY", 64))
+STORAGE_FSYNC_INTERVAL = float(os.getenv("STORAGE_FSYNC_INTERVAL", 1.0))
+STORAGE_COMPACT_EVERY = int(os.getenv("STORAGE_COMPACT_EVERY", 1000))
+
+
+class PollJournal:
+    """
+    Опросы в памяти (список, позиция - индекс опроса) плюс журнал изменений на диске.
+    Записи журнала хранят позицию опроса и идемпотентны, поэтому повторное воспроизведение безопасно:
+    если процесс упадет между записью нового снимка и очисткой журнала, данные не задвоятся.
+    """
+
+    def __init__(self, data_file: str = DATA_FILE, journal_file: str = JOURNAL_FILE,
+                 fsync_every: int = STORAGE_FSYNC_EVERY, fsync_interval: float = STORAGE_FSYNC_INTERVAL,
+                 compact_every: int = STORAGE_COMPACT_EVERY):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.polls: list[dict] = []
+        self._journal_records = 0
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._load()
+        self._journal = open(self.journal_file, "a", encoding="utf-8")
+
+    def _load(self):
+        if os.path.exists(self.data_file):
+            with open(self.data_file, "r", encoding="utf-8") as f:
+                self.polls = json.load(f)
+        if not os.path.exists(self.journal_file):
+            return
+
+        valid_size = 0
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    # Недописанная последняя строка: процесс упал посреди записи. Все до нее уже применено
+                    logger.warning(f"Журнал {self.journal_file} обрезан после {self._journal_records} записей: "
+                                   f"поврежденный хвост отброшен.")
+                    break
+                self._apply(record)
+                self._journal_records += 1
+                valid_size += len(line)
+        if valid_size < os.path.getsize(self.journal_file):
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(valid_size)
+
+    def _apply(self, record: dict):
+        index = record["index"]
+        if record["op"] == "add":
+            if index < len(self.polls):
+                self.polls[index] = record["poll"]
+            elif index == len(self.polls):
+                self.polls.append(record["poll"])
+            else:
+                raise RuntimeError(f"Пропуск в журнале {self.journal_file}: опрос {index} "
+                                   f"при {len(self.polls)} известных")
+        elif record["op"] == "votes":
+            self.polls[index]["votes"] = record["votes"]
+
+    def _append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False)
+        # В память попадает то же, что прочитается из журнала после перезапуска, и не ссылка на объект вызывающего
+        self._apply(json.loads(line))
+        self._journal.write(line + "\n")
+        self._journal.flush()
+        self._journal_records += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._synced_at >= self.fsync_interval:
+            self._fsync()
+        if self._journal_records >= self.compact_every:
+            self._compact()
+
+    def _fsync(self):
+        if self._unsynced:
+            os.fsync(self._journal.fileno())
+            self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _compact(self):
+        """Пишет снимок во временный файл, атомарно подменяет им старый и очищает журнал."""
+        tmp_file = f"{self.data_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.polls, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.data_file)
+        self._journal.close()
+        self._journal = open(self.journal_file, "w", encoding="utf-8")
+        self._journal_records = 0
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        logger.info(f"Журнал опросов сжат в снимок {self.data_file}: {len(self.polls)} опросов.")
+
+    def load(self) -> list[dict]:
+        with self._lock:
+            # Копия: вызывающий код может менять опросы, не затрагивая хранилище
+            return copy.deepcopy(self.polls)
+
+    def add_poll(self, poll: dict):
+        with self._lock:
+            self._append({"op": "add", "index": len(self.polls), "poll": poll})
+
+    def update_last_votes(self, votes) -> bool:
+        with self._lock:
+            if not self.polls:
+                return False
+            self._append({"op": "votes", "index": len(self.polls) - 1, "votes": votes})
+            return True
+
+    def compact(self):
+        with self._lock:
+            self._fsync()
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._journal.closed:
+                return
+            self._fsync()
+            self._journal.close()
+
+
+_store: PollJournal | None = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> PollJournal:
+    # Файлы открываются при первом обращении, а не при импорте модуля
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PollJournal()
+            atexit.register(_store.close)
+        return _store
 
 
 def load_polls():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+    return _get_store().load()
 
 
 def save_poll(poll):
-    """Добавляет опрос в файл"""
-    polls = load_polls()
-    polls.append(poll)
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(polls, f, ensure_ascii=False, indent=4)
+    """Добавляет опрос в хранилище"""
+    _get_store().add_poll(poll)
 
 
 def update_last_poll_votes(votes):
     """Обновляет голоса последнего опроса"""
-    polls = load_polls()
-    if polls:
-        polls[-1]["votes"] = votes
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(polls, f, ensure_ascii=False, indent=4)
+    _get_store().update_last_votes(votes)
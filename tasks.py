@@ -1,119 +1,219 @@
-import asyncio
 import os
 import logging
+import time
 
 from aiogram import Bot
-from aiogram.client.default import DefaultBotProperties  # <-- ИСПРАВЛЕНИЕ: Добавлен импорт
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from worker import celery_app
+from worker_runtime import runtime
+from broadcaster import BroadcastEngine, BroadcastStats, RedisRateLimiter
+import broadcast_state
+import metrics
 from database.main import async_session
+from database.audience import Audience
 from database.models import Poll
 from database import crud
 
 logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Размер шарда (пользователей на одну задачу) и частота сохранения контрольной точки внутри шарда
+BROADCAST_SHARD_SIZE = int(os.getenv("BROADCAST_SHARD_SIZE", 5000))
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", 500))
+
 
 @celery_app.task
 def notify_users_about_new_poll(poll_id: int):
     logger.info(f"Запущена задача на уведомление о новом опросе ID: {poll_id}")
-    asyncio.run(send_notifications(poll_id))
+    return runtime.run(send_notifications(poll_id))
 
 
 async def send_notifications(poll_id: int):
-    if not BOT_TOKEN:
-        logger.error("Не найден BOT_TOKEN в задаче рассылки. Рассылка отменена.")
-        return
-
-    # ИСПРАВЛЕНИЕ: Обновлен синтаксис инициализации бота
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    poll_title = ""
-    users_to_notify = []
-
     async with async_session() as session:
         poll = await session.get(Poll, poll_id)
         if not poll:
             logger.error(f"Опрос ID {poll_id} не найден в БД. Рассылка отменена.")
-            await bot.session.close()
             return
         poll_title = poll.title
-        users_to_notify = await crud.get_all_users(session)
-
-    if not users_to_notify:
-        logger.warning("Нет пользователей для уведомления.")
-        await bot.session.close()
-        return
-
-    logger.info(f"Начинается рассылка по опросу '{poll_title}' для {len(users_to_notify)} пользователей.")
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🙋‍♂️ Пройти опрос", callback_data=f"poll_{poll_id}")]
-    ])
-
-    successful_sends = 0
-    failed_sends = 0
-
-    for user in users_to_notify:
-        try:
-            await bot.send_message(
-                chat_id=user.user_tg_id,
-                text=f"📢 <b>Новый опрос!</b>\n\n- <i>{poll_title}</i>\n\nПримите участие, ваше мнение важно!",
-                reply_markup=keyboard
-            )
-            successful_sends += 1
-            await asyncio.sleep(0.1)
-        except (TelegramBadRequest, TelegramForbiddenError) as e:
-            logger.warning(f"Не удалось отправить сообщение пользователю {user.user_tg_id}: {e}")
-            failed_sends += 1
-        except Exception as e:
-            logger.error(f"Непредвиденная ошибка при отправке пользователю {user.user_tg_id}: {e}")
-            failed_sends += 1
-
-    logger.info(f"Рассылка завершена. Успешно: {successful_sends}, Ошибок: {failed_sends}")
-    await bot.session.close()
+
+    return await plan_broadcast("poll", {"poll_id": poll_id, "title": poll_title})
 
 
 @celery_app.task
-def broadcast_message_task(message_text: str):
+def broadcast_message_task(message_text: str, audience: dict | None = None):
     logger.info("Запущена задача на массовую рассылку сообщения.")
-    asyncio.run(send_broadcast(message_text))
+    return runtime.run(send_broadcast(message_text, Audience.from_dict(audience)))
+
+
+async def send_broadcast(message_text: str, audience: Audience | None = None):
+    return await plan_broadcast("message", {"text": message_text}, audience)
+
+
+@celery_app.task
+def remind_non_voters_task(poll_id: int):
+    logger.info(f"Запущена задача на напоминание об опросе ID: {poll_id}")
+    return runtime.run(send_reminder(poll_id))
+
+
+async def send_reminder(poll_id: int):
+    """Напоминание об активном опросе только тем, кто в нем еще не голосовал."""
+    async with async_session() as session:
+        poll = await session.get(Poll, poll_id)
+        if not poll or not poll.status:
+            logger.error(f"Опрос ID {poll_id} не найден или завершен. Напоминание отменено.")
+            return None
+        poll_title = poll.title
+
+    return await plan_broadcast("reminder", {"poll_id": poll_id, "title": poll_title},
+                                Audience(not_voted_poll_id=poll_id))
+
+
+@celery_app.task
+def notify_poll_results(poll_id: int):
+    logger.info(f"Запущена задача на рассылку итогов опроса ID: {poll_id}")
+    return runtime.run(send_poll_results(poll_id))
+
 
+async def send_poll_results(poll_id: int):
+    """Итоги завершенного опроса - только его участникам."""
+    async with async_session() as session:
+        poll = await session.get(Poll, poll_id)
+        if not poll:
+            logger.error(f"Опрос ID {poll_id} не найден в БД. Рассылка итогов отменена.")
+            return None
+        poll_title = poll.title
 
-async def send_broadcast(message_text: str):
+    return await plan_broadcast("results", {"poll_id": poll_id, "title": poll_title},
+                                Audience(voted_poll_id=poll_id))
+
+
+async def plan_broadcast(kind: str, payload: dict, audience: Audience | None = None) -> int | None:
+    """
+    Делит пользователей аудитории на диапазоны user_tg_id и ставит по задаче send_broadcast_shard на каждый шард.
+    Возвращает ID рассылки, по которому можно смотреть прогресс (/broadcast_status).
+    """
     if not BOT_TOKEN:
         logger.error("Не найден BOT_TOKEN в задаче рассылки. Рассылка отменена.")
-        return
-
-    # ИСПРАВЛЕНИЕ: Обновлен синтаксис инициализации бота
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    users_to_notify = []
+        return None
 
+    audience = audience or Audience()
     async with async_session() as session:
-        users_to_notify = await crud.get_all_users(session)
-
-    if not users_to_notify:
-        logger.warning("Нет пользователей для рассылки.")
-        await bot.session.close()
-        return
-
-    logger.info(f"Начинается рассылка сообщения для {len(users_to_notify)} пользователей.")
-
-    successful_sends = 0
-    failed_sends = 0
-
-    for user in users_to_notify:
-        try:
-            await bot.send_message(chat_id=user.user_tg_id, text=message_text)
-            successful_sends += 1
-            await asyncio.sleep(0.1)
-        except (TelegramBadRequest, TelegramForbiddenError) as e:
-            logger.warning(f"Не удалось отправить сообщение пользователю {user.user_tg_id}: {e}")
-            failed_sends += 1
-        except Exception as e:
-            logger.error(f"Непредвиденная ошибка при отправке пользователю {user.user_tg_id}: {e}")
-            failed_sends += 1
-
-    logger.info(f"Массовая рассылка завершена. Успешно: {successful_sends}, Ошибок: {failed_sends}")
-    await bot.session.close()
\ No newline at end of file
+        users_count = await crud.count_users(session, reachable_only=True, audience=audience)
+        bounds = await crud.get_user_id_shard_bounds(session, BROADCAST_SHARD_SIZE, audience)
+
+    if not users_count:
+        logger.warning(f"Нет пользователей для рассылки (аудитория: {audience.describe()}).")
+        return None
+
+    shards = list(zip([None] + bounds, bounds + [None]))
+    broadcast_id = await broadcast_state.create_broadcast(runtime.redis, kind, payload, len(shards), users_count,
+                                                          audience.to_dict())
+
+    for shard, (after_id, until_id) in enumerate(shards):
+        send_broadcast_shard.delay(broadcast_id, shard, after_id, until_id)
+
+    logger.info(f"Рассылка ID {broadcast_id} ({kind}) для {users_count} пользователей "
+                f"(аудитория: {audience.describe()}) разбита на {len(shards)} шардов.")
+    return broadcast_id
+
+
+def _make_sender(bot: Bot, kind: str, payload: dict):
+    """Возвращает функцию send(chat_id) для рассылки заданного типа."""
+    if kind in ("poll", "reminder"):
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🙋‍♂️ Пройти опрос", callback_data=f"poll_{payload['poll_id']}")]
+        ])
+        if kind == "poll":
+            text = f"📢 <b>Новый опрос!</b>\n\n- <i>{payload['title']}</i>\n\nПримите участие, ваше мнение важно!"
+        else:
+            text = f"⏰ <b>Напоминание</b>\n\nВы еще не прошли опрос:\n- <i>{payload['title']}</i>\n\nЭто займет минуту!"
+
+        async def send(chat_id: int):
+            await bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+    elif kind == "results":
+        # Кнопка открывает актуальные итоги (refresh_results), а не снимок на момент рассылки
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📊 Посмотреть итоги", callback_data=f"results_{payload['poll_id']}")]
+        ])
+        text = f"🏁 <b>Опрос завершен</b>\n\n- <i>{payload['title']}</i>\n\nСпасибо за участие!"
+
+        async def send(chat_id: int):
+            await bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+    else:
+        async def send(chat_id: int):
+            await bot.send_message(chat_id=chat_id, text=payload["text"])
+    return send
+
+
+def _record_broadcast_metrics(kind: str, stats: BroadcastStats):
+    metrics.BROADCAST_MESSAGES.labels(kind, "sent").inc(stats.sent)
+    metrics.BROADCAST_MESSAGES.labels(kind, "failed").inc(stats.failed)
+    metrics.BROADCAST_RETRY_AFTER_PAUSES.labels(kind).inc(stats.retry_after_pauses)
+
+
+# acks_late + reject_on_worker_lost: если воркер упал посреди шарда, задача вернется в очередь
+# и продолжит работу с последней контрольной точки, а не начнет шард заново.
+# Блокировку упавшего воркера никто не снимет, поэтому вернувшаяся задача откладывается до ее истечения
+# (max_retries=None: блокировка всегда либо истекает, либо снимается завершенным шардом).
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=None)
+def send_broadcast_shard(self, broadcast_id: int, shard: int, after_id: int | None, until_id: int | None):
+    logger.info(f"Запущен шард {shard} рассылки ID {broadcast_id}: user_tg_id в ({after_id}, {until_id}]")
+    try:
+        return runtime.run(run_broadcast_shard(broadcast_id, shard, after_id, until_id))
+    except broadcast_state.ShardLocked as e:
+        logger.info(f"{e}. Повтор через {e.retry_in} с.")
+        raise self.retry(exc=e, countdown=e.retry_in)
+
+
+async def run_broadcast_shard(broadcast_id: int, shard: int, after_id: int | None, until_id: int | None):
+    # Бот, Redis и пул БД общие для всех задач процесса и не закрываются после шарда (см. worker_runtime.py)
+    redis_client = runtime.redis
+    bot = runtime.bot
+    meta = await broadcast_state.get_broadcast(redis_client, broadcast_id)
+    if not meta:
+        logger.error(f"Рассылка ID {broadcast_id} не найдена в Redis. Шард {shard} пропущен.")
+        return None
+    token = await broadcast_state.acquire_shard(redis_client, broadcast_id, shard)
+    if token is None:
+        logger.info(f"Шард {shard} рассылки ID {broadcast_id} уже завершен. Пропуск.")
+        return None
+
+    checkpoint = await broadcast_state.get_checkpoint(redis_client, broadcast_id, shard)
+    if checkpoint is not None:
+        logger.info(f"Шард {shard} рассылки ID {broadcast_id} продолжается с user_tg_id > {checkpoint}")
+        after_id = checkpoint
+
+    send = _make_sender(bot, meta["kind"], meta["payload"])
+    audience = Audience.from_dict(meta["audience"])
+    engine = BroadcastEngine(bucket=RedisRateLimiter(redis_client), record_deliveries=True)
+    totals = BroadcastStats()
+
+    try:
+        async for batch in crud.iter_user_id_batches(async_session, BROADCAST_CHECKPOINT_EVERY, after_id, until_id,
+                                                     audience):
+            stats = await engine.run(batch, send)
+            # Журнал пишется до контрольной точки: после сбоя пачка отправится заново и перезапишет его
+            marked = await crud.record_deliveries(async_session, broadcast_id, stats.deliveries, redis_client)
+            if marked:
+                logger.info(f"Рассылка ID {broadcast_id}: {marked} пользователей недоступны и исключены из рассылок.")
+            owned = await broadcast_state.save_progress(redis_client, broadcast_id, shard, token, batch[-1],
+                                                        stats.sent, stats.failed)
+            totals.merge(stats)
+            _record_broadcast_metrics(meta["kind"], stats)
+            if not owned:
+                # Задача зависла дольше срока блокировки, и шард уже продолжает другая задача
+                logger.warning(f"Блокировка шарда {shard} рассылки ID {broadcast_id} перехвачена другой задачей. "
+                               f"Шард остановлен. {totals.summary()}")
+                return None
+    except BaseException:
+        await broadcast_state.release_shard(redis_client, broadcast_id, shard, token)
+        raise
+
+    if not await broadcast_state.finish_shard(redis_client, broadcast_id, shard, token):
+        logger.warning(f"Блокировка шарда {shard} рассылки ID {broadcast_id} перехвачена другой задачей. "
+                       f"Шард завершит она.")
+        return None
+    totals.finished_at = time.monotonic()
+    logger.info(f"Шард {shard} рассылки ID {broadcast_id} завершен. {totals.summary()}")
+    return totals.as_dict()
@@ -0,0 +1,322 @@
+# KorpBot/update_stream.py
+#
+# Раздача апдейтов нескольким процессам-обработчикам через Redis Streams.
+#
+# Ингестер (main.py с BOT_MODE=ingest) забирает апдейты у Telegram и складывает их в STREAM_PARTITIONS
+# потоков по chat_id, поэтому апдейты одного чата всегда попадают в один поток и обрабатываются по порядку.
+# Обработчики (python update_stream.py work, сколько угодно процессов) делят потоки между собой через
+# аренду в Redis: каждый поток в любой момент читает один процесс, апдейты в нем обрабатываются
+# последовательно, а разные потоки - параллельно. Апдейт подтверждается (XACK) только после обработки:
+# если процесс упал, его аренда истекает, и новый владелец потока забирает неподтвержденные апдейты
+# через XAUTOCLAIM.
+#
+#   python update_stream.py work     - запустить обработчик
+#   python update_stream.py stats    - отставание и скорость по потокам и обработчикам
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import signal
+import socket
+import sys
+import time
+import uuid
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+STREAM_PARTITIONS = int(os.getenv("STREAM_PARTITIONS", 16))
+# Примерный предел длины каждого потока (старые подтвержденные апдейты отбрасываются)
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 100_000))
+# Через сколько секунд без продления аренда потока считается брошенной
+STREAM_LEASE_TTL = int(os.getenv("STREAM_LEASE_TTL", 15))
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", 20))
+
+GROUP = "bot-workers"
+WORKERS_KEY = "updates:workers"
+
+
+def stream_key(partition: int) -> str:
+    return f"updates:stream:{partition}"
+
+
+def _lease_key(partition: int) -> str:
+    return f"updates:lease:{partition}"
+
+
+def _worker_stats_key(worker_id: str) -> str:
+    return f"updates:worker:{worker_id}"
+
+
+def partition_for(update: Update) -> int:
+    """Номер потока для апдейта: по чату, а если чата нет (inline и т.п.) - по пользователю."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id % STREAM_PARTITIONS
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    user = getattr(event, "from_user", None)
+    key = chat.id if chat else user.id if user else update.update_id
+    return key % STREAM_PARTITIONS
+
+
+# --- ИНГЕСТЕР ---
+
+async def run_ingester(bot: Bot, redis: Redis, dp: Dispatcher, polling_timeout: int = 30):
+    """
+    Забирает апдейты через getUpdates и складывает их в потоки. offset сдвигается только после
+    записи пачки в Redis, поэтому при падении ингестера Telegram отдаст апдейты повторно.
+    """
+    await bot.delete_webhook(drop_pending_updates=False)
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    logger.info(f"Ингестер запущен: {STREAM_PARTITIONS} потоков апдейтов.")
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=polling_timeout,
+                                            allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(1)
+            continue
+        if not updates:
+            continue
+        async with redis.pipeline(transaction=False) as pipe:
+            for update in updates:
+                pipe.xadd(stream_key(partition_for(update)),
+                          {"update": update.model_dump_json(exclude_none=True)},
+                          maxlen=STREAM_MAXLEN, approximate=True)
+            await pipe.execute()
+        offset = updates[-1].update_id + 1
+
+
+# --- ОБРАБОТЧИК ---
+
+# Продление и снятие аренды только своим владельцем
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class StreamWorker:
+    """
+    Процесс-обработчик: арендует свою долю потоков (примерно STREAM_PARTITIONS / число живых обработчиков)
+    и для каждого арендованного потока крутит отдельный цикл чтения через группу потребителей.
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, redis: Redis):
+        self.bot = bot
+        self.dp = dp
+        self.redis = redis
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:4]}"
+        self.partitions: dict[int, asyncio.Task] = {}
+        # Потоки, которые нужно отдать: цикл чтения завершит текущую пачку и остановится
+        self.releasing: set[int] = set()
+        self.processed = 0
+        self.failed = 0
+
+    async def _ensure_group(self, partition: int):
+        try:
+            await self.redis.xgroup_create(stream_key(partition), GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _handle(self, partition: int, entry_id: str, fields: dict):
+        try:
+            update = Update.model_validate(json.loads(fields["update"]), context={"bot": self.bot})
+            await self.dp.feed_update(self.bot, update)
+            self.processed += 1
+        except Exception as e:
+            # Апдейт все равно подтверждается: повторная обработка "ядовитого" апдейта заблокировала бы поток
+            self.failed += 1
+            logger.error(f"Ошибка обработки апдейта {entry_id} из потока {partition}: {e}", exc_info=True)
+        await self.redis.xack(stream_key(partition), GROUP, entry_id)
+
+    async def _consume(self, partition: int):
+        key = stream_key(partition)
+        try:
+            await self._ensure_group(partition)
+            # Сначала - апдейты, которые прежний владелец получил, но не успел подтвердить (по порядку ID)
+            start = "0-0"
+            while partition not in self.releasing:
+                start, entries, *_ = await self.redis.xautoclaim(key, GROUP, self.worker_id, min_idle_time=0,
+                                                                start_id=start, count=STREAM_BATCH)
+                for entry_id, fields in entries:
+                    if fields:
+                        await self._handle(partition, entry_id, fields)
+                if start == "0-0":
+                    break
+            await self._forget_idle_consumers(key)
+
+            while partition not in self.releasing:
+                response = await self.redis.xreadgroup(GROUP, self.worker_id, {key: ">"},
+                                                       count=STREAM_BATCH, block=1000)
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        await self._handle(partition, entry_id, fields)
+        finally:
+            await self.redis.eval(_RELEASE_SCRIPT, 1, _lease_key(partition), self.worker_id)
+
+    async def _forget_idle_consumers(self, key: str):
+        """Удаляет из группы потребителей завершившихся процессов (их апдейты уже перехвачены)."""
+        for consumer in await self.redis.xinfo_consumers(key, GROUP):
+            if (consumer["name"] != self.worker_id and consumer["pending"] == 0
+                    and consumer["idle"] > STREAM_LEASE_TTL * 1000):
+                await self.redis.xgroup_delconsumer(key, GROUP, consumer["name"])
+
+    def _start_partition(self, partition: int):
+        task = asyncio.create_task(self._consume(partition))
+        task.add_done_callback(lambda t, p=partition: self._on_partition_done(p, t))
+        self.partitions[partition] = task
+        logger.info(f"Обработчик {self.worker_id}: взят поток {partition}")
+
+    def _on_partition_done(self, partition: int, task: asyncio.Task):
+        self.partitions.pop(partition, None)
+        self.releasing.discard(partition)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Цикл чтения потока {partition} завершился с ошибкой: {task.exception()}")
+        else:
+            logger.info(f"Обработчик {self.worker_id}: поток {partition} отдан")
+
+    async def _rebalance(self):
+        now = time.time()
+        await self.redis.zadd(WORKERS_KEY, {self.worker_id: now})
+        await self.redis.zremrangebyscore(WORKERS_KEY, "-inf", now - STREAM_LEASE_TTL)
+        alive = max(await self.redis.zcard(WORKERS_KEY), 1)
+        share = math.ceil(STREAM_PARTITIONS / alive)
+
+        for partition in list(self.partitions):
+            renewed = await self.redis.eval(_RENEW_SCRIPT, 1, _lease_key(partition),
+                                            self.worker_id, STREAM_LEASE_TTL)
+            if not renewed:
+                # Аренду потеряли (например, процесс долго висел) - поток уже читает кто-то другой
+                logger.warning(f"Обработчик {self.worker_id}: потеряна аренда потока {partition}")
+                self.partitions[partition].cancel()
+
+        active = [p for p in self.partitions if p not in self.releasing]
+        # Отдаем лишние потоки, когда появились новые обработчики
+        for partition in active[share:]:
+            self.releasing.add(partition)
+        # Добираем свободные потоки до своей доли
+        for partition in range(STREAM_PARTITIONS):
+            if len(self.partitions) >= share:
+                break
+            if partition in self.partitions:
+                continue
+            if await self.redis.set(_lease_key(partition), self.worker_id, nx=True, ex=STREAM_LEASE_TTL):
+                self._start_partition(partition)
+
+    async def _publish_stats(self, interval: float, previous: int) -> int:
+        await self.redis.hset(_worker_stats_key(self.worker_id), mapping={
+            "partitions": ",".join(map(str, sorted(self.partitions))),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rate": round((self.processed - previous) / interval, 2),
+            "updated_at": time.time(),
+        })
+        await self.redis.expire(_worker_stats_key(self.worker_id), STREAM_LEASE_TTL * 4)
+        return self.processed
+
+    async def run(self):
+        interval = STREAM_LEASE_TTL / 3
+        logger.info(f"Обработчик апдейтов {self.worker_id} запущен.")
+        previous = 0
+        try:
+            while True:
+                try:
+                    await self._rebalance()
+                    previous = await self._publish_stats(interval, previous)
+                except Exception as e:
+                    logger.error(f"Ошибка распределения потоков: {e}")
+                await asyncio.sleep(interval)
+        finally:
+            # Дорабатываем текущие пачки и освобождаем потоки для других обработчиков
+            self.releasing.update(self.partitions)
+            await asyncio.gather(*self.partitions.values(), return_exceptions=True)
+            await self.redis.zrem(WORKERS_KEY, self.worker_id)
+
+
+async def get_stream_stats(redis: Redis) -> dict:
+    """Отставание по потокам (необработанные и неподтвержденные апдейты) и скорость обработчиков."""
+    partitions = []
+    for partition in range(STREAM_PARTITIONS):
+        key = stream_key(partition)
+        if not await redis.exists(key):
+            continue
+        groups = {group["name"]: group for group in await redis.xinfo_groups(key)}
+        group = groups.get(GROUP, {})
+        partitions.append({
+            "partition": partition,
+            "length": await redis.xlen(key),
+            "lag": group.get("lag"),
+            "pending": group.get("pending", 0),
+            "owner": await redis.get(_lease_key(partition)),
+        })
+    workers = []
+    for worker_id in await redis.zrange(WORKERS_KEY, 0, -1):
+        stats = await redis.hgetall(_worker_stats_key(worker_id))
+        workers.append({"worker": worker_id, **stats})
+    return {"partitions": partitions, "workers": workers}
+
+
+async def _work():
+    # main.py содержит настройку диспетчера (роутеры, middleware, хранилище FSM)
+    from main import build_dispatcher, BOT_TOKEN, REDIS_HOST, REDIS_PORT
+    from aiogram.client.default import DefaultBotProperties
+    import metrics
+
+    metrics.start_metrics_server()
+    redis = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    dp = build_dispatcher(redis)
+    worker = StreamWorker(bot, dp, redis)
+    task = asyncio.create_task(worker.run())
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await bot.session.close()
+    await redis.aclose()
+
+
+async def _stats():
+    redis = Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", 6379)),
+                  decode_responses=True)
+    stats = await get_stream_stats(redis)
+    print("Потоки:")
+    for p in stats["partitions"]:
+        print(f"  {p['partition']:>3}: длина {p['length']}, отставание {p['lag']}, "
+              f"не подтверждено {p['pending']}, владелец {p['owner'] or '-'}")
+    print("Обработчики:")
+    for w in stats["workers"]:
+        print(f"  {w['worker']}: потоки [{w.get('partitions', '')}], обработано {w.get('processed', 0)}, "
+              f"ошибок {w.get('failed', 0)}, скорость {w.get('rate', 0)}/с")
+    await redis.aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    parser = argparse.ArgumentParser(description="Обработка апдейтов из Redis Streams")
+    parser.add_argument("command", choices=["work", "stats"])
+    args = parser.parse_args()
+    asyncio.run(_work() if args.command == "work" else _stats())
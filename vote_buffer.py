@@ -0,0 +1,314 @@
+# KorpBot/vote_buffer.py
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import Counter
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+
+from database.models import PollOption, Vote
+import poll_cache
+
+logger = logging.getLogger(__name__)
+
+# Режим "write-behind": голоса сначала пишутся в Redis, а в PostgreSQL попадают пачками фоновым флашером.
+WRITE_BEHIND = os.getenv("VOTES_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+FLUSH_INTERVAL = float(os.getenv("VOTES_FLUSH_INTERVAL", 2.0))
+
+PENDING_KEY = "votes:pending"
+FLUSHING_PREFIX = "votes:flushing:"
+FLUSH_LOCK_KEY = "votes:flush_lock"
+FLUSH_LOCK_TTL = 60
+
+
+def _tally_key(poll_id: int) -> str:
+    return f"poll:{poll_id}:tally"
+
+
+def _voters_key(poll_id: int) -> str:
+    return f"poll:{poll_id}:voters"
+
+
+def _loaded_key(poll_id: int) -> str:
+    return f"poll:{poll_id}:loaded"
+
+
+# KEYS: tally, voters, pending, loaded; ARGV: user_id, option_id, pending_field
+# Возвращает -1, если состояние опроса еще не загружено в Redis, 0 - голос не изменился, 1 - голос учтен.
+_RECORD_SCRIPT = """
+if redis.call('EXISTS', KEYS[4]) == 0 then
+    return -1
+end
+local prev = redis.call('HGET', KEYS[2], ARGV[1])
+if prev == ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+if prev then
+    redis.call('HINCRBY', KEYS[1], prev, -1)
+end
+redis.call('HSET', KEYS[3], ARGV[3], ARGV[2])
+return 1
+"""
+
+# KEYS: lock; ARGV: token
+# Снимает блокировку, только если она все еще наша: если пачка писалась дольше FLUSH_LOCK_TTL, блокировка
+# истекла и ее уже мог взять другой флашер - удалять ее нельзя.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Пачка голосов из Redis: голоса за удаленные варианты и от неизвестных пользователей отбрасываются.
+# Агрегаты (votes_count, poll_vote_bucket, poll_stats) корректируются на изменения из самой пачки, как в
+# poll_state.RECORD_VOTE_SQL: новый голос дает +1, перенесенный голос - еще и -1 прежнему варианту в интервале
+# прежнего голоса. Стоимость сброса зависит от размера пачки, а не от числа голосов в опросе.
+# prev читается из того же снимка, что и upsert, то есть до записи пачки; каждая строка агрегатов
+# меняется в запросе один раз - изменения заранее суммируются по ключу.
+FLUSH_VOTES_SQL = text("""
+WITH batch AS (
+    SELECT v.poll_id, v.user_tg_id, v.option_id
+    FROM unnest(CAST(:poll_ids AS integer[]), CAST(:user_ids AS bigint[]), CAST(:option_ids AS integer[]))
+        AS v(poll_id, user_tg_id, option_id)
+    JOIN poll_option po ON po.id = v.option_id AND po.poll_id = v.poll_id
+    JOIN bot_user bu ON bu.user_tg_id = v.user_tg_id
+),
+prev AS (
+    SELECT vote.poll_id, vote.user_tg_id, vote.option_id, vote.voted_at
+    FROM vote
+    JOIN batch ON batch.poll_id = vote.poll_id AND batch.user_tg_id = vote.user_tg_id
+),
+upsert AS (
+    INSERT INTO vote (poll_id, user_tg_id, option_id)
+    SELECT poll_id, user_tg_id, option_id FROM batch
+    ON CONFLICT (poll_id, user_tg_id) DO UPDATE
+        SET option_id = EXCLUDED.option_id, voted_at = EXCLUDED.voted_at
+        WHERE vote.option_id <> EXCLUDED.option_id
+    RETURNING poll_id, user_tg_id, option_id, voted_at, (xmax = 0) AS inserted
+),
+deltas AS (
+    SELECT poll_id, option_id, date_trunc('minute', voted_at) AS bucket_start, 1 AS delta FROM upsert
+    UNION ALL
+    SELECT prev.poll_id, prev.option_id, date_trunc('minute', prev.voted_at), -1
+    FROM upsert
+    JOIN prev ON prev.poll_id = upsert.poll_id AND prev.user_tg_id = upsert.user_tg_id
+    WHERE NOT upsert.inserted
+),
+counters AS (
+    UPDATE poll_option
+    SET votes_count = GREATEST(coalesce(votes_count, 0) + d.delta, 0)
+    FROM (SELECT option_id, sum(delta) AS delta FROM deltas GROUP BY option_id) d
+    WHERE poll_option.id = d.option_id AND d.delta <> 0
+    RETURNING poll_option.id
+),
+bucket_in AS (
+    INSERT INTO poll_vote_bucket (poll_id, option_id, bucket_start, votes)
+    SELECT poll_id, option_id, bucket_start, sum(delta) FROM deltas
+    GROUP BY poll_id, option_id, bucket_start
+    HAVING sum(delta) > 0
+    ON CONFLICT (poll_id, option_id, bucket_start) DO UPDATE
+        SET votes = poll_vote_bucket.votes + EXCLUDED.votes
+    RETURNING option_id
+),
+bucket_out AS (
+    UPDATE poll_vote_bucket b
+    SET votes = GREATEST(b.votes + d.delta, 0)
+    FROM (
+        SELECT poll_id, option_id, bucket_start, sum(delta) AS delta FROM deltas
+        GROUP BY poll_id, option_id, bucket_start
+        HAVING sum(delta) < 0
+    ) d
+    WHERE b.poll_id = d.poll_id AND b.option_id = d.option_id AND b.bucket_start = d.bucket_start
+    RETURNING b.option_id
+),
+stats AS (
+    INSERT INTO poll_stats (poll_id, total_votes, updated_at)
+    SELECT poll_id, count(*), now() FROM upsert WHERE inserted GROUP BY poll_id
+    ON CONFLICT (poll_id) DO UPDATE
+        SET total_votes = poll_stats.total_votes + EXCLUDED.total_votes, updated_at = EXCLUDED.updated_at
+    RETURNING poll_id
+)
+SELECT count(*) FROM upsert
+""")
+
+
+async def _acquire_flush_lock(redis: Redis) -> str | None:
+    """Берет блокировку флашера. :return: токен владельца или None, если блокировка занята."""
+    token = uuid.uuid4().hex
+    if await redis.set(FLUSH_LOCK_KEY, token, nx=True, ex=FLUSH_LOCK_TTL):
+        return token
+    return None
+
+
+async def _release_flush_lock(redis: Redis, token: str):
+    await redis.eval(_RELEASE_LOCK_SCRIPT, 1, FLUSH_LOCK_KEY, token)
+
+
+async def load_poll(redis: Redis, session: AsyncSession, poll_id: int):
+    """
+    Загружает голоса опроса из PostgreSQL в Redis. Еще не сброшенные в БД голоса
+    накладываются поверх, поэтому счетчики в Redis остаются точными.
+    Выполняется под блокировкой флашера, чтобы пачка не "проскочила" между чтением БД и очереди.
+    """
+    while not (token := await _acquire_flush_lock(redis)):
+        await asyncio.sleep(0.05)
+    try:
+        if await redis.exists(_loaded_key(poll_id)):
+            return
+
+        option_ids = (await session.execute(
+            select(PollOption.id).filter(PollOption.poll_id == poll_id)
+        )).scalars().all()
+        voters = {
+            user_tg_id: option_id for user_tg_id, option_id in (await session.execute(
+                select(Vote.user_tg_id, Vote.option_id).filter(Vote.poll_id == poll_id)
+            )).all()
+        }
+        prefix = f"{poll_id}:"
+        leftovers = sorted([key async for key in redis.scan_iter(match=f"{FLUSHING_PREFIX}*")])
+        for key in leftovers + [PENDING_KEY]:
+            async for field, option_id in redis.hscan_iter(key, match=f"{prefix}*"):
+                voters[int(field[len(prefix):])] = int(option_id)
+
+        tally = Counter(voters.values())
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(_tally_key(poll_id), _voters_key(poll_id))
+            pipe.hset(_tally_key(poll_id), mapping={option_id: tally.get(option_id, 0) for option_id in option_ids}
+                      or {"0": 0})
+            if voters:
+                pipe.hset(_voters_key(poll_id), mapping=voters)
+            pipe.set(_loaded_key(poll_id), "1")
+            await pipe.execute()
+    finally:
+        await _release_flush_lock(redis, token)
+
+
+async def record_vote(redis: Redis, session: AsyncSession, poll_id: int, option_id: int, user_tg_id: int) -> bool:
+    """
+    Учитывает голос в Redis (атомарно, Lua-скриптом) и ставит его в очередь на запись в PostgreSQL.
+    :return: True, если голос изменился.
+    """
+    keys = [_tally_key(poll_id), _voters_key(poll_id), PENDING_KEY, _loaded_key(poll_id)]
+    args = [user_tg_id, option_id, f"{poll_id}:{user_tg_id}"]
+    result = await redis.eval(_RECORD_SCRIPT, len(keys), *keys, *args)
+    if result == -1:
+        await load_poll(redis, session, poll_id)
+        result = await redis.eval(_RECORD_SCRIPT, len(keys), *keys, *args)
+    return result == 1
+
+
+async def get_tally(redis: Redis, poll_id: int) -> dict[int, int] | None:
+    """Возвращает живые счетчики {option_id: голосов} или None, если опрос не загружен в Redis."""
+    if not await redis.exists(_loaded_key(poll_id)):
+        return None
+    tally = await redis.hgetall(_tally_key(poll_id))
+    return {int(option_id): int(count) for option_id, count in tally.items()}
+
+
+async def get_user_vote(redis: Redis, poll_id: int, user_tg_id: int) -> int | None | bool:
+    """
+    Возвращает ID варианта, за который голосовал пользователь, None - если не голосовал,
+    или False, если опрос не загружен в Redis и нужно смотреть в БД.
+    """
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.exists(_loaded_key(poll_id))
+        pipe.hget(_voters_key(poll_id), user_tg_id)
+        loaded, option_id = await pipe.execute()
+    if not loaded:
+        return False
+    return int(option_id) if option_id is not None else None
+
+
+async def forget_poll(redis: Redis, poll_id: int):
+    """Удаляет состояние опроса из Redis (например, после удаления опроса)."""
+    await redis.delete(_tally_key(poll_id), _voters_key(poll_id), _loaded_key(poll_id))
+
+
+async def _flush_key(redis: Redis, session_pool: async_sessionmaker, key: str) -> int:
+    items = await redis.hgetall(key)
+    if items:
+        poll_ids, user_ids, option_ids = [], [], []
+        for field, option_id in items.items():
+            poll_id, user_tg_id = field.split(":")
+            poll_ids.append(int(poll_id))
+            user_ids.append(int(user_tg_id))
+            option_ids.append(int(option_id))
+
+        async with session_pool() as session:
+            await session.execute(FLUSH_VOTES_SQL, {
+                "poll_ids": poll_ids, "user_ids": user_ids, "option_ids": option_ids,
+            })
+            await session.commit()
+        # votes_count в БД изменились - ETag в API должны смениться вместе с ними
+        await poll_cache.bump_versions(redis, sorted(set(poll_ids)))
+    await redis.delete(key)
+    return len(items)
+
+
+async def flush(redis: Redis, session_pool: async_sessionmaker) -> int:
+    """
+    Сбрасывает накопленные голоса в PostgreSQL одной пачкой и корректирует агрегаты затронутых опросов.
+    Очередь атомарно переименовывается, поэтому новые голоса не теряются во время записи.
+    Одновременно работает только один флашер (блокировка в Redis), чтобы пачки не применялись не по порядку.
+    :return: количество сброшенных голосов.
+    """
+    token = await _acquire_flush_lock(redis)
+    if not token:
+        return 0
+    try:
+        flushed = 0
+        # Остатки пачек, не дописанных до сбоя, старше текущей очереди - применяем их первыми
+        for key in sorted([key async for key in redis.scan_iter(match=f"{FLUSHING_PREFIX}*")]):
+            flushed += await _flush_key(redis, session_pool, key)
+
+        processing_key = f"{FLUSHING_PREFIX}{int(time.time())}:{uuid.uuid4().hex}"
+        try:
+            await redis.rename(PENDING_KEY, processing_key)
+        except ResponseError:
+            # Очередь пуста
+            return flushed
+        flushed += await _flush_key(redis, session_pool, processing_key)
+        return flushed
+    finally:
+        await _release_flush_lock(redis, token)
+
+
+async def run_flusher(redis: Redis, session_pool: async_sessionmaker, interval: float = FLUSH_INTERVAL):
+    """Фоновая задача: раз в interval секунд сбрасывает голоса из Redis в PostgreSQL."""
+    logger.info(f"Запущен фоновый сброс голосов в БД (интервал {interval} c).")
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                flushed = await flush(redis, session_pool)
+                if flushed:
+                    logger.info(f"Сброшено голосов в БД: {flushed}")
+            except Exception as e:
+                logger.error(f"Ошибка при сбросе голосов в БД: {e}")
+    except asyncio.CancelledError:
+        await flush(redis, session_pool)
+        raise
+
+
+async def reconcile(redis: Redis, session_pool: async_sessionmaker):
+    """
+    Восстановление после сбоя: дописывает в БД все незавершенные пачки и заново строит
+    счетчики в Redis из PostgreSQL (опросы загружаются лениво, при первом голосе).
+    """
+    flushed = await flush(redis, session_pool)
+    dropped = 0
+    async for key in redis.scan_iter(match="poll:*:loaded"):
+        poll_id = int(key.split(":")[1])
+        await forget_poll(redis, poll_id)
+        dropped += 1
+    logger.info(f"Сверка голосов: сброшено в БД {flushed}, счетчики перестроятся для {dropped} опросов.")
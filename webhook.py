@@ -0,0 +1,189 @@
+# KorpBot/webhook.py
+#
+# Режим webhook: апдейты принимает aiohttp-сервер, и за балансировщиком может работать несколько реплик бота.
+# Состояние, общее для реплик (FSM, кэши, очереди голосов), уже живет в Redis и PostgreSQL.
+#
+# Локальная проверка без Telegram: запустить бота с BOT_MODE=webhook (WEBHOOK_BASE_URL можно не задавать)
+# и отправить записанные апдейты:
+#   python webhook.py replay updates.jsonl --url http://localhost:8080/webhook
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientSession, web
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram шлет апдейты (без пути). Если не задан, webhook не регистрируется -
+# удобно для локальной проверки и для реплик, которые не должны его перерегистрировать.
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# Сколько одновременных HTTPS-соединений Telegram может держать к webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Сколько апдейтов одна реплика обрабатывает одновременно
+UPDATES_MAX_IN_FLIGHT = int(os.getenv("UPDATES_MAX_IN_FLIGHT", 100))
+# Сколько секунд запрос ждет свободный слот; затем отвечаем 503, и Telegram повторит доставку позже
+WEBHOOK_SLOT_TIMEOUT = float(os.getenv("WEBHOOK_SLOT_TIMEOUT", 10))
+# Сколько секунд при остановке ждать завершения уже принятых апдейтов
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", 20))
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик webhook, который сразу отвечает Telegram и обрабатывает апдейт в фоне,
+    но не более max_in_flight апдейтов одновременно. Когда все слоты заняты, ответ задерживается:
+    Telegram не присылает больше WEBHOOK_MAX_CONNECTIONS запросов одновременно и сам притормаживает.
+    Переопределен только публичный handle(), а апдейт передается диспетчеру через Dispatcher.feed_raw_update:
+    внутренние методы фоновой обработки SimpleRequestHandler меняются от версии к версии aiogram.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int = UPDATES_MAX_IN_FLIGHT,
+                 slot_timeout: float = WEBHOOK_SLOT_TIMEOUT, **kwargs: Any):
+        super().__init__(dispatcher, bot, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.slot_timeout = slot_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {"accepted": 0, "rejected": 0, "failed": 0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.slot_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            logger.warning(f"Все {self.max_in_flight} слотов заняты, апдейт {update.get('update_id')} отклонен.")
+            return web.Response(status=503, text="Busy")
+
+        task = asyncio.create_task(self._process_update(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_update_done)
+        self.stats["accepted"] += 1
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def _process_update(self, bot: Bot, update: dict):
+        result = await self.dispatcher.feed_raw_update(bot, update, **self.data)
+        # Ответ Telegram уже отправлен, поэтому метод API, который вернул хэндлер, выполняется отдельным запросом
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot, result)
+
+    def _on_update_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["failed"] += 1
+            logger.error(f"Ошибка обработки апдейта: {task.exception()}")
+
+    async def drain(self, timeout: float = WEBHOOK_SHUTDOWN_TIMEOUT):
+        """Дожидается уже принятых апдейтов (при остановке реплики)."""
+        if self._tasks:
+            logger.info(f"Ожидание завершения {self.in_flight} апдейтов...")
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """
+    Запускает aiohttp-сервер с обработчиком webhook и работает до SIGTERM/SIGINT.
+    Если задан WEBHOOK_BASE_URL, регистрирует webhook в Telegram (повторная регистрация
+    тем же адресом из другой реплики безопасна). При остановке webhook не удаляется:
+    апдейты продолжат получать остальные реплики.
+    """
+    handler = LimitedRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None)
+
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "in_flight": handler.in_flight,
+            "max_in_flight": handler.max_in_flight,
+            **handler.stats,
+        })
+
+    app.router.add_get("/healthz", healthz)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} "
+                f"(одновременно до {handler.max_in_flight} апдейтов)")
+
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задан: запросы к webhook не проверяются.")
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"Webhook зарегистрирован: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Остановка webhook-сервера...")
+        # Сначала перестаем принимать запросы, затем дожидаемся принятых апдейтов
+        await site.stop()
+        await handler.drain()
+        await runner.cleanup()
+
+
+async def replay(path: str, url: str, secret: str, concurrency: int):
+    """Отправляет апдейты из файла (по одному JSON на строку или JSON-массив) на webhook."""
+    with open(path, encoding="utf-8") as file:
+        content = file.read().strip()
+    updates = json.loads(content) if content.startswith("[") else [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses: dict[int, int] = {}
+
+    async with ClientSession() as session:
+        async def post(update: dict):
+            async with semaphore:
+                async with session.post(url, json=update, headers=headers) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        await asyncio.gather(*(post(update) for update in updates))
+    print(f"Отправлено апдейтов: {len(updates)}, ответы: {statuses}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Инструменты webhook-режима")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="Отправить записанные апдейты на webhook")
+    replay_parser.add_argument("file", help="Файл с апдейтами (JSON Lines или JSON-массив)")
+    replay_parser.add_argument("--url", default=f"http://localhost:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    replay_parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    replay_parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(replay(args.file, args.url, args.secret, args.concurrency)))
@@ -1,10 +1,23 @@
 import os
 import logging
 import sys
+import time
 from celery import Celery
-from celery.signals import after_setup_logger
+from celery.signals import (
+    after_setup_logger,
+    task_failure,
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
 from dotenv import load_dotenv
 
+import metrics
+from worker_runtime import runtime
+
 load_dotenv()
 
 # --- ИСПРАВЛЕНИЕ: Каноническая настройка логирования для Celery ---
@@ -36,7 +49,68 @@ celery_app = Celery(
 
 celery_app.conf.update(
     result_expires=3600,
+    # Шарды рассылок подтверждаются только после выполнения (acks_late), поэтому
+    # не берем задачи "впрок" и даем им достаточно времени до повторной доставки.
+    worker_prefetch_multiplier=1,
+    broker_transport_options={"visibility_timeout": 4 * 3600},
 )
 
+
+# --- АСИНХРОННАЯ СРЕДА ЗАДАЧ ---
+# Один event loop, Bot и пул БД на процесс (см. worker_runtime.py). Запускается уже в дочернем процессе:
+# поток с loop и соединения не переживают fork.
+
+@worker_process_init.connect
+def start_async_runtime(**kwargs):
+    runtime.start()
+
+
+@worker_process_shutdown.connect
+def stop_async_runtime(**kwargs):
+    runtime.stop()
+
+
+# Пулы solo и threads выполняют задачи в главном процессе, там среду останавливаем при остановке воркера
+@worker_shutdown.connect
+def stop_main_process_runtime(**kwargs):
+    runtime.stop()
+
+
+# --- МЕТРИКИ PROMETHEUS ---
+# Задачи выполняются в дочерних процессах prefork-пула, поэтому для воркера нужен PROMETHEUS_MULTIPROC_DIR:
+# сервер метрик в главном процессе собирает значения всех дочерних.
+
+# Время старта выполняющихся задач процесса по task_id
+_task_started: dict[str, float] = {}
+
+
+@worker_init.connect
+def start_metrics(**kwargs):
+    metrics.reset_multiprocess_dir()
+    metrics.start_metrics_server()
+
+
+@worker_process_shutdown.connect
+def forget_process_metrics(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+
+
+@task_prerun.connect
+def task_started(task_id=None, **kwargs):
+    _task_started[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        metrics.CELERY_TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.monotonic() - started)
+
+
+@task_failure.connect
+def task_failed(sender=None, exception=None, **kwargs):
+    metrics.CELERY_TASK_FAILURES.labels(getattr(sender, "name", "unknown"), type(exception).__name__).inc()
+
+
 if __name__ == '__main__':
     celery_app.start()
@@ -0,0 +1,117 @@
+# KorpBot/worker_runtime.py
+#
+# Асинхронная среда процесса Celery-воркера: один долгоживущий event loop в отдельном потоке,
+# общие на весь процесс Bot (aiohttp-сессия), клиент Redis и пул соединений с БД.
+# Задачи отправляют корутины в этот loop (runtime.run) вместо asyncio.run: не создается новый loop,
+# сессия и соединения на каждую задачу, а соединения пула не оказываются привязаны к закрытому loop.
+#
+# Запускается на worker_process_init (после fork, в каждом дочернем процессе prefork-пула) и
+# останавливается на worker_process_shutdown - см. worker.py. В других пулах (solo, threads) и при
+# вызове задач вне воркера среда запускается при первом обращении.
+
+import asyncio
+import logging
+import os
+import threading
+from typing import Any, Coroutine, TypeVar
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Сколько секунд ждать закрытия сессий и соединений при остановке процесса
+RUNTIME_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_RUNTIME_SHUTDOWN_TIMEOUT", 10))
+
+
+class AsyncRuntime:
+    """Event loop процесса и общие для всех задач клиенты."""
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+        self._bot: Bot | None = None
+        self._redis: redis.Redis | None = None
+
+    @property
+    def started(self) -> bool:
+        # После fork поток родителя в дочернем процессе не существует, поэтому сверяем pid
+        return self._loop is not None and self._pid == os.getpid()
+
+    def start(self):
+        with self._lock:
+            if self.started:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._pid = os.getpid()
+            self._bot = None
+            self._redis = None
+            self._thread = threading.Thread(target=self._loop.run_forever, name="worker-async-runtime", daemon=True)
+            self._thread.start()
+        logger.info(f"Асинхронная среда воркера запущена (pid {self._pid}).")
+
+    @property
+    def bot(self) -> Bot:
+        """Общий Bot процесса; aiohttp-сессия создается при первом запросе и живет до остановки."""
+        if self._bot is None:
+            self._bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+        return self._bot
+
+    @property
+    def redis(self) -> redis.Redis:
+        if self._redis is None:
+            # worker.py подключает сигналы этого модуля, поэтому импортируем его здесь
+            from worker import REDIS_URL
+            self._redis = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        return self._redis
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Выполняет корутину в loop процесса и ждет результат (из синхронного кода задачи)."""
+        if not self.started:
+            self.start()
+        if threading.current_thread() is self._thread:
+            # Ожидание результата заблокировало бы сам loop (например, задача в eager-режиме из корутины)
+            coro.close()
+            raise RuntimeError("runtime.run нельзя вызывать из корутины, выполняющейся в этом же loop")
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result()
+        except BaseException:
+            # Задачу прервали (SoftTimeLimitExceeded, остановка воркера) - отменяем и корутину
+            future.cancel()
+            raise
+
+    async def _close_clients(self):
+        from database.main import engine
+
+        if self._bot is not None:
+            await self._bot.session.close()
+        if self._redis is not None:
+            await self._redis.aclose()
+        await engine.dispose()
+
+    def stop(self):
+        """Закрывает сессию бота, Redis и пул БД, затем останавливает loop. Повторный вызов ничего не делает."""
+        with self._lock:
+            if not self.started:
+                return
+            loop, thread = self._loop, self._thread
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_clients(), loop).result(RUNTIME_SHUTDOWN_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Не удалось корректно закрыть соединения воркера: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(RUNTIME_SHUTDOWN_TIMEOUT)
+            loop.close()
+            self._loop = self._thread = self._pid = None
+            self._bot = self._redis = None
+        logger.info("Асинхронная среда воркера остановлена.")
+
+
+runtime = AsyncRuntime()